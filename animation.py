@@ -1,7 +1,7 @@
 import pygame
-from draw_dashed_line import draw_dashed_line
 
 from animation_base import AnimationBase
+from assets import load_atlas
 from vehicle import Vehicle
 
 WHITE = (255, 255, 255)
@@ -34,46 +34,95 @@ class Animation(AnimationBase):
 
         self._screen = pygame.display.set_mode((conf.window_width, conf.window_height))
 
-        # Load vehicle types
-        car_type_image = pygame.transform.scale(pygame.image.load('car_side.png'),
-                (int(4*conf.scale), int(2*conf.scale)))
-        self._vtypes = {'car': car_type_image}
+        # The road never changes: draw it once, blit it every frame.
+        self._background = self._draw_background()
+
+        # Vehicle sprites, scaled on first use per (type id, length)
+        self._atlas = load_atlas()
+        self._sprites = {}
+
+        # Dirty rectangle mode: vehicle -> screen rect drawn in the last frame
+        self._dirty_rects = conf.dirty_rects
+        self._rects = None
 
     def draw_frame(self):
         super().draw_frame()
 
         self._handle_events()
-        self._screen.fill(WHITE)
-        self._draw_road()
-
-        for v in self._sim:
-            self._draw_vehicle(v)
+        if self._dirty_rects:
+            self._draw_dirty()
+        else:
+            self._screen.blit(self._background, (0, 0))
+            for v in self._sim:
+                self._draw_vehicle(v)
+            pygame.display.flip()
 
-        pygame.display.flip()
         self._clock.tick(self._conf.fps)
 
-    def _draw_road(self):
+    def _draw_dirty(self):
+        """
+        Restore the background under the vehicles of the last frame, draw the
+        vehicles and update only the screen areas that changed.
+        """
+        if self._rects is None:
+            self._screen.blit(self._background, (0, 0))
+            self._rects = {v: self._draw_vehicle(v) for v in self._sim}
+            pygame.display.flip()
+            return
+
+        old = self._rects
+        for rect in old.values():
+            self._screen.blit(self._background, rect, rect)
+
+        # Redraw all vehicles, restoring the background may have erased
+        # parts of vehicles that didn't move.
+        self._rects = {v: self._draw_vehicle(v) for v in self._sim}
+
+        dirty = []
+        for v, rect in self._rects.items():
+            prev = old.pop(v, None)
+            if prev is None:
+                dirty.append(rect)
+            elif prev != rect:
+                # Vehicles wrapping to the next row move far, don't merge.
+                dirty.extend([rect.union(prev)] if rect.colliderect(prev) else [rect, prev])
+        dirty.extend(old.values())      # despawned vehicles
+
+        pygame.display.update(dirty)
+
+    def _draw_background(self):
+        background = pygame.Surface(self._screen.get_size()).convert()
+        background.fill(WHITE)
+        self._draw_road(background)
+        return background
+
+    def _draw_road(self, surf):
         sc = self._conf.scale
-        sw = self._screen.get_width()
+        sw = surf.get_width()
 
         for row in range(self._conf.rows):
             y = self._y_offset(row, 0)
-            pygame.draw.rect(self._screen, WHITE, (0, y, sw, sc*self._conf.nb_lanes*LANE_WIDTH))
+            pygame.draw.rect(surf, WHITE, (0, y, sw, sc*self._conf.nb_lanes*LANE_WIDTH))
             
-            pygame.draw.line(self._screen, BLACK, (0, y), (sw, y), 3)
+            pygame.draw.line(surf, BLACK, (0, y), (sw, y), 3)
             
             for lane in range(1, self._conf.nb_lanes):
                 y += LANE_WIDTH*sc
-                pygame.draw.line(self._screen, GREY, (0, y), (sw, y), 1)
+                pygame.draw.line(surf, GREY, (0, y), (sw, y), 1)
 
             y += LANE_WIDTH*sc
-            pygame.draw.line(self._screen, BLACK, (0, y), (sw, y), 3)
+            pygame.draw.line(surf, BLACK, (0, y), (sw, y), 3)
 
-    def _draw_vehicle(self, v):
-        if not v.type in self._vtypes:
-            raise Exception('ERROR: animation can\'t deal with vehicle type {}'.format(v.type))
+    def _sprite(self, v):
+        key = (v.type_id, v.length)
+        if key not in self._sprites:
+            sc = self._conf.scale
+            self._sprites[key] = pygame.transform.scale(self._atlas.sprite(v.type_id).convert_alpha(),
+                                                        (int(v.length*sc), int(2*sc)))
+        return self._sprites[key]
 
-        image = self._vtypes[v.type]
+    def _draw_vehicle(self, v):
+        image = self._sprite(v)
         rect = image.get_rect()
 
         sc = self._conf.scale
@@ -92,6 +141,7 @@ class Animation(AnimationBase):
             self._screen.fill(RED, rect=rect)
         else:
             self._screen.blit(image, rect)
+        return rect.clip(self._screen.get_rect())
 
     def _y_offset(self, row, lane):
         sc = self._conf.scale
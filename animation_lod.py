@@ -0,0 +1,111 @@
+import numpy as np
+
+import pygame
+from pygame.locals import *
+
+from OpenGL.GL import *
+OpenGL.ERROR_CHECKING = False
+
+import animation_opengl_vbo
+from animation_base import AnimationBase
+from render_geometry import Viewport, lane_bins, strip_quads, vehicle_quads
+
+CAR_LENGTH = 4.0        # meter
+MAX_LENGTH = 15.0       # meter, longest vehicle, margin for culling
+MIN_VEHICLE_PX = 3      # cars shorter than this on screen are aggregated in strips
+STRIP_PX = 4            # minimum length of a strip on screen
+ZOOM_STEP = 1.25
+PAN_STEP = 0.1          # fraction of the viewport per arrow key press
+
+class Animation(animation_opengl_vbo.Animation):
+    """
+    Level of detail animation for long roads. The window has a fixed size and
+    shows a viewport that can be zoomed (mouse wheel, +/-, 0 to reset) and
+    panned (right mouse drag, arrow keys). Only the vehicles inside the
+    viewport are drawn. Zoomed out so far that cars would be shorter than
+    MIN_VEHICLE_PX pixels, the lanes are drawn as strips colored by the mean
+    speed and the density of their vehicles instead.
+    """
+
+    def __init__(self, sim, conf):
+        super().__init__(sim, conf)
+        pygame.display.set_caption('Highway simulation (OpenGL, level of detail)')
+
+        self._viewport = Viewport(self._geometry, *self._display)
+        self._max_speed = conf.speed_range[1]
+
+    def _display_size(self):
+        return (self._conf.window_width, self._conf.window_height)
+
+    def _confirm_display(self):
+        pass    # the window size doesn't depend on the road length
+
+    def _pixel_to_world(self, x, y):
+        return self._viewport.to_world(x, y)
+
+    def draw_frame(self):
+        AnimationBase.draw_frame(self)
+
+        self._set_view()
+        glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+        self._draw_asphalt()
+        self._draw_road()
+        self._draw_vehicles()
+
+        pygame.display.flip()
+        self._clock.tick(self._conf.fps)
+
+    def _set_view(self):
+        vp = self._viewport
+        glLoadIdentity()
+        glScalef(1.0, -1.0, 1.0)
+        glTranslatef(-1.0, -1.0, 0.0)
+        glScalef(2.0, 2.0, 1.0)
+        glScalef(1/vp.width, 1/vp.height, 1.0)
+        glTranslatef(-vp.x0, -vp.y0, 0.0)
+
+    def _draw_vehicles(self):
+        g = self._geometry
+        vp = self._viewport
+
+        arr = self._vehicle_arrays()
+        xc, yc = g.vehicle_centers(arr['position'], arr['animlane'])
+        arr = arr[vp.visible(xc, yc, MAX_LENGTH)]
+        if len(arr) == 0:
+            return
+
+        mpp = vp.meters_per_pixel
+        if CAR_LENGTH/mpp < MIN_VEHICLE_PX:
+            # Power of 2 bin lengths, so the strips don't jitter while zooming.
+            bin_len = 2.0**np.ceil(np.log2(STRIP_PX*mpp))
+            counts, speed = lane_bins(arr, g, bin_len)
+            self._submit(strip_quads(counts, speed, g, bin_len, self._max_speed), 0)
+        else:
+            body, indicators = vehicle_quads(arr, g, self._uv)
+            self._submit(np.concatenate([body, indicators]), len(body))
+
+    def _handle_event(self, event):
+        super()._handle_event(event)
+
+        vp = self._viewport
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button in (4, 5):
+            cx, cy = vp.to_world(*event.pos)
+            vp.zoom(ZOOM_STEP if event.button == 4 else 1/ZOOM_STEP, cx, cy)
+        elif event.type == pygame.MOUSEMOTION and event.buttons[2]:
+            mpp = vp.meters_per_pixel
+            vp.pan(-event.rel[0]*mpp, -event.rel[1]*mpp)
+        elif event.type == pygame.KEYDOWN:
+            if event.key in (pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS):
+                vp.zoom(ZOOM_STEP)
+            elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                vp.zoom(1/ZOOM_STEP)
+            elif event.key == pygame.K_0:
+                vp.reset()
+            elif event.key == pygame.K_LEFT:
+                vp.pan(-PAN_STEP*vp.width, 0)
+            elif event.key == pygame.K_RIGHT:
+                vp.pan(PAN_STEP*vp.width, 0)
+            elif event.key == pygame.K_UP:
+                vp.pan(0, -PAN_STEP*vp.height)
+            elif event.key == pygame.K_DOWN:
+                vp.pan(0, PAN_STEP*vp.height)
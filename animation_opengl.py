@@ -10,9 +10,7 @@ import inspect
 from vehicle import Car, Truck
 
 from animation_base import AnimationBase
-
-LANE_WIDTH   = 4.0
-ROAD_SPACING = 2.5
+from render_geometry import LANE_WIDTH, ROAD_SPACING
 
 class Animation(AnimationBase):
 
@@ -30,7 +28,7 @@ class Animation(AnimationBase):
         self._world_height = self._road_width * conf.rows + ROAD_SPACING # meter
         self._pixels_per_meter = conf.window_width / self._row_length    # px/meter
 
-        self._display = (conf.window_width, int(self._world_height*self._pixels_per_meter))
+        self._display = self._display_size()
         self._confirm_display()
         self._clock = pygame.time.Clock()
         self._screen = pygame.display.set_mode(self._display, DOUBLEBUF|OPENGL)
@@ -41,7 +39,10 @@ class Animation(AnimationBase):
         glScalef(1/self._row_length, 1/self._world_height, 1.0)
         glClearColor(1.0, 1.0, 1.0, 1.0)
 
-        self.textures = {
+        self.textures = self._load_textures()
+
+    def _load_textures(self):
+        return {
             'yellow_car': self.TexFromIMG("data/yellow_car.png"),
             'black_car':  self.TexFromIMG("data/black_car.png"),
             'police_car': self.TexFromIMG("data/police_car.png"),
@@ -52,6 +53,9 @@ class Animation(AnimationBase):
             'tesla':      self.TexFromIMG("data/tesla.png")
         }
         
+    def _display_size(self):
+        return (self._conf.window_width, int(self._world_height*self._pixels_per_meter))
+
     def _confirm_display(self):
         if self._display[1] > 1080:
             r = input('Confirm window height {}? '.format(self._display[1]))
@@ -173,9 +177,11 @@ class Animation(AnimationBase):
     def _y_offset(self, row, lane):
         return row*self._road_width + ROAD_SPACING + lane*LANE_WIDTH
 
+    def _pixel_to_world(self, x, y):
+        return (x / self._pixels_per_meter, y / self._pixels_per_meter)
+
     def _pixel_pox_to_pos_lane(self, x, y):
-        xm = x / self._pixels_per_meter
-        ym = y / self._pixels_per_meter
+        xm, ym = self._pixel_to_world(x, y)
 
         row = ym // self._road_width
         pos = row*self._row_length + xm
@@ -184,11 +190,7 @@ class Animation(AnimationBase):
         return (pos, lane)
 
     def _slow_down_cars(self, pos):
-        for i in range(self._conf.nb_lanes):
-            v = self._sim.find_vehicle(pos, i)
-            if v:
-                v.velocity = 0
-                v.acceleration = 0
+        self._sim.stop_vehicles(pos)
 
     def TexFromIMG(self, filename):
         img = pygame.image.load(filename)
@@ -0,0 +1,106 @@
+import ctypes
+
+import numpy as np
+
+import pygame
+from pygame.locals import *
+
+from OpenGL.GL import *
+OpenGL.ERROR_CHECKING = False
+
+import animation_opengl
+from animation_base import AnimationBase
+from assets import SPRITES, load_atlas
+from render_geometry import RoadGeometry, VERTEX_SIZE, vehicle_arrays, vehicle_quads
+
+class Animation(animation_opengl.Animation):
+    """
+    OpenGL animation drawing all vehicles with two draw calls per frame: the
+    vehicle quads are computed with numpy, streamed to one vertex buffer and
+    textured from a single atlas, instead of one glBegin/glEnd block and
+    texture bind per vehicle.
+    """
+
+    def __init__(self, sim, conf):
+        super().__init__(sim, conf)
+        pygame.display.set_caption('Highway simulation (OpenGL, batched)')
+
+        self._geometry = RoadGeometry(conf)
+        self._vbo = glGenBuffers(1)
+
+    def _load_textures(self):
+        atlas = load_atlas()
+        self._uv = atlas.uv
+
+        self._atlas = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self._atlas)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_ADD)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, atlas.width, atlas.height, 0,
+                     GL_RGBA, GL_UNSIGNED_BYTE, atlas.tobytes())
+
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        return {s: self._atlas for s in SPRITES}
+
+    def destroy(self):
+        glDeleteBuffers(1, [self._vbo])
+        glDeleteTextures([self._atlas])
+        super().destroy()
+
+    def draw_frame(self):
+        AnimationBase.draw_frame(self)
+
+        glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+        self._draw_asphalt()
+        self._draw_road()
+        self._draw_vehicles()
+
+        pygame.display.flip()
+        self._clock.tick(self._conf.fps)
+
+    def _vehicle_arrays(self):
+        # A SimulationProcess publishes its vehicles as arrays.
+        if hasattr(self._sim, 'vehicle_arrays'):
+            return self._sim.vehicle_arrays()
+        return vehicle_arrays(self._sim)
+
+    def _draw_vehicles(self):
+        arr = self._vehicle_arrays()
+        if len(arr) == 0:
+            return
+        body, indicators = vehicle_quads(arr, self._geometry, self._uv)
+        self._submit(np.concatenate([body, indicators]), len(body))
+
+    def _submit(self, data, nb_textured):
+        """
+        Upload the interleaved vertices and draw them as quads, the first
+        nb_textured vertices textured from the atlas.
+        """
+        glBindBuffer(GL_ARRAY_BUFFER, self._vbo)
+        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data, GL_STREAM_DRAW)
+
+        stride = VERTEX_SIZE * 4
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glVertexPointer(2, GL_FLOAT, stride, ctypes.c_void_p(0))
+        glTexCoordPointer(2, GL_FLOAT, stride, ctypes.c_void_p(8))
+        glColorPointer(3, GL_FLOAT, stride, ctypes.c_void_p(16))
+
+        glEnable(GL_BLEND)
+        if nb_textured:
+            glEnable(GL_TEXTURE_2D)
+            glBindTexture(GL_TEXTURE_2D, self._atlas)
+            glDrawArrays(GL_QUADS, 0, nb_textured)
+            glDisable(GL_TEXTURE_2D)
+        if len(data) > nb_textured:
+            glDrawArrays(GL_QUADS, nb_textured, len(data) - nb_textured)
+
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glColor3f(0.0, 0.0, 0.0)
@@ -0,0 +1,153 @@
+import hashlib
+import os
+
+import numpy as np
+import pygame
+
+# Vehicle sprites, the index in this list is the type id of a vehicle type.
+SPRITES = ['yellow_car', 'black_car', 'police_car', 'ambulance',
+           'red_truck', 'long_truck', 'car', 'tesla']
+TYPE_IDS = {name: i for i, name in enumerate(SPRITES)}
+
+DATA_DIR = 'data'
+CACHE_FILE = os.path.join(DATA_DIR, 'cache', 'atlas.npz')
+
+ATLAS_PADDING = 2   # px between sprites, avoids bleeding with linear filtering
+
+def sprite_files(data_dir=DATA_DIR):
+    return [os.path.join(data_dir, name + '.png') for name in SPRITES]
+
+def _signature(filenames):
+    """ Changes whenever a sprite file or the packing changes. """
+    h = hashlib.sha1(str(ATLAS_PADDING).encode())
+    for f in filenames:
+        st = os.stat(f)
+        h.update('{}:{}:{}'.format(os.path.basename(f), st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+class Atlas:
+    """
+    All sprites packed in a grid of equal cells of one RGBA image. rgba is
+    stored bottom row first, ready for glTexImage2D. uv holds the (u0, v0,
+    u1, v1) texture coordinates and rects the (x, y, w, h) pixel rectangle
+    (top row first) of every sprite, indexed by type id.
+    """
+
+    def __init__(self, rgba, uv, rects):
+        self.rgba = rgba
+        self.uv = uv
+        self.rects = rects
+        self._surface = None
+
+    @property
+    def width(self):
+        return self.rgba.shape[1]
+
+    @property
+    def height(self):
+        return self.rgba.shape[0]
+
+    @classmethod
+    def from_files(cls, filenames):
+        images = [pygame.image.load(f) for f in filenames]
+        cols = int(np.ceil(np.sqrt(len(images))))
+        rows = int(np.ceil(len(images) / cols))
+        cell_w = max(img.get_width() for img in images) + ATLAS_PADDING
+        cell_h = max(img.get_height() for img in images) + ATLAS_PADDING
+        width, height = cols*cell_w, rows*cell_h
+
+        surface = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+        uv = np.empty((len(images), 4), dtype=np.float32)
+        rects = np.empty((len(images), 4), dtype=np.int32)
+        for i, img in enumerate(images):
+            w, h = img.get_size()
+            x, y = (i % cols)*cell_w, (i // cols)*cell_h
+            surface.blit(img, (x, y))
+            rects[i] = (x, y, w, h)
+            # Same texture coordinates (0.01 to 0.95) as the per sprite textures.
+            v = height - y - h
+            uv[i] = ((x + 0.01*w)/width, (v + 0.01*h)/height,
+                     (x + 0.95*w)/width, (v + 0.95*h)/height)
+
+        data = pygame.image.tostring(surface, 'RGBA', True)
+        rgba = np.frombuffer(data, dtype=np.uint8).reshape(height, width, 4)
+        return cls(rgba, uv, rects)
+
+    def tobytes(self):
+        return self.rgba.tobytes()
+
+    def surface(self):
+        """ The atlas as a pygame surface (top row first). """
+        if self._surface is None:
+            data = np.ascontiguousarray(self.rgba[::-1]).tobytes()
+            self._surface = pygame.image.fromstring(data, (self.width, self.height), 'RGBA')
+        return self._surface
+
+    def sprite(self, type_id):
+        return self.surface().subsurface(tuple(int(c) for c in self.rects[type_id]))
+
+def load_atlas(data_dir=DATA_DIR, cache_file=CACHE_FILE):
+    """
+    The sprite atlas, packed on first use and cached as raw RGBA in
+    cache_file. The cache is rebuilt when a sprite changes.
+    """
+    files = sprite_files(data_dir)
+    signature = _signature(files)
+
+    try:
+        with np.load(cache_file) as c:
+            if str(c['signature']) == signature:
+                return Atlas(c['rgba'], c['uv'], c['rects'])
+    except (OSError, KeyError, ValueError):
+        pass
+
+    atlas = Atlas.from_files(files)
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp = cache_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, signature=signature, rgba=atlas.rgba, uv=atlas.uv, rects=atlas.rects)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass    # read-only data directory, pack again next time
+    return atlas
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+class AtlasTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmp, 'cache', 'atlas.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_pack(self):
+        atlas = load_atlas(cache_file=self.cache_file)
+        self.assertEqual(atlas.rgba.shape, (atlas.height, atlas.width, 4))
+
+        tesla = pygame.image.load(sprite_files()[TYPE_IDS['tesla']])
+        sprite = atlas.sprite(TYPE_IDS['tesla'])
+        self.assertEqual(sprite.get_size(), tesla.get_size())
+        self.assertEqual(sprite.get_at((10, 10)), tesla.get_at((10, 10)))
+        self.assertTrue(np.all((atlas.uv >= 0) & (atlas.uv <= 1)))
+
+    def test_cache(self):
+        atlas = load_atlas(cache_file=self.cache_file)
+        self.assertTrue(os.path.exists(self.cache_file))
+
+        with mock.patch.object(Atlas, 'from_files', side_effect=AssertionError('not cached')):
+            cached = load_atlas(cache_file=self.cache_file)
+        self.assertTrue(np.array_equal(atlas.rgba, cached.rgba))
+        self.assertTrue(np.array_equal(atlas.uv, cached.uv))
+
+if __name__ == '__main__':
+    unittest.main()
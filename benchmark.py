@@ -0,0 +1,287 @@
+#!/usr/bin/python
+
+import argparse
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from config import HeadlessConfig
+from simulation import SimulationWithHandlers
+from vehicle import Vehicle, Car, Truck, AutomaticCar
+from vehicle_container import VehicleContainer
+from sim_event_handler import *
+
+# Full matrix, and a small one for quick checks (--quick).
+MATRIX = {
+    'vehicles': [50, 200, 800],
+    'nb_lanes': [1, 2, 4, 8],
+    'road_len': [600, 2000],
+    'handlers': ['none', 'stats', 'slow_zone'],
+}
+QUICK_MATRIX = {
+    'vehicles': [50, 200],
+    'nb_lanes': [1, 3],
+    'road_len': [600],
+    'handlers': ['none', 'stats'],
+}
+CONTAINER_SIZES = [100, 1000, 10000]
+
+def make_handlers(name, conf):
+    if name == 'none':
+        return []
+    elif name == 'stats':
+        return [StatsEvHandler(), AverageSpeedHandler(), ThroughPutHandler(),
+                TravelTimeHandler(), VehicleCountHandler()]
+    elif name == 'slow_zone':
+        return [SlowZoneEvHandler(conf.road_len/2, conf.road_len/2 + 150, max_velocity=7)]
+    raise ValueError("unknown handler set: {}".format(name))
+
+MIN_SPACING = 12.0   # meter, front to front
+
+def populate(sim, nb_vehicles):
+    """
+    Place up to nb_vehicles evenly over the lanes and the road (as many as
+    fit with MIN_SPACING), at a velocity they can keep with that spacing.
+    The spawn rate is set such that the inflow roughly matches the outflow.
+    Returns the number of vehicles placed.
+    """
+    conf = sim._conf
+    per_lane = max(1, min(nb_vehicles // conf.nb_lanes, int(conf.road_len // MIN_SPACING)))
+    spacing = conf.road_len / per_lane
+    velocity = min(np.mean(conf.speed_range), spacing)
+
+    for lane in range(conf.nb_lanes):
+        for i in range(per_lane):
+            p = np.random.rand()
+            if p < 0.45:
+                cls = Car
+            elif p < 0.90 or lane != conf.nb_lanes-1 or spacing < 2*MIN_SPACING:
+                cls = AutomaticCar
+            else:
+                cls = Truck
+            # From the pool, to get an id like the spawned vehicles.
+            vehicle = sim._pool.acquire(cls, lane)
+            vehicle.position = i*spacing
+            vehicle.velocity = velocity
+            sim._spawn_vehicle(vehicle)
+
+    conf.spawn_rate = per_lane * conf.nb_lanes * velocity / conf.road_len
+    return per_lane * conf.nb_lanes
+
+def _seed(seed):
+    np.random.seed(seed)
+    random.seed(seed)
+
+def _make_sim(params, seed):
+    _seed(seed)
+    conf = HeadlessConfig()
+    conf.nb_lanes = params['nb_lanes']
+    conf.road_len = params['road_len']
+    sim = SimulationWithHandlers(conf, make_handlers(params['handlers'], conf))
+    nb_placed = populate(sim, params['vehicles'])
+    return sim, nb_placed
+
+def bench_simulation(params, steps, dt=1./60, seed=0):
+    """ Time `steps` time steps of a headless simulation. """
+    sim, nb_placed = _make_sim(params, seed)
+    latencies = np.empty(steps)
+    vehicle_steps = 0
+
+    for i in range(steps):
+        vehicle_steps += sum(len(l) for l in sim._container._lists)
+        t0 = time.perf_counter()
+        sim.time_step(dt)
+        latencies[i] = time.perf_counter() - t0
+
+    # Peak memory is measured in a separate run, tracemalloc slows down
+    # the simulation too much to be part of the timed run.
+    sim, nb_placed = _make_sim(params, seed)
+    tracemalloc.start()
+    for i in range(min(steps, 100)):
+        sim.time_step(dt)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    total = latencies.sum()
+    return dict(params,
+        steps=steps,
+        vehicles_placed=nb_placed,
+        vehicle_steps=vehicle_steps,
+        vehicle_steps_per_sec=vehicle_steps / total,
+        steps_per_sec=steps / total,
+        latency_p50=np.percentile(latencies, 50),
+        latency_p90=np.percentile(latencies, 90),
+        latency_p99=np.percentile(latencies, 99),
+        latency_max=latencies.max(),
+        peak_memory=peak_memory)
+
+def _timed(fn, n):
+    t0 = time.perf_counter()
+    fn()
+    return n / (time.perf_counter() - t0)
+
+def bench_container(size, nb_lanes=3, seed=0):
+    """ Operations per second of the VehicleContainer operations. """
+    _seed(seed)
+    vehicles = [Vehicle(np.random.randint(nb_lanes), position=p)
+                for p in np.random.uniform(0, 10*size, size)]
+    container = VehicleContainer(nb_lanes)
+    results = {'size': size, 'nb_lanes': nb_lanes}
+
+    def spawn():
+        for v in vehicles:
+            container.spawn(v)
+    results['spawn'] = _timed(spawn, size)
+
+    results['iterate'] = _timed(lambda: sum(1 for v in container), size)
+
+    def closest():
+        for v in vehicles:
+            container.get_closest_vehicle(v, (v.lane+1) % nb_lanes)
+    results['get_closest_vehicle'] = _timed(closest, size)
+
+    def front_back():
+        for v in vehicles:
+            container.front(v)
+            container.back(v)
+    results['front_back'] = _timed(front_back, 2*size)
+
+    def lane_change():
+        for v in vehicles:
+            old_lane = v.lane
+            v.lane = (v.lane+1) % nb_lanes
+            container.notify_lane_change(v, old_lane)
+    results['notify_lane_change'] = _timed(lane_change, size)
+
+    def despawn():
+        for v in vehicles:
+            container.despawn(v)
+    results['despawn'] = _timed(despawn, size)
+
+    results['spawn_many'] = _timed(lambda: container.spawn_many(vehicles), size)
+    # Trim the road in 100 steps, like the vehicles leaving it.
+    def despawn_beyond():
+        for end in np.linspace(10*size, 0, 100):
+            container.despawn_beyond(end)
+    results['despawn_beyond'] = _timed(despawn_beyond, size)
+
+    return results
+
+def run(matrix, steps):
+    results = {'meta': _meta(), 'simulation': [], 'container': []}
+
+    keys = sorted(matrix)
+    for values in itertools.product(*[matrix[k] for k in keys]):
+        params = dict(zip(keys, values))
+        r = bench_simulation(params, steps)
+        results['simulation'].append(r)
+        print('{:40s} {:10.0f} vehicle-steps/s  p50 {:6.2f} ms  p99 {:6.2f} ms  {:8.0f} kB'.format(
+            _key(r), r['vehicle_steps_per_sec'], 1000*r['latency_p50'],
+            1000*r['latency_p99'], r['peak_memory']/1e3))
+
+    for size in CONTAINER_SIZES:
+        r = bench_container(size)
+        results['container'].append(r)
+        print('container size={:6d} '.format(size) + '  '.join('{}={:.0f}/s'.format(k, r[k])
+            for k in sorted(r) if k not in ('size', 'nb_lanes')))
+
+    return results
+
+def compare(old, new, tolerance):
+    """
+    Compare two benchmark results, return the list of regressions: entries
+    whose throughput dropped by more than `tolerance` (relative).
+    """
+    regressions = []
+
+    old_sim = {_key(r): r for r in old['simulation']}
+    for r in new['simulation']:
+        k = _key(r)
+        if k in old_sim:
+            ratio = r['vehicle_steps_per_sec'] / old_sim[k]['vehicle_steps_per_sec']
+            print('{:40s} {:6.2f}x'.format(k, ratio))
+            if ratio < 1 - tolerance:
+                regressions.append((k, 'vehicle_steps_per_sec', ratio))
+
+    old_cont = {r['size']: r for r in old['container']}
+    for r in new['container']:
+        if r['size'] in old_cont:
+            for op in r:
+                if op in ('size', 'nb_lanes'):
+                    continue
+                ratio = r[op] / old_cont[r['size']][op]
+                if ratio < 1 - tolerance:
+                    regressions.append(('container size={}'.format(r['size']), op, ratio))
+
+    return regressions
+
+def _key(r):
+    return 'n{}_lanes{}_len{}_{}'.format(r['vehicles'], r['nb_lanes'], r['road_len'], r['handlers'])
+
+def _meta():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'revision': revision,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the simulation throughput.')
+    parser.add_argument('--quick', action='store_true', help='run a small matrix')
+    parser.add_argument('--steps', type=int, default=200, help='time steps per configuration')
+    parser.add_argument('--out', default='bench_output.json', help='where to store the results')
+    parser.add_argument('--compare', metavar='OLD_JSON', help='compare against earlier results')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    results = run(QUICK_MATRIX if args.quick else MATRIX, args.steps)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(old, results, args.tolerance)
+        for k, metric, ratio in regressions:
+            print('REGRESSION: {} {} {:.2f}x'.format(k, metric, ratio))
+        if regressions:
+            sys.exit(1)
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_populate(self):
+        params = {'vehicles': 50, 'nb_lanes': 2, 'road_len': 600, 'handlers': 'none'}
+        sim, nb_placed = _make_sim(params, seed=0)
+        ids = [v.id for v in sim]
+        self.assertEqual(len(ids), nb_placed)
+        self.assertEqual(len(set(ids)), nb_placed)
+
+    def test_handlers(self):
+        for handlers in ('stats', 'slow_zone'):
+            params = {'vehicles': 50, 'nb_lanes': 2, 'road_len': 600, 'handlers': handlers}
+            r = bench_simulation(params, steps=20)
+            self.assertEqual(r['steps'], 20)
+            self.assertGreater(r['vehicle_steps'], 0)
+
+if __name__ == "__main__":
+    main()
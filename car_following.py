@@ -0,0 +1,179 @@
+import math
+
+import numpy as np
+
+# Car-following models that replace calc_acceleration for the vehicle
+# classes of Config.car_following. A model gives the acceleration from the
+# velocity of the vehicle, the velocity vf of the vehicle in front, its
+# distance df (the difference of the positions, as in calc_acceleration)
+# and its length lf (all NaN without a vehicle in front), plus the driver
+# parameters taken from the vehicle. Positions are vehicle centers, as drawn
+# by the renderers, so the models use the bumper-to-bumper gap
+# df - (lf + length)/2 with the length of the vehicle itself. Each model has
+# a scalar reference on floats and an array version, vectorized with numpy,
+# for whole lanes. Decelerations are limited to HV_BRAKING.
+
+IDM_DELTA = 4           # acceleration exponent
+IDM_B = 2.0             # m/s², comfortable deceleration
+IDM_S0 = 2.0            # meter, jam distance on top of the extremely safe distance
+
+PIPES_SPEED = 4.4704    # m/s (10 mph): Pipes' rule asks one vehicle length per 10 mph
+
+def gap(df, lf, length):
+    """ Bumper-to-bumper gap of a vehicle of length to the one in front (floats or arrays). """
+    return df - (lf + length)/2
+
+def idm(velocity, vf, df, lf, v0, T, a, b, s0, bmax, length):
+    """
+    Intelligent Driver Model (Treiber, Hennecke, Helbing 2000): desired
+    velocity v0, time gap T, maximum acceleration a, comfortable
+    deceleration b, jam distance s0.
+    """
+    free = 1 - (velocity/v0)**IDM_DELTA
+    if df != df:
+        return max(-bmax, a*free)
+    s_star = s0 + max(0.0, velocity*T + velocity*(velocity - vf)/(2*math.sqrt(a*b)))
+    return max(-bmax, a*(free - (s_star/max(gap(df, lf, length), 0.01))**2))
+
+def idms(velocity, vf, df, lf, v0, T, a, b, s0, bmax, length):
+    free = 1 - (velocity/v0)**IDM_DELTA
+    with np.errstate(invalid='ignore'):
+        s_star = s0 + np.maximum(0.0, velocity*T + velocity*(velocity - vf)/(2*np.sqrt(a*b)))
+        interaction = np.where(np.isnan(df), 0.0, (s_star/np.maximum(gap(df, lf, length), 0.01))**2)
+    return np.maximum(-bmax, a*(free - interaction))
+
+def _idm_params(vehicle):
+    return (vehicle.desired_velocity, vehicle.safe_time, vehicle.HV_AMAX, IDM_B,
+            vehicle.extremely_safe_distance + IDM_S0, vehicle.HV_BRAKING, vehicle.length)
+
+def pipes(velocity, vf, df, lf, v0, T, a, bmax, d0, length):
+    """
+    Pipes (1953): the gap to the vehicle in front should be d0 plus one
+    vehicle length per 10 mph. Followers respond linearly to the
+    relative velocity and to the deviation from that distance (sensitivity
+    1/T), free vehicles relax to v0 in T; the smaller of the two applies.
+    """
+    acc = (v0 - velocity)/T
+    if df == df:
+        acc = min(acc, (vf - velocity)/T + (gap(df, lf, length) - d0 - length*velocity/PIPES_SPEED)/(T*T))
+    return min(a, max(-bmax, acc))
+
+def pipess(velocity, vf, df, lf, v0, T, a, bmax, d0, length):
+    acc = (v0 - velocity)/T
+    follow = (vf - velocity)/T + (gap(df, lf, length) - d0 - length*velocity/PIPES_SPEED)/(T*T)
+    acc = np.where(np.isnan(df), acc, np.minimum(acc, follow))
+    return np.minimum(a, np.maximum(-bmax, acc))
+
+def _pipes_params(vehicle):
+    return (vehicle.desired_velocity, vehicle.safe_time, vehicle.HV_AMAX, vehicle.HV_BRAKING,
+            vehicle.extremely_safe_distance, vehicle.length)
+
+class Model:
+    """ A registered car-following model. """
+
+    def __init__(self, name, params, acceleration, accelerations):
+        self.name = name
+        self.params = params                # vehicle -> tuple of its parameters
+        self.acceleration = acceleration    # (velocity, vf, df, lf, *params) -> acceleration
+        self.accelerations = accelerations  # the same on arrays
+
+    def parameter_arrays(self, vehicles):
+        """ The parameters of vehicles as arrays, for accelerations. """
+        return tuple(np.array(p, dtype=float) for p in zip(*(self.params(v) for v in vehicles)))
+
+# Models that Config.car_following can select: name -> Model.
+MODELS = {}
+
+def register_model(name, params, acceleration, accelerations):
+    MODELS[name] = Model(name, params, acceleration, accelerations)
+
+register_model('idm', _idm_params, idm, idms)
+register_model('pipes', _pipes_params, pipes, pipess)
+
+def model(name):
+    if name not in MODELS:
+        raise ValueError('unknown car-following model {}, one of {}'.format(name, sorted(MODELS)))
+    return MODELS[name]
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+from config import HeadlessConfig
+from random_streams import RandomStreams
+from simulation import Simulation
+from vehicle import AutomaticCar, Car, Truck
+
+class CarFollowingTest(unittest.TestCase):
+
+    def test_arrays(self):
+        rng = RandomStreams(seed=1)
+        vehicles = [cls(0, rng=rng) for cls in (Car, AutomaticCar, Truck)*30]
+        n = len(vehicles)
+        r = np.random.RandomState(0)
+        velocity = r.uniform(0, 35, n)
+        df = np.where(r.rand(n) < 0.2, np.nan, r.uniform(1, 80, n))
+        vf = np.where(np.isnan(df), np.nan, r.uniform(0, 35, n))
+        lf = np.where(np.isnan(df), np.nan, r.choice([4.0, 18.0], n))
+
+        for m in MODELS.values():
+            a = m.accelerations(velocity, vf, df, lf, *m.parameter_arrays(vehicles))
+            for i, v in enumerate(vehicles):
+                self.assertAlmostEqual(a[i], m.acceleration(velocity[i], vf[i], df[i], lf[i], *m.params(v)),
+                                       places=12, msg=m.name)
+
+    def test_equilibrium(self):
+        car = Car(0, rng=RandomStreams(seed=2))
+        p = _idm_params(car)
+        v0, T, a, b, s0, bmax, length = p
+        self.assertEqual(idm(v0, np.nan, np.nan, np.nan, *p), 0.0)
+        # Steady following at the IDM equilibrium gap, behind a truck.
+        v, lf = 20.0, 18.0
+        centers = (lf + length)/2
+        s = (s0 + v*T) / math.sqrt(1 - (v/v0)**IDM_DELTA)
+        self.assertAlmostEqual(idm(v, v, s + centers, lf, *p), 0.0)
+        self.assertEqual(idm(v, 0.0, centers + 1.0, lf, *p), -bmax)
+
+        p = _pipes_params(car)
+        d = car.extremely_safe_distance + car.length*v/PIPES_SPEED
+        self.assertEqual(pipes(v, v, d + centers, lf, *p), 0.0)
+        self.assertLess(pipes(v, v, d, lf, *p), 0.0)
+        self.assertGreater(pipes(v, np.nan, np.nan, np.nan, *p), 0.0)
+
+    def test_simulation(self):
+        class Conf(HeadlessConfig):
+            seed = 4
+            car_following = {'Car': 'idm', 'Truck': 'pipes'}
+
+        sim = Simulation(Conf())
+        for i in range(1500):
+            sim.time_step(0.1)
+        cars = [v for v in sim if isinstance(v, Car)]
+        self.assertGreater(len(cars), 5)
+        self.assertGreater(np.mean([v.velocity for v in cars]), 10)
+
+        Conf.car_following = {'Car': 'gipps'}
+        with self.assertRaises(ValueError):
+            sim = Simulation(Conf())
+            for i in range(100):
+                sim.time_step(0.1)
+
+    def test_gaps(self):
+        # Followers keep their front bumper behind the rear bumper of the vehicle in front.
+        for name in MODELS:
+            class Conf(HeadlessConfig):
+                seed = 3
+                spawn_rate = 6.0
+                car_following = {'Car': name, 'AutomaticCar': name, 'Truck': name}
+
+            sim = Simulation(Conf())
+            for i in range(1500):
+                sim.time_step(0.1)
+                for l in sim._container._lists:
+                    for back, front in zip(l, l[1:]):
+                        self.assertGreater(gap(front.position - back.position, front.length, back.length),
+                                           0, name)
+
+if __name__ == '__main__':
+    unittest.main()
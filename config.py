@@ -0,0 +1,45 @@
+class Config:
+    fps = 60
+    nb_lanes = 3
+    road_len = 600          # meter
+    spawn_rate = 3.0        # cars per second
+    speed_range = (25, 35)  # (min, max) speed in meter/sec
+    ring = False            # ring road of length road_len with a fixed number of vehicles, no spawning
+    ring_density = 20.0     # vehicles per km and lane on the ring road
+
+    speedup = 1             # int speed up factor: 1 sec in anim = speedup sec in sim
+
+    # Animation
+    window_height = 370
+    rows = 3                # number of wrapped roads vertically
+    window_width = 1800
+
+    sound = True
+    renderer = 'opengl'     # 'opengl': one draw call per vehicle, 'opengl_vbo': batched,
+                            # 'opengl_lod': zoomable window_width x window_height viewport for long roads
+    decoupled = False       # simulate in a separate process, the animation draws snapshots (not with 'opengl')
+
+    seed = None             # seed of the random streams, None: drawn from np.random
+    antithetic = False      # use antithetic random numbers (for paired replications)
+
+    kernels = False         # driver model: False: vehicle methods, True: flat scalar kernels (kernels.py)
+    car_following = None    # {vehicle class name: model of car_following.py ('idm', 'pipes')} replacing
+                            # calc_acceleration for those classes, None: calc_acceleration for all
+    lane_changes = 'sequential' # 'sequential': made during each vehicle update, 'synchronous': requested
+                            # during the updates, resolved together after them (order independent)
+
+    platoons = False        # chains of AutomaticCars locked in behind a leader follow its update without
+                            # neighbor lookups or lane changes while locked in (zone model only)
+
+    profile = None          # output prefix for profiler reports (.json and .folded), None to disable
+                            # (not in decoupled mode)
+
+    # Non-OpenGL animation specific configuration
+    dirty_rects = False     # only redraw and update the screen areas that changed (opt-in)
+    #window_height = 500
+    #scale = 10
+    #road_len = -1
+
+class HeadlessConfig(Config):
+    """ Configuration for runs without a display (batch runs, scenarios). """
+    sound = False
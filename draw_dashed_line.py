@@ -5,33 +5,87 @@ Created on Mon Jun 19 10:29:35 2017
 @author: Jake
 """
 import numpy as np
-import math
 import pygame
 
+def dash_segments(start_pos, end_pos, dash_length=10):
+    """
+    (n, 2, 2) array of the (start, end) points of the dashes of a line: dash
+    i runs from 2*i to 2*i+1 dash lengths along the line.
+    """
+    start = np.asarray(start_pos, dtype=float)
+    end = np.asarray(end_pos, dtype=float)
+    length = np.hypot(*(end - start))
+    if length == 0:
+        return np.empty((0, 2, 2))
+
+    direction = (end - start) / length
+    t0 = np.arange(0, length - dash_length, 2*dash_length)
+    starts = start + t0[:, None]*direction
+    ends = start + (t0 + dash_length)[:, None]*direction
+    return np.stack([starts, ends], 1)
+
 def draw_dashed_line(surf, color, start_pos, end_pos, width=1, dash_length=10):
+    segments = np.rint(dash_segments(start_pos, end_pos, dash_length)).astype(int)
+    if len(segments) == 0:
+        return
+
     x1, y1 = start_pos
     x2, y2 = end_pos
-    dl = dash_length
-
-    if (x1 == x2):
-        ycoords = [y for y in range(y1, y2, dl if y1 < y2 else -dl)]
-        xcoords = [x1] * len(ycoords)
-    elif (y1 == y2):
-        xcoords = [x for x in range(x1, x2, dl if x1 < x2 else -dl)]
-        ycoords = [y1] * len(xcoords)
+    if y1 == y2 or x1 == x2:
+        _fill_axis_aligned(surf, color, segments, width, horizontal=(y1 == y2))
+    else:
+        for (xa, ya), (xb, yb) in segments:
+            pygame.draw.line(surf, color, (xa, ya), (xb, yb), width)
+
+def _fill_axis_aligned(surf, color, segments, width, horizontal):
+    """ Draw all dashes of a horizontal or vertical line with one array assignment. """
+    axis = 0 if horizontal else 1
+    size = surf.get_size()
+    lo = np.minimum(segments[:, 0, axis], segments[:, 1, axis])
+    hi = np.maximum(segments[:, 0, axis], segments[:, 1, axis])
+
+    # Pixels along the line that are covered by a dash (end points included).
+    covered = np.zeros(size[axis] + 1, dtype=int)
+    np.add.at(covered, np.clip(lo, 0, size[axis]), 1)
+    np.add.at(covered, np.clip(hi + 1, 0, size[axis]), -1)
+    mask = np.cumsum(covered)[:size[axis]] > 0
+
+    # Same thickness as pygame.draw.line: width pixels centered on the line.
+    c = segments[0, 0, 1 - axis]
+    a = max(c - (width-1)//2, 0)
+    b = min(c + width//2 + 1, size[1 - axis])
+    if a >= b:
+        return
+
+    pixels = pygame.surfarray.pixels3d(surf)
+    if horizontal:
+        pixels[mask, a:b] = color[:3]
     else:
-        a = abs(x2 - x1)
-        b = abs(y2 - y1)
-        c = round(math.sqrt(a**2 + b**2))
-        dx = dl * a / c
-        dy = dl * b / c
-
-        xcoords = [x for x in np.arange(x1, x2, dx if x1 < x2 else -dx)]
-        ycoords = [y for y in np.arange(y1, y2, dy if y1 < y2 else -dy)]
-
-    next_coords = list(zip(xcoords[1::2], ycoords[1::2]))
-    last_coords = list(zip(xcoords[0::2], ycoords[0::2]))
-    for (x1, y1), (x2, y2) in zip(next_coords, last_coords):
-        start = (round(x1), round(y1))
-        end = (round(x2), round(y2))
-        pygame.draw.line(surf, color, start, end, width)
\ No newline at end of file
+        pixels[a:b, mask] = color[:3]
+    del pixels      # unlock the surface
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+
+class DashedLineTest(unittest.TestCase):
+
+    def test_dash_segments(self):
+        segments = dash_segments((0, 5), (50, 5), dash_length=10)
+        self.assertEqual(segments[:, :, 0].tolist(), [[0, 10], [20, 30]])
+        self.assertEqual(len(dash_segments((0, 0), (30, 40), dash_length=10)), 2)
+
+    def test_draw(self):
+        surf = pygame.Surface((60, 20))
+        draw_dashed_line(surf, (255, 255, 255), (0, 5), (60, 5), width=3, dash_length=10)
+
+        self.assertEqual(surf.get_at((5, 5))[:3], (255, 255, 255))
+        self.assertEqual(surf.get_at((5, 4))[:3], (255, 255, 255))
+        self.assertEqual(surf.get_at((5, 7))[:3], (0, 0, 0))
+        self.assertEqual(surf.get_at((15, 5))[:3], (0, 0, 0))
+        self.assertEqual(surf.get_at((45, 5))[:3], (255, 255, 255))
+
+if __name__ == '__main__':
+    unittest.main()
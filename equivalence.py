@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import sys
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+from scipy import stats
+
+from headless import run_spec
+from simulation import SimulationWithHandlers
+from sim_event_handler import AverageSpeedHandler, ThroughPutHandler, TravelTimeHandler
+
+def kernel_engine(conf, handlers=None):
+    """ The reference simulation driven by the flat kernels (Config.kernels). """
+    conf.kernels = True
+    return SimulationWithHandlers(conf, handlers)
+
+def synchronous_engine(conf, handlers=None):
+    """ The reference simulation with synchronous lane changes (Config.lane_changes). """
+    conf.lane_changes = 'synchronous'
+    return SimulationWithHandlers(conf, handlers)
+
+def platoon_engine(conf, handlers=None):
+    """ The reference simulation advancing lock-in chains as units (Config.platoons). """
+    conf.platoons = True
+    return SimulationWithHandlers(conf, handlers)
+
+# Simulation engines that can be compared: name -> class taking (conf, handlers).
+ENGINES = {
+    'reference': SimulationWithHandlers,
+    'kernels': kernel_engine,
+    'synchronous': synchronous_engine,
+    'platoons': platoon_engine,
+}
+
+# Scenarios: configuration overrides and an optional scenario timeline (see
+# headless.run_spec).
+SCENARIOS = {
+    'free_flow': {'conf': {'spawn_rate': 1.5}},
+    'dense':     {'conf': {'spawn_rate': 4.0}},
+    'slow_zone': {'conf': {'spawn_rate': 3.0},
+                  'events': [{'time': 60, 'action': 'speed_limit',
+                              'start': 300, 'stop': 450, 'max_velocity': 7}]},
+    'incident':  {'conf': {'spawn_rate': 3.0},
+                  'events': [{'time': 60, 'action': 'incident', 'start': 400,
+                              'stop': 410, 'lanes': [2], 'duration': 60}]},
+}
+
+METRICS = ['throughput', 'travel_time', 'speed']
+
+def register_engine(name, engine):
+    ENGINES[name] = engine
+
+def run_once(engine, scenario, seed, duration=300, warmup=60, dt=0.1):
+    """
+    Run one replication and return the samples of the compared metrics,
+    recorded after the warm-up period.
+    """
+    avgspeed = AverageSpeedHandler()
+    throughput = ThroughPutHandler()
+    traveltime = TravelTimeHandler()
+    run_spec(SCENARIOS[scenario], duration, [avgspeed, throughput, traveltime],
+             seed=seed, dt=dt, engine=ENGINES[engine])
+
+    t = np.array(avgspeed.simTimeList)
+    return {
+        'throughput': throughput.nb_vehicles_list[int(warmup // throughput.interval):],
+        'travel_time': [p[1] for p in traveltime.dict.values() if p[1] != 0 and p[0] >= warmup],
+        'speed': list(np.array(avgspeed.averageSpeedList)[t >= warmup]),
+    }
+
+def _run_once(args):
+    return run_once(*args)
+
+def confidence_interval(values, confidence=0.95):
+    """ (mean, half width) of the t confidence interval of the mean. """
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2:
+        return (values.mean() if len(values) else np.nan, np.inf)
+    half = stats.t.ppf((1+confidence)/2, len(values)-1) * values.std(ddof=1) / np.sqrt(len(values))
+    return (values.mean(), half)
+
+def thin(samples, n):
+    """ At most n evenly spaced samples of one replication. """
+    samples = np.asarray(samples, dtype=float)
+    if len(samples) <= n:
+        return samples
+    return samples[np.linspace(0, len(samples)-1, n).astype(int)]
+
+def compare_samples(ref_runs, alt_runs, alpha=0.01, samples_per_run=10):
+    """
+    Compare one metric of two engines. ref_runs/alt_runs hold the samples of
+    each replication. The pooled samples are compared with the KS and
+    Anderson-Darling tests, the per-replication means with their confidence
+    intervals. Diverged if any test rejects at level alpha or if the
+    intervals don't overlap.
+
+    Samples within a replication are strongly autocorrelated (speed series,
+    travel times of successive vehicles), which makes the tests reject far
+    too often. Each replication is therefore thinned to samples_per_run
+    samples before pooling.
+    """
+    ref = np.concatenate([thin(r, samples_per_run) for r in ref_runs])
+    alt = np.concatenate([thin(r, samples_per_run) for r in alt_runs])
+    if len(ref) < 2 or len(alt) < 2:
+        return {'diverged': None, 'reason': 'not enough samples'}
+
+    ks = stats.ks_2samp(ref, alt)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')     # p-value capped/floored warnings
+        ad = stats.anderson_ksamp([ref, alt])
+
+    ref_mean, ref_half = confidence_interval([np.mean(r) for r in ref_runs if len(r)])
+    alt_mean, alt_half = confidence_interval([np.mean(r) for r in alt_runs if len(r)])
+    overlap = abs(ref_mean - alt_mean) <= ref_half + alt_half
+
+    return {
+        'ks_statistic': float(ks.statistic),
+        'ks_pvalue': float(ks.pvalue),
+        'ad_statistic': float(ad.statistic),
+        'ad_pvalue': float(ad.significance_level),
+        'ref_mean': float(ref_mean), 'ref_ci': float(ref_half),
+        'alt_mean': float(alt_mean), 'alt_ci': float(alt_half),
+        'ci_overlap': bool(overlap),
+        'diverged': bool(ks.pvalue < alpha or ad.significance_level < alpha or not overlap),
+    }
+
+def compare_engines(alt, ref='reference', scenarios=None, seeds=range(20),
+                    duration=300, warmup=60, alpha=0.01, alt_seed_offset=None, processes=None):
+    """
+    Compare two engines on all scenarios, return the report per scenario.
+    The tests assume independent samples, so by default the alternative
+    engine gets the seeds following the reference ones (alt_seed_offset
+    len(seeds)); with alt_seed_offset=0 both share their random numbers and
+    the tests become too lenient.
+    """
+    if alt_seed_offset is None:
+        alt_seed_offset = len(seeds)
+    report = {}
+    with Pool(processes) as pool:
+        for scenario in scenarios or sorted(SCENARIOS):
+            jobs = [(ref, scenario, seed, duration, warmup) for seed in seeds]
+            jobs += [(alt, scenario, seed + alt_seed_offset, duration, warmup) for seed in seeds]
+            runs = pool.map(_run_once, jobs)
+            ref_runs, alt_runs = runs[:len(seeds)], runs[len(seeds):]
+
+            report[scenario] = {m: compare_samples([r[m] for r in ref_runs],
+                                                   [r[m] for r in alt_runs], alpha)
+                                for m in METRICS}
+    return report
+
+def print_report(report):
+    for scenario in sorted(report):
+        for m in METRICS:
+            r = report[scenario][m]
+            if r['diverged'] is None:
+                print('{:10s} {:12s} {}'.format(scenario, m, r['reason']))
+                continue
+            print('{:10s} {:12s} ref {:8.2f} ± {:6.2f}  alt {:8.2f} ± {:6.2f}  KS p={:.3f}  AD p={:.3f}  {}'.format(
+                scenario, m, r['ref_mean'], r['ref_ci'], r['alt_mean'], r['alt_ci'],
+                r['ks_pvalue'], r['ad_pvalue'], 'DIVERGED' if r['diverged'] else 'ok'))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that an engine reproduces the traffic statistics of the reference engine.')
+    parser.add_argument('engine', choices=sorted(ENGINES))
+    parser.add_argument('--reference', default='reference', choices=sorted(ENGINES))
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS))
+    parser.add_argument('--seeds', type=int, default=20, help='number of replications')
+    parser.add_argument('--duration', type=float, default=300, help='simulated seconds per replication')
+    parser.add_argument('--warmup', type=float, default=60, help='simulated seconds to discard')
+    parser.add_argument('--alpha', type=float, default=0.01)
+    parser.add_argument('--seed-offset', type=int, help='offset of the seeds of the compared engine (default: --seeds, disjoint seeds)')
+    parser.add_argument('--out', help='write the report as JSON')
+    args = parser.parse_args()
+
+    report = compare_engines(args.engine, args.reference, args.scenarios, range(args.seeds),
+                             args.duration, args.warmup, args.alpha, args.seed_offset)
+    print_report(report)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if any(s[m]['diverged'] for s in report.values() for m in METRICS):
+        sys.exit(1)
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+
+class CompareSamplesTest(unittest.TestCase):
+
+    def test_same_distribution(self):
+        rs = np.random.RandomState(1)
+        ref = [rs.normal(30, 2, 100) for i in range(10)]
+        alt = [rs.normal(30, 2, 100) for i in range(10)]
+        self.assertFalse(compare_samples(ref, alt)['diverged'])
+
+    def test_shifted_distribution(self):
+        rs = np.random.RandomState(1)
+        ref = [rs.normal(30, 2, 100) for i in range(10)]
+        alt = [rs.normal(32, 2, 100) for i in range(10)]
+        r = compare_samples(ref, alt)
+        self.assertTrue(r['diverged'])
+        self.assertFalse(r['ci_overlap'])
+
+    def test_not_enough_samples(self):
+        self.assertIsNone(compare_samples([[1.0]], [[]])['diverged'])
+
+if __name__ == "__main__":
+    main()
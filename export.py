@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+import argparse
+import os
+import shutil
+import subprocess
+from multiprocessing import Pool
+
+import numpy as np
+import pygame
+
+from assets import load_atlas
+from render_geometry import (CLASS_CAR, CLASS_OTHER, INDICATOR_SIZE, LANE_WIDTH,
+                             VEHICLE_HEIGHT, RoadGeometry, vehicle_colors)
+from trajectory import Trajectory
+
+ASPHALT_RGB = (77, 77, 77)
+LINE_RGB = (255, 255, 255)
+
+class Rasterizer:
+    """
+    Software renderer of trajectory frames to (height, width, 3) RGB arrays,
+    with the road layout and sprites of the OpenGL animation. No display is
+    needed.
+    """
+
+    def __init__(self, conf, width=1800):
+        g = self.geometry = RoadGeometry(conf)
+        self.ppm = width / g.row_length                       # px/meter
+        # Video encoders want even sizes.
+        self.width = width + width % 2
+        self.height = int(round(g.world_height*self.ppm))
+        self.height += self.height % 2
+
+        self._atlas = load_atlas()
+        self._atlas_rgba = self._atlas.rgba[::-1]               # top row first
+        self._sprites = {}
+        self._background = self._draw_background()
+
+    def _draw_background(self):
+        g = self.geometry
+        img = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        img[:] = ASPHALT_RGB
+
+        x = np.arange(self.width)
+        dashes = (x % 16 < 4) | (x % 16 >= 12)                 # glLineStipple(1, 0xF00F)
+        for row in range(g.rows):
+            for lane in range(g.nb_lanes + 1):
+                y = int(g.y_offset(row, lane)*self.ppm)
+                if lane in (0, g.nb_lanes):
+                    img[max(0, y-1):y+1] = LINE_RGB
+                elif 0 <= y < self.height:
+                    img[y, dashes] = LINE_RGB
+        return img
+
+    def _sprite(self, type_id, w, h):
+        """ Sprite scaled (nearest neighbor) to w x h px, as float RGB and alpha. """
+        key = (type_id, w, h)
+        if key not in self._sprites:
+            x, y, sw, sh = (int(c) for c in self._atlas.rects[type_id])
+            rows = y + ((np.arange(h) + 0.5)*sh/h).astype(int)
+            cols = x + ((np.arange(w) + 0.5)*sw/w).astype(int)
+            src = self._atlas_rgba[rows[:, None], cols[None, :]].astype(np.float32)
+            self._sprites[key] = (src[:, :, :3], src[:, :, 3:]/255)
+        return self._sprites[key]
+
+    def _blit(self, img, rgb, alpha, x0, y0):
+        h, w = alpha.shape[:2]
+        xa, ya = max(x0, 0), max(y0, 0)
+        xb, yb = min(x0 + w, self.width), min(y0 + h, self.height)
+        if xa >= xb or ya >= yb:
+            return
+        src = (slice(ya-y0, yb-y0), slice(xa-x0, xb-x0))
+        dst = img[ya:yb, xa:xb]
+        a = alpha[src]
+        dst[:] = dst*(1 - a) + rgb[src]*a
+
+    def render(self, arr):
+        img = self._background.copy()
+        if len(arr) == 0:
+            return img
+
+        g = self.geometry
+        xc, yc = g.vehicle_centers(arr['position'].astype(float), arr['animlane'].astype(float))
+        xc *= self.ppm
+        yc *= self.ppm
+        h = max(1, int(round(VEHICLE_HEIGHT*self.ppm)))
+
+        for i in range(len(arr)):
+            w = max(1, int(round(arr['length'][i]*self.ppm)))
+            rgb, alpha = self._sprite(arr['type'][i], w, h)
+            self._blit(img, rgb, alpha, int(round(xc[i] - w/2)), int(round(yc[i] - h/2)))
+
+        # Status indicators
+        colors = (vehicle_colors(arr)*255).astype(np.uint8)
+        s = max(1, int(round(INDICATOR_SIZE*self.ppm)))
+        xi = np.where(arr['cls'] == CLASS_CAR, xc - 0.5*self.ppm, xc)
+        for i in np.nonzero(arr['cls'] != CLASS_OTHER)[0]:
+            x0, y0 = int(round(xi[i] - s/2)), int(round(yc[i] - s/2))
+            img[max(y0, 0):max(y0+s, 0), max(x0, 0):max(x0+s, 0)] = colors[i]
+        return img
+
+# Each worker process opens the trajectory and builds its rasterizer once.
+_worker = {}
+
+def _init_worker(filename, width):
+    _worker['trajectory'] = Trajectory(filename)
+    _worker['rasterizer'] = Rasterizer(_worker['trajectory'].conf, width)
+
+def _render_frame(i):
+    return _worker['rasterizer'].render(_worker['trajectory'].frame(i))
+
+def _save_png(job):
+    i, filename = job
+    img = _render_frame(i)
+    pygame.image.save(pygame.surfarray.make_surface(img.swapaxes(0, 1)), filename)
+    return filename
+
+def frame_indices(trajectory, fps=30, speedup=1.0, start=0.0, stop=None):
+    """ Recorded frames to show for a video at fps playing speedup x real time. """
+    step = max(1, int(round(speedup/(fps*trajectory.interval))))
+    t = trajectory.times
+    selected = (t >= start) & (t <= (stop if stop is not None else np.inf))
+    return np.nonzero(selected)[0][::step]
+
+def export(filename, out, width=1800, fps=30, speedup=1.0, start=0.0, stop=None, processes=None):
+    """
+    Render a trajectory file in parallel worker processes. out is either a
+    PNG file name pattern with a frame number field ('frames/{:06d}.png') or
+    a video file (.mp4, .gif, ...) encoded by piping raw frames to ffmpeg.
+    Returns the number of frames.
+    """
+    trajectory = Trajectory(filename)
+    indices = frame_indices(trajectory, fps, speedup, start, stop)
+    initargs = (filename, width)
+
+    if out.endswith('.png'):
+        if os.path.dirname(out):
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+        jobs = [(i, out.format(n)) for n, i in enumerate(indices)]
+        with Pool(processes, _init_worker, initargs) as pool:
+            for _ in pool.imap_unordered(_save_png, jobs, chunksize=4):
+                pass
+        return len(jobs)
+
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        raise RuntimeError('ffmpeg not found, export PNG frames instead')
+
+    raster = Rasterizer(trajectory.conf, width)
+    cmd = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+           '-s', '{}x{}'.format(raster.width, raster.height), '-r', str(fps), '-i', '-']
+    if not out.endswith('.gif'):
+        cmd += ['-pix_fmt', 'yuv420p']
+    encoder = subprocess.Popen(cmd + [out], stdin=subprocess.PIPE)
+    try:
+        with Pool(processes, _init_worker, initargs) as pool:
+            # imap keeps the frames in order
+            for img in pool.imap(_render_frame, indices, chunksize=4):
+                encoder.stdin.write(img.tobytes())
+    finally:
+        encoder.stdin.close()
+        encoder.wait()
+    if encoder.returncode:
+        raise RuntimeError('ffmpeg failed with exit code {}'.format(encoder.returncode))
+    return len(indices)
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a recorded trajectory (headless.py --record) offline.')
+    parser.add_argument('trajectory')
+    parser.add_argument('out', help="video file (.mp4, .gif, needs ffmpeg) or PNG pattern like 'frames/{:06d}.png'")
+    parser.add_argument('--width', type=int, default=1800, help='px')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--speedup', type=float, default=1.0, help='simulated seconds per video second')
+    parser.add_argument('--start', type=float, default=0.0, help='simulated time of the first frame')
+    parser.add_argument('--stop', type=float, help='simulated time of the last frame')
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+
+    n = export(args.trajectory, args.out, args.width, args.fps, args.speedup,
+               args.start, args.stop, args.processes)
+    print('{} frames written to {}'.format(n, args.out))
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import tempfile
+import unittest
+from config import HeadlessConfig
+from simulation import SimulationWithHandlers
+from trajectory import TrajectoryRecorder
+
+class ExportTest(unittest.TestCase):
+
+    class Conf(HeadlessConfig):
+        seed = 3
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'run.traj')
+        recorder = TrajectoryRecorder(self.filename, interval=0.5)
+        sim = SimulationWithHandlers(self.Conf(), [recorder])
+        for i in range(50):
+            sim.time_step(0.1)
+        recorder.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_render(self):
+        traj = Trajectory(self.filename)
+        raster = Rasterizer(traj.conf, width=400)
+        arr = traj.frame(len(traj) - 1)
+        img = raster.render(arr)
+
+        self.assertEqual(img.shape, (raster.height, raster.width, 3))
+        x, y = raster.geometry.vehicle_centers(float(arr['position'][0]), float(arr['animlane'][0]))
+        self.assertNotEqual(tuple(img[int(y*raster.ppm), int(x*raster.ppm)]), ASPHALT_RGB)
+
+    def test_export_png(self):
+        out = os.path.join(self.tmp, 'frames', '{:04d}.png')
+        n = export(self.filename, out, width=400, fps=2, speedup=2.0, processes=2)
+        self.assertEqual(n, 5)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(out)))[-1], '0004.png')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+import argparse
+import json
+from multiprocessing import Pool
+
+import numpy as np
+
+from equivalence import confidence_interval
+from headless import make_conf
+from simulation import Simulation
+
+# Density sweep on the ring road (Config.ring): each run keeps a fixed
+# number of vehicles, the space-mean speed is sampled every time step after
+# the warm-up and the flow follows from q = k*v (Edie's definitions on the
+# whole ring).
+
+def run_ring(density, seed, duration=300, warmup=60, dt=0.1, overrides=None):
+    """
+    One run of the ring road at density (vehicles per km and lane), returns
+    the space-mean speed (m/s) and the flow (vehicles per hour and lane).
+    """
+    conf = make_conf(overrides, ring=True, ring_density=density, seed=seed)
+    sim = Simulation(conf)
+    nb_lanes = conf.nb_lanes
+    # The density actually placed, the number of vehicles is rounded.
+    density = len(list(sim)) / (conf.road_len/1000) / nb_lanes
+
+    speeds = []
+    for i in range(int(round(duration/dt))):
+        sim.time_step(dt)
+        if (i+1)*dt > warmup:
+            velocities = [v.velocity for v in sim]
+            speeds.append(np.mean(velocities) if velocities else np.nan)
+
+    speed = float(np.mean(speeds))
+    return {'density': density, 'speed': speed, 'flow': density * speed * 3.6}
+
+def _run_ring(args):
+    return run_ring(*args)
+
+def sweep(densities, seeds, duration=300, warmup=60, dt=0.1, overrides=None, processes=None):
+    """
+    The fundamental diagram: for each density, the mean and confidence
+    interval half width of the speed and flow over the seeds.
+    """
+    jobs = [(k, s, duration, warmup, dt, overrides) for k in densities for s in seeds]
+    with Pool(processes) as pool:
+        runs = pool.map(_run_ring, jobs)
+
+    points = []
+    for i, k in enumerate(densities):
+        r = runs[i*len(seeds):(i+1)*len(seeds)]
+        point = {'density': float(np.mean([x['density'] for x in r]))}
+        for metric in ('speed', 'flow'):
+            point[metric], point[metric + '_half_width'] = confidence_interval([x[metric] for x in r])
+        points.append(point)
+    return points
+
+def parse_range(text):
+    """ 'start:stop:step' (stop included) or a comma separated list. """
+    if ':' in text:
+        start, stop, step = (float(x) for x in text.split(':'))
+        return list(np.arange(start, stop + step/2, step))
+    return [float(x) for x in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Flow-density curve of the ring road.')
+    parser.add_argument('--densities', default='5:80:5', help='vehicles per km and lane, START:STOP:STEP or a list')
+    parser.add_argument('-n', type=int, default=3, help='runs (seeds) per density')
+    parser.add_argument('--duration', type=float, default=300)
+    parser.add_argument('--warmup', type=float, default=60)
+    parser.add_argument('--road-len', type=float, default=1000, help='ring length in meter')
+    parser.add_argument('--lanes', type=int, help='number of lanes (default: Config.nb_lanes)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='FILE', help='write the points to FILE')
+    args = parser.parse_args()
+
+    overrides = {'road_len': args.road_len}
+    if args.lanes:
+        overrides['nb_lanes'] = args.lanes
+    points = sweep(parse_range(args.densities), range(args.seed, args.seed + args.n),
+                   args.duration, args.warmup, overrides=overrides)
+
+    print('density [veh/km/lane]   speed [m/s]        flow [veh/h/lane]')
+    for p in points:
+        print('{:10.1f}          {:6.2f} ± {:5.2f}    {:7.0f} ± {:4.0f}'.format(
+            p['density'], p['speed'], p['speed_half_width'], p['flow'], p['flow_half_width']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(points, f, indent=1)
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+
+class RingRoadTest(unittest.TestCase):
+
+    def test_fixed_vehicles(self):
+        conf = make_conf(ring=True, ring_density=30, road_len=500, seed=2)
+        sim = Simulation(conf)
+        vehicles = set(sim)
+        self.assertEqual(len(vehicles), 15*conf.nb_lanes)
+        # They start at their safe distance from the bumper in front.
+        for v in vehicles:
+            front = sim._container.front(v)
+            gap = front.position - v.position - (front.length + v.length)/2
+            self.assertLessEqual(v.velocity * v.safe_time, gap + 1e-9)
+        nb_allocated = sim._pool.nb_allocated
+
+        for i in range(1200):
+            sim.time_step(0.1)
+        # The same vehicles, no allocation after setup, all on the ring.
+        self.assertEqual(set(sim), vehicles)
+        self.assertEqual(sim._pool.nb_allocated, nb_allocated)
+        self.assertEqual(sim._pool.ids.next, len(vehicles))
+        self.assertTrue(all(0 <= v.position < conf.road_len for v in vehicles))
+        # They went around.
+        self.assertGreater(np.mean([v.velocity for v in vehicles]), 5)
+
+    def test_run_ring(self):
+        free = run_ring(5, seed=1, duration=60, warmup=20, overrides={'road_len': 1000})
+        dense = run_ring(60, seed=1, duration=60, warmup=20, overrides={'road_len': 1000})
+        self.assertEqual(free['density'], 5)
+        self.assertAlmostEqual(free['flow'], 5 * free['speed'] * 3.6)
+        # Congested: slower, but more flow than the nearly empty ring.
+        self.assertLess(dense['speed'], free['speed'] / 2)
+        self.assertGreater(dense['flow'], free['flow'])
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('10:30:10'), [10, 20, 30])
+        self.assertEqual(parse_range('5,7.5'), [5, 7.5])
+
+if __name__ == '__main__':
+    main()
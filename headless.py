@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+import argparse
+
+from config import HeadlessConfig
+from profiler import Profiler
+from simulation import SimulationWithHandlers
+from scenario import load_scenario, scenario_from_dict
+from sim_event_handler import *
+from liveview import LiveViewServer
+from trajectory import TrajectoryRecorder
+
+def run_headless(conf, duration, handlers=(), dt=None, profiler=None, engine=SimulationWithHandlers):
+    """
+    Run the simulation without animation for `duration` seconds of simulated
+    time and return it.
+    """
+    sim = engine(conf, handlers)
+    dt = dt if dt else 1./conf.fps
+
+    if profiler:
+        profiler.attach(sim)
+    try:
+        for i in range(int(round(duration/dt))):
+            sim.time_step(dt)
+    finally:
+        if profiler:
+            profiler.detach()
+    return sim
+
+def make_conf(overrides=None, **kwargs):
+    """ A HeadlessConfig with some attributes overridden. """
+    conf = HeadlessConfig()
+    for k, v in dict(overrides or {}, **kwargs).items():
+        setattr(conf, k, v)
+    return conf
+
+def make_sim(spec, handlers=(), seed=None, antithetic=False, engine=SimulationWithHandlers):
+    """
+    Simulation of an experiment spec: a scenario dict (see scenario_from_dict)
+    with an optional "conf" section of configuration overrides, e.g.
+    {"conf": {"spawn_rate": 4.0}, "events": [..]}.
+    """
+    conf = make_conf(spec.get('conf'), seed=seed, antithetic=antithetic)
+    handlers = list(handlers)
+    if 'events' in spec or 'handlers' in spec:
+        handlers.append(scenario_from_dict(spec))
+    return engine(conf, handlers)
+
+def run_spec(spec, duration, handlers=(), seed=None, antithetic=False, dt=0.1,
+             engine=SimulationWithHandlers):
+    """ Run one replication of an experiment spec (see make_sim) and return it. """
+    sim = make_sim(spec, handlers, seed, antithetic, engine)
+    for i in range(int(round(duration/dt))):
+        sim.time_step(dt)
+    return sim
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the highway simulation without animation.')
+    parser.add_argument('scenario', nargs='?', help='scenario file (.json or .yaml)')
+    parser.add_argument('--duration', type=float, help='simulated seconds (default: from scenario)')
+    parser.add_argument('--profile', metavar='PREFIX', help='write profiler reports to PREFIX.json and PREFIX.folded')
+    parser.add_argument('--record', metavar='FILE', help='record a trajectory file for export.py')
+    parser.add_argument('--record-interval', type=float, default=1/30, help='simulated seconds between recorded frames')
+    parser.add_argument('--liveview', metavar='[HOST:]PORT', help='stream the run to live-view clients (liveview.py HOST:PORT)')
+    args = parser.parse_args()
+
+    stats = StatsEvHandler()
+    throughput = ThroughPutHandler()
+    traveltime = TravelTimeHandler()
+    handlers = [stats, throughput, traveltime]
+    duration = args.duration
+    if args.scenario:
+        scenario = load_scenario(args.scenario)
+        handlers.append(scenario)
+        duration = duration or scenario.duration
+    if not duration:
+        parser.error('no --duration given and none set in the scenario')
+
+    recorder = TrajectoryRecorder(args.record, args.record_interval) if args.record else None
+    if recorder:
+        handlers.append(recorder)
+
+    liveview = None
+    if args.liveview:
+        host, _, port = args.liveview.rpartition(':')
+        liveview = LiveViewServer(host or '127.0.0.1', int(port))
+        handlers.append(liveview)
+        print('Live view on {}:{}'.format(*liveview.address))
+
+    profiler = Profiler() if args.profile else None
+    run_headless(HeadlessConfig(), duration, handlers, profiler=profiler)
+
+    if recorder:
+        recorder.close()
+        print(recorder)
+    if liveview:
+        liveview.close()
+
+    if profiler:
+        print(profiler)
+        profiler.to_json(args.profile + '.json')
+        profiler.to_folded(args.profile + '.folded')
+
+    print(stats)
+    if throughput.nb_vehicles_list:
+        print("Average throughput [vehicles/{}s]".format(throughput.interval),
+                np.mean(throughput.nb_vehicles_list))
+    travel_times = [p[1] for p in traveltime.dict.values() if p[1] != 0]
+    if travel_times:
+        print("Average travel time [s]", np.mean(travel_times))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import numpy as np
+
+# Scalar kernels of the driver model of HumanVehicle/AutomaticCar
+# (calc_acceleration, prob_left, prob_right, _enough_room) on plain floats,
+# a missing neighbor is NaN. Same results as the vehicle methods
+# (Config.kernels).
+
+def enough_room(d, length, safe_distance, hv_k):
+    """ Gap d to a neighbor of length and safe_distance is large enough. """
+    return d != d or d > max(length, hv_k*safe_distance)
+
+def prob_left(velocity, safe_distance, desired_velocity, epsilon, hv_k, hv_k1, vf, df,
+              vlf, dlf, lf_length, lf_safe_distance, vlb, dlb, lb_length, lb_safe_distance):
+    if df != df or df == 0 or not df < hv_k1*safe_distance:
+        return 0.0
+    if not (desired_velocity - velocity > epsilon or desired_velocity - vf > epsilon):
+        return 0.0
+    if not (enough_room(dlf, lf_length, lf_safe_distance, hv_k)
+            and enough_room(dlb, lb_length, lb_safe_distance, hv_k)):
+        return 0.0
+    if not (vlf != vlf or velocity <= vlf or dlf >= hv_k1*safe_distance):
+        return 0.0
+    if not (vlb != vlb or velocity >= vlb or dlb >= hv_k1*safe_distance):
+        return 0.0
+    return (safe_distance/df)**(3/4)
+
+def prob_right(velocity, safe_distance, epsilon, hv_k,
+               vrf, drf, rf_length, rf_safe_distance, drb, rb_length, rb_safe_distance):
+    if (vrf != vrf or velocity - vrf < epsilon or drf > hv_k*safe_distance) \
+            and enough_room(drf, rf_length, rf_safe_distance, hv_k) \
+            and enough_room(drb, rb_length, rb_safe_distance, hv_k):
+        return 0.9
+    return 0.0
+
+def acceleration(velocity, acc, safe_distance, desired_velocity, epsilon,
+                 hv_k, hv_k1, hv_k2, hv_k3, hv_l, hv_l2, hv_a0, hv_amax, hv_braking,
+                 lock_in, af, vf, df):
+    """
+    Zone logic of calc_acceleration, with the lock-in zone of
+    AutomaticCar if lock_in. Returns (acceleration, velocity,
+    safe_distance), the lock-in zone adjusts the latter two.
+    """
+    # acceleration zone
+    if df != df or df >= hv_k1*safe_distance:
+        if desired_velocity - velocity == 0:
+            a = 0.0
+        elif desired_velocity - velocity < epsilon:
+            a = hv_a0
+        else:
+            a = min(hv_amax, (desired_velocity - velocity) / (velocity+0.01) * hv_l * hv_amax)
+    # adaptive zone
+    elif df < hv_k1*safe_distance and df > hv_k2*safe_distance:
+        if velocity > vf:
+            a = max(-hv_braking, (vf - velocity) / (vf+0.01) * hv_l * hv_braking)
+        elif desired_velocity - velocity == 0:
+            a = 0.0
+        elif desired_velocity - velocity < epsilon:
+            a = hv_a0
+        else:
+            a = min(hv_amax, (vf - velocity) / (vf+0.01) * hv_l * hv_amax)
+    # lock-in zone
+    elif lock_in and df < hv_k2*safe_distance and df > hv_k3*safe_distance \
+            and abs(vf - desired_velocity) < 2:
+        if velocity - vf < 1:
+            velocity = vf
+            a = 0.0
+            if safe_distance > 2:
+                safe_distance -= 1
+        else:
+            a = min(hv_amax, (vf - velocity) / (velocity+0.001) * hv_l2 * hv_amax)
+    # braking zone
+    else:
+        if df < hv_k*safe_distance and (af != 0 and af < acc):
+            a = -hv_braking
+        elif velocity > vf:
+            a = max(-hv_braking, -(hv_braking / safe_distance * df - hv_braking))
+        else:
+            a = -0.1
+    return a, velocity, safe_distance
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+from config import HeadlessConfig
+from random_streams import RandomStreams
+from simulation import Simulation
+from vehicle import AutomaticCar, Car, Truck
+
+class KernelsTest(unittest.TestCase):
+
+    class Conf(HeadlessConfig):
+        seed = 5
+        spawn_rate = 4.0
+
+    def _run(self, kernels):
+        conf = self.Conf()
+        conf.kernels = kernels
+        sim = Simulation(conf)
+        for i in range(1500):
+            sim.time_step(0.1)
+        return [(v.lane, v.position, v.velocity, v.acceleration) for v in sim]
+
+    def test_same_as_methods(self):
+        self.assertEqual(self._run(False), self._run(True))
+
+    def test_acceleration(self):
+        rng = RandomStreams(seed=1)
+        r = np.random.RandomState(0)
+        for cls in (Car, AutomaticCar, Truck)*30:
+            v = cls(0, rng=rng)
+            velocity = r.uniform(0, 35)
+            df = np.nan if r.rand() < 0.2 else r.uniform(1, 80)
+            vf = np.nan if np.isnan(df) else r.uniform(0, 35)
+            af = np.nan if np.isnan(df) else r.choice([0.0, -1.0, 1.0])
+            acc = r.uniform(-2, 2)
+            safe_distance = max(v.extremely_safe_distance, velocity*v.safe_time)
+
+            a = acceleration(velocity, acc, safe_distance, v.desired_velocity, v.epsilon,
+                             *v.kernel_params(), af, vf, df)
+            v.velocity, v.acceleration, v.safe_distance = velocity, acc, safe_distance
+            none = lambda x: None if np.isnan(x) else x
+            self.assertEqual(a, (v.calc_acceleration(self.Conf, none(af), none(vf), none(df)),
+                                 v.velocity, v.safe_distance))
+
+            d = np.nan if r.rand() < 0.25 else r.uniform(0, 30)
+            self.assertEqual(enough_room(d, v.length, safe_distance, v.HV_K),
+                             np.isnan(d) or d > max(v.length, v.HV_K*safe_distance))
+
+if __name__ == '__main__':
+    unittest.main()
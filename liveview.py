@@ -0,0 +1,335 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import select
+import socket
+import struct
+
+import numpy as np
+
+from render_geometry import VEHICLE_DTYPE, _class_code
+from sim_event_handler import SimEventHandler
+
+# Quantized vehicle record of the live-view protocol.
+RECORD_DTYPE = np.dtype([
+    ('id',       '<u4'),
+    ('position', '<u4'),    # decimeter
+    ('length',   'u1'),     # decimeter
+    ('lane',     'u1'),     # animlane in 1/16 lane
+    ('type',     'u1'),     # type id
+    ('flags',    'u1'),     # FLAG_*, class in bits 4-5
+])
+FLAG_ACCELERATING = 1
+FLAG_BRAKING = 2
+FLAG_EMERGENCY = 4
+CLASS_SHIFT = 4
+
+# Messages are prefixed with their length. The payload starts with its kind:
+#  - HELLO: JSON with the road configuration, sent once after connecting
+#  - KEYFRAME: all vehicles
+#  - DELTA: the vehicles that changed since the previous frame and the ids
+#    of the vehicles that left the road
+# Frames: kind, sim_time, number of records, number of removed ids, the
+# records and the removed ids.
+HELLO, KEYFRAME, DELTA = 0, 1, 2
+LENGTH = struct.Struct('<I')
+FRAME = struct.Struct('<BdII')
+
+CONF_FIELDS = ['road_len', 'rows', 'nb_lanes', 'speed_range', 'fps']
+
+def quantize(vehicles):
+    """ RECORD_DTYPE array of the vehicles, sorted on id. """
+    rec = np.array([(v.id, max(0, int(v.position*10)), int(round(v.length*10)),
+                     int(round(v.animlane*16)), v.type_id,
+                     (FLAG_ACCELERATING if v.acceleration > 0 else FLAG_BRAKING if v.acceleration < 0 else 0) |
+                     (FLAG_EMERGENCY if v.emergency > 0 else 0) | (_class_code(v) << CLASS_SHIFT))
+                    for v in vehicles], dtype=RECORD_DTYPE)
+    return np.sort(rec, order='id')
+
+def encode_message(kind, payload):
+    body = struct.pack('<B', kind) + payload if kind == HELLO else payload
+    return LENGTH.pack(len(body)) + body
+
+def encode_frame(kind, sim_time, records, removed=()):
+    removed = np.asarray(removed, dtype='<u4')
+    return encode_message(kind, FRAME.pack(kind, sim_time, len(records), len(removed)) +
+                          records.tobytes() + removed.tobytes())
+
+class FrameEncoder:
+    """ Delta encoding of successive quantized frames. """
+
+    def __init__(self):
+        self.records = np.empty(0, dtype=RECORD_DTYPE)
+        self.sim_time = 0.0
+
+    def keyframe(self):
+        return encode_frame(KEYFRAME, self.sim_time, self.records)
+
+    def delta(self, records, sim_time):
+        """ Delta message from the previous frame to records (sorted on id). """
+        old = self.records
+        changed = np.ones(len(records), dtype=bool)
+        if len(old):
+            # Records with an id that was already there: changed if different.
+            idx = np.searchsorted(old['id'], records['id'])
+            idx = np.minimum(idx, len(old) - 1)
+            same_id = old['id'][idx] == records['id']
+            changed[same_id] = records[same_id] != old[idx[same_id]]
+        removed = old['id'][~np.isin(old['id'], records['id'])]
+
+        self.records = records
+        self.sim_time = sim_time
+        return encode_frame(DELTA, sim_time, records[changed], removed)
+
+class FrameDecoder:
+    """ Applies received frames, records holds the current vehicles sorted on id. """
+
+    def __init__(self):
+        self.conf = None
+        self.records = np.empty(0, dtype=RECORD_DTYPE)
+        self.sim_time = 0.0
+
+    def decode(self, body):
+        """ Apply one message body (without length prefix), return its kind. """
+        kind = body[0]
+        if kind == HELLO:
+            self.conf = json.loads(body[1:].decode())
+            return kind
+
+        kind, self.sim_time, n, m = FRAME.unpack_from(body)
+        start = FRAME.size
+        records = np.frombuffer(body, dtype=RECORD_DTYPE, count=n, offset=start)
+        removed = np.frombuffer(body, dtype='<u4', count=m, offset=start + n*RECORD_DTYPE.itemsize)
+
+        if kind == KEYFRAME:
+            self.records = records.copy()
+        else:
+            old = self.records
+            keep = ~np.isin(old['id'], removed) & ~np.isin(old['id'], records['id'])
+            self.records = np.sort(np.concatenate([old[keep], records]), order='id')
+        return kind
+
+    def vehicle_arrays(self):
+        """ The current vehicles as VEHICLE_DTYPE array, for the renderers. """
+        rec = self.records
+        arr = np.zeros(len(rec), dtype=VEHICLE_DTYPE)
+        arr['position'] = rec['position'] / 10
+        arr['length'] = rec['length'] / 10
+        arr['animlane'] = rec['lane'] / 16
+        arr['type'] = rec['type']
+        arr['cls'] = rec['flags'] >> CLASS_SHIFT
+        arr['emergency'] = (rec['flags'] & FLAG_EMERGENCY) > 0
+        arr['acceleration'] = np.where(rec['flags'] & FLAG_ACCELERATING, 1.0,
+                                       np.where(rec['flags'] & FLAG_BRAKING, -1.0, 0.0))
+        arr['slack'] = 1.0
+        return arr
+
+class LiveViewServer(SimEventHandler):
+    """
+    Simulation handler that streams the vehicles to live-view clients over
+    TCP, every interval seconds of simulated time. A client gets the road
+    configuration and a keyframe when it connects, then delta frames.
+    Sockets are non-blocking: a client that falls more than max_backlog
+    bytes behind is disconnected rather than slowing down the simulation.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, interval=1/30, keyframe_every=300,
+                 max_backlog=1 << 22):
+        self.interval = interval
+        self.keyframe_every = keyframe_every
+        self.max_backlog = max_backlog
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(8)
+        self._socket.setblocking(False)
+        self.address = self._socket.getsockname()
+
+        self._clients = {}      # socket -> bytearray of unsent data
+        self._encoder = FrameEncoder()
+        self._nb_frames = 0
+        self._next_time = 0.0
+        self.bytes_sent = 0
+
+    def after_time_step(self, dt, sim_time):
+        if sim_time + 1e-9 < self._next_time:
+            return
+        self._next_time = (np.floor(sim_time/self.interval + 1e-6) + 1) * self.interval
+
+        self._accept(self._sim._conf)
+        if not self._clients:
+            return
+
+        records = quantize(self._sim)
+        self._nb_frames += 1
+        if self._nb_frames % self.keyframe_every == 0:
+            self._encoder.delta(records, sim_time)
+            message = self._encoder.keyframe()
+        else:
+            message = self._encoder.delta(records, sim_time)
+
+        for client in list(self._clients):
+            self._clients[client] += message
+        self._flush()
+
+    def _accept(self, conf):
+        while True:
+            try:
+                client, addr = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            hello = json.dumps({f: getattr(conf, f) for f in CONF_FIELDS}).encode()
+            self._clients[client] = bytearray(encode_message(HELLO, hello) + self._encoder.keyframe())
+
+    def _flush(self):
+        for client, data in list(self._clients.items()):
+            try:
+                n = client.send(data)
+                self.bytes_sent += n
+                del data[:n]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self._drop(client)
+                continue
+            if len(data) > self.max_backlog:
+                self._drop(client)
+
+    def _drop(self, client):
+        del self._clients[client]
+        client.close()
+
+    def close(self):
+        for client in list(self._clients):
+            self._drop(client)
+        self._socket.close()
+
+    def __str__(self):
+        return 'LiveViewServer({}:{}, {} clients)'.format(self.address[0], self.address[1], len(self._clients))
+
+class LiveViewClient:
+    """ Connects to a LiveViewServer and decodes its frames. """
+
+    def __init__(self, host, port):
+        self._socket = socket.create_connection((host, port))
+        self._buffer = bytearray()
+        self.decoder = FrameDecoder()
+
+    def receive(self, timeout=None):
+        """
+        Receive and apply the next message, return its kind (None on timeout,
+        raise ConnectionError when the server closed the connection).
+        """
+        while True:
+            if len(self._buffer) >= LENGTH.size:
+                size, = LENGTH.unpack_from(self._buffer)
+                if len(self._buffer) >= LENGTH.size + size:
+                    body = bytes(self._buffer[LENGTH.size:LENGTH.size + size])
+                    del self._buffer[:LENGTH.size + size]
+                    return self.decoder.decode(body)
+
+            if not select.select([self._socket], [], [], timeout)[0]:
+                return None
+            data = self._socket.recv(1 << 16)
+            if not data:
+                raise ConnectionError('live-view server closed the connection')
+            self._buffer += data
+
+    def close(self):
+        self._socket.close()
+
+def main():
+    import pygame
+    from export import Rasterizer
+
+    parser = argparse.ArgumentParser(description='View a simulation streamed by a LiveViewServer.')
+    parser.add_argument('address', help='HOST:PORT')
+    parser.add_argument('--width', type=int, default=1800, help='px')
+    args = parser.parse_args()
+
+    host, port = args.address.rsplit(':', 1)
+    client = LiveViewClient(host, int(port))
+    while client.receive() != HELLO:
+        pass
+
+    conf = type('LiveViewConf', (), client.decoder.conf)
+    raster = Rasterizer(conf, args.width)
+    pygame.init()
+    pygame.display.set_caption('Highway simulation (live view {})'.format(args.address))
+    screen = pygame.display.set_mode((raster.width, raster.height))
+
+    try:
+        while True:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_q):
+                    return
+            # Apply all pending frames, draw the latest state.
+            kind = client.receive(timeout=0.1)
+            while kind is not None:
+                kind = client.receive(timeout=0)
+            img = raster.render(client.decoder.vehicle_arrays())
+            pygame.surfarray.blit_array(screen, img.swapaxes(0, 1))
+            pygame.display.flip()
+    except ConnectionError as e:
+        print(e)
+    finally:
+        client.close()
+        pygame.quit()
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+from config import HeadlessConfig
+from simulation import SimulationWithHandlers
+
+class LiveViewTest(unittest.TestCase):
+
+    class Conf(HeadlessConfig):
+        seed = 5
+
+    def test_delta_encoding(self):
+        rec = np.zeros(3, dtype=RECORD_DTYPE)
+        rec['id'] = [1, 2, 3]
+        rec['position'] = [100, 200, 300]
+        encoder = FrameEncoder()
+        decoder = FrameDecoder()
+        decoder.decode(encoder.delta(rec, 0.1)[LENGTH.size:])
+
+        new = rec[1:].copy()                    # 1 left the road
+        new['position'][1] += 5                 # 3 moved, 2 didn't
+        new = np.concatenate([new, np.array([(4, 0, 40, 0, 0, 0)], dtype=RECORD_DTYPE)])
+        message = encoder.delta(new, 0.2)
+        self.assertEqual(len(message), LENGTH.size + FRAME.size + 2*RECORD_DTYPE.itemsize + 4)
+
+        decoder.decode(message[LENGTH.size:])
+        self.assertTrue(np.array_equal(decoder.records, new))
+        self.assertEqual(decoder.sim_time, 0.2)
+
+    def test_localhost(self):
+        server = LiveViewServer(interval=0.1)
+        sim = SimulationWithHandlers(self.Conf(), [server])
+        client = LiveViewClient(*server.address)
+        try:
+            for i in range(300):
+                sim.time_step(0.1)
+                while client.receive(timeout=0) is not None:
+                    pass
+            # Let the last frames arrive.
+            while client.receive(timeout=0.5) is not None:
+                pass
+
+            self.assertEqual(client.decoder.conf['road_len'], self.Conf.road_len)
+            self.assertAlmostEqual(client.decoder.sim_time, sim._sim_time)
+            self.assertTrue(np.array_equal(client.decoder.records, quantize(sim)))
+            self.assertGreater(len(client.decoder.records), 0)
+        finally:
+            client.close()
+            server.close()
+
+if __name__ == '__main__':
+    main()
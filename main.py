@@ -1,69 +1,80 @@
 #!/usr/bin/python
 
+import sys
 import time
 import pygame
 
+from config import Config
 from vehicle import Vehicle
 from simulation import SimulationWithHandlers
 from animation import max_road_len
-from animation_opengl import Animation
 
 from animation_base import AnimationInterrupt
-from animation_opengl import Animation
+from profiler import Profiler
+from scenario import load_scenario
+from snapshot import SimulationProcess
 from sim_event_handler import *
 
-class Config:
-    fps = 60
-    nb_lanes = 3
-    road_len = 600          # meter
-    spawn_rate = 3.0        # cars per second
-    speed_range = (25, 35)  # (min, max) speed in meter/sec
+def make_animation(sim, conf):
+    if conf.renderer == 'opengl_vbo':
+        from animation_opengl_vbo import Animation
+    elif conf.renderer == 'opengl_lod':
+        from animation_lod import Animation
+    else:
+        from animation_opengl import Animation
+    return Animation(sim, conf)
 
-    speedup = 1             # int speed up factor: 1 sec in anim = speedup sec in sim
-
-    # Animation
-    window_height = 370
-    rows = 3                # number of wrapped roads vertically
-    window_width = 1800
-
-    sound = True
-
-    # Non-OpenGL animation specific configuration
-    #window_height = 500
-    #scale = 10
-    #road_len = -1
-
-def start_sim():
+def start_sim(scenario_file=None):
     conf = Config()
-
-    sim = SimulationWithHandlers(conf)
-    anim = Animation(sim, conf)
     dt = 1./conf.fps
 
     stats = StatsEvHandler()
-    sim.add_handler(stats)
     avgspeed = AverageSpeedHandler()
-    sim.add_handler(avgspeed)
     throughput = ThroughPutHandler()
-    sim.add_handler(throughput)
     traveltime = TravelTimeHandler()
-    sim.add_handler(traveltime)
     vehicle_count = VehicleCountHandler()
-    sim.add_handler(vehicle_count)
 
     slow_zone1 = SlowZoneEvHandler(300, 450, max_velocity=7)
     slow_zone1.enabled = False   # disabled by default, enable by pressing O
-    sim.add_handler(slow_zone1)
-    anim.register_interactive_sim_handler(slow_zone1, pygame.K_o)
     slow_zone2 = SlowZoneEvHandler(400, 500, max_velocity=0)
     slow_zone2.enabled = False   # disabled by default, enable by pressing P
-    sim.add_handler(slow_zone2)
-    anim.register_interactive_sim_handler(slow_zone2, pygame.K_p)
+
+    handlers = [stats, avgspeed, throughput, traveltime, vehicle_count, slow_zone1, slow_zone2]
+    named_handlers = {'slow_zone1': slow_zone1, 'slow_zone2': slow_zone2}
+
+    if conf.decoupled:
+        # The simulation runs in its own process, the animation draws the
+        # latest published snapshot.
+        if conf.renderer not in ('opengl_vbo', 'opengl_lod'):
+            raise ValueError("decoupled mode needs the 'opengl_vbo' or 'opengl_lod' renderer")
+        sim = SimulationProcess(conf, handlers, named_handlers, scenario_file).start()
+        anim = make_animation(sim, conf)
+        anim.register_interactive_sim_handler(sim.handler_proxy('slow_zone1'), pygame.K_o)
+        anim.register_interactive_sim_handler(sim.handler_proxy('slow_zone2'), pygame.K_p)
+    else:
+        sim = SimulationWithHandlers(conf, handlers)
+        anim = make_animation(sim, conf)
+        anim.register_interactive_sim_handler(slow_zone1, pygame.K_o)
+        anim.register_interactive_sim_handler(slow_zone2, pygame.K_p)
+
+        # A scenario can schedule the same toggles as the keyboard.
+        if scenario_file:
+            scenario = load_scenario(scenario_file)
+            for name, h in named_handlers.items():
+                scenario.register_handler(name, h)
+            sim.add_handler(scenario)
+
+    profiler = None
+    if conf.profile and not conf.decoupled:
+        profiler = Profiler(sample_every=10).attach(sim, anim)
 
     try:
         while True:
-            for i in range(conf.speedup):
-                sim.time_step(conf.speedup*dt)
+            if conf.decoupled:
+                sim.sync_conf()
+            else:
+                for i in range(conf.speedup):
+                    sim.time_step(conf.speedup*dt)
             anim.draw_frame()
     except (KeyboardInterrupt, AnimationInterrupt):
         print()
@@ -71,6 +82,15 @@ def start_sim():
     finally:
         anim.destroy()
 
+    if conf.decoupled:
+        stats, avgspeed, throughput, traveltime, vehicle_count, slow_zone1, slow_zone2 = sim.stop()
+
+    if profiler:
+        profiler.detach()
+        print(profiler)
+        profiler.to_json(conf.profile + '.json')
+        profiler.to_folded(conf.profile + '.folded')
+
     print(stats)
     plt.figure()
     ax1 = plt.subplot(5,1,1)
@@ -86,4 +106,4 @@ def start_sim():
     plt.show()
 
 if __name__ == "__main__":
-    start_sim()
+    start_sim(sys.argv[1] if len(sys.argv) > 1 else None)
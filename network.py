@@ -0,0 +1,445 @@
+import copy
+
+import numpy as np
+
+from random_streams import STREAMS
+from simulation import Simulation
+from vehicle_container import VehicleContainer
+from vehicle_pool import VehiclePool, VehicleIds
+
+MERGE_ZONE = 100.0      # meter before the end of a lane in which its vehicles are forced out of it
+EXIT_ZONE = 300.0       # meter before the end of a link in which vehicles move to the lanes of their route
+ACCELERATION_LANE = 200.0   # meter, default length of the acceleration lane of an on-ramp
+FORCED_BRAKING = 4.0    # m/s², deceleration the vehicles behind a forced lane change may need
+
+class Ghost:
+    """
+    Stand-in, during one time step, for the last vehicle of a lane of the
+    next link (so that vehicles see their leader across the link boundary),
+    or for the end of a lane (a stopped obstacle). Ghosts are never updated,
+    the ghost of a vehicle is placed where it will be after the step, as
+    leaders are updated before their followers within a link.
+    """
+
+    def __init__(self, lane, position, vehicle=None, dt=0.0):
+        self.lane = lane
+        self.position = position
+        if vehicle:
+            self.position += dt*vehicle.velocity + .5*dt*dt*vehicle.acceleration
+            self.velocity = vehicle.velocity
+            self.acceleration = vehicle.acceleration
+            self.length = vehicle.length
+            self.safe_distance = vehicle.safe_distance
+            self.extremely_safe_distance = vehicle.extremely_safe_distance
+        else:
+            self.velocity = 0.0
+            self.acceleration = 0.0
+            self.length = 1.0
+            self.safe_distance = self.extremely_safe_distance = 1.0
+
+    def __lt__(self, other):
+        return self.position < other.position
+
+class LinkContainer(VehicleContainer):
+    """ Vehicle container of a link, some of its lanes may end (lane -> position). """
+
+    def __init__(self, nb_lanes, lane_ends=None):
+        super().__init__(nb_lanes)
+        self.lane_ends = dict(lane_ends or {})
+
+    def lane_open(self, lane, position):
+        # Nobody changes to a lane that ends, its vehicles only leave it.
+        return super().lane_open(lane, position) and lane not in self.lane_ends
+
+class Link(Simulation):
+    """
+    One road of a Network, with its own vehicle container, configuration
+    (road_len, nb_lanes) and random streams. Vehicles that drive past the end
+    of the link are collected in outbox, the network moves them to the next
+    link of their route. A link only modifies its own state while it steps,
+    so all links of a network can be stepped in parallel. The vehicle ids
+    come from the VehicleIds of the network, so they stay unique when the
+    vehicles move between links.
+    """
+
+    def __init__(self, name, conf, length, nb_lanes, lane_ends=None, seed=None, ids=None):
+        conf = copy.copy(conf)
+        conf.road_len = length
+        conf.nb_lanes = nb_lanes
+        conf.spawn_rate = 0.0
+        conf.seed = seed
+        super().__init__(conf)
+
+        self.name = name
+        self.length = length
+        self.nb_lanes = nb_lanes
+        self._container = LinkContainer(nb_lanes, lane_ends)
+        self._pool = VehiclePool(self._rng, ids)
+        self._explicit_lane_ends = dict(lane_ends or {})
+        self._route_rng = np.random.RandomState([self._rng.seed, len(STREAMS)])
+
+        self.outgoing = {}      # next link name -> {lane: lane of the next link}
+        self.routes = []        # routes of the spawned vehicles
+        self._route_weights = None
+        self.outbox = []
+        self.nb_spawned = 0
+
+    def set_source(self, rate, routes):
+        self._conf.spawn_rate = rate
+        self.routes = [tuple(r) for w, r in routes]
+        w = np.array([w for w, r in routes], dtype=float)
+        self._route_weights = np.cumsum(w/w.sum())
+
+    def update_lane_ends(self):
+        """ Lanes that lead to no next link end at the end of the link. """
+        ends = dict(self._explicit_lane_ends)
+        if self.outgoing:
+            for lane in range(self.nb_lanes):
+                if not any(lane in lanes for lanes in self.outgoing.values()):
+                    ends.setdefault(lane, self.length)
+        self._container.lane_ends = ends
+
+    def next_link(self, vehicle):
+        """ Name of the next link of the route of vehicle, None at its end. """
+        i = vehicle.route_index + 1
+        return vehicle.route[i] if i < len(vehicle.route) else None
+
+    def time_step(self, dt, ghosts=()):
+        c = self._container
+        ghosts = list(ghosts) + [Ghost(lane, end) for lane, end in c.lane_ends.items()]
+        c.spawn_many(ghosts)
+
+        super().time_step(dt)
+        self._mandatory_lane_changes()
+
+        # Ghosts past the end of the link were removed with the vehicles
+        # that left it.
+        for g in ghosts:
+            if g.position <= self.length:
+                c.despawn(g)
+
+    def time_step_vehicle(self, vehicle, dt):
+        if not isinstance(vehicle, Ghost):
+            super().time_step_vehicle(vehicle, dt)
+
+    def try_spawn_vehicle(self):
+        if self._conf.spawn_rate > 0:
+            super().try_spawn_vehicle()
+
+    def _spawn_vehicle(self, vehicle):
+        i = int(np.searchsorted(self._route_weights, self._route_rng.random_sample(), side='right'))
+        vehicle.route = self.routes[min(i, len(self.routes) - 1)]
+        vehicle.route_index = 0
+        vehicle.spawn_time = self._sim_time
+        self.nb_spawned += 1
+        super()._spawn_vehicle(vehicle)
+
+    def _despawn_beyond(self, position):
+        # The vehicles continue on the next link, nothing is recycled.
+        vehicles = super()._despawn_beyond(position)
+        self.outbox.extend(v for v in vehicles if not isinstance(v, Ghost))
+        return []
+
+    def _target_lanes(self, vehicle):
+        """ Lanes vehicle has to be in at the end of its lane or of the link, None: any. """
+        open_lanes = {l for l in range(self.nb_lanes) if l not in self._container.lane_ends}
+        nxt = self.next_link(vehicle)
+        if nxt in self.outgoing:
+            lanes = set(self.outgoing[nxt])
+        elif self.outgoing:
+            lanes = set().union(*self.outgoing.values())
+        else:
+            return open_lanes if vehicle.lane not in open_lanes else None
+        return lanes if lanes else open_lanes
+
+    def _mandatory_lane_changes(self):
+        """
+        Vehicles in a lane that ends, or in a lane that doesn't lead to the next
+        link of their route, move over as soon as the gaps allow it once they
+        are close enough to the end, whatever their speed and cooldown.
+        """
+        c = self._container
+        for v in list(c):
+            if isinstance(v, Ghost):
+                continue
+            lanes = self._target_lanes(v)
+            if not lanes or v.lane in lanes:
+                continue
+            if v.lane in c.lane_ends:
+                if c.lane_ends[v.lane] - v.position > MERGE_ZONE:
+                    continue
+            elif self.length - v.position > EXIT_ZONE:
+                continue
+
+            lane = v.lane + (1 if min(lanes, key=lambda l: abs(l - v.lane)) > v.lane else -1)
+            if lane in lanes or lane not in c.lane_ends:
+                self._force_lane_change(v, lane)
+
+    def _force_lane_change(self, vehicle, lane):
+        back, front = self._container.neighbors_at(lane, vehicle.position)
+
+        # The safe distances must hold, and the slower vehicle must be
+        # reachable with moderate braking.
+        if front and front.position - vehicle.position <= \
+                max(front.length, vehicle.safe_distance) + _braking_distance(vehicle, front):
+            return False
+        if back and vehicle.position - back.position <= \
+                max(vehicle.length, back.safe_distance) + _braking_distance(back, vehicle):
+            return False
+
+        old_lane = vehicle.lane
+        vehicle.lane = lane
+        self._container.notify_lane_change(vehicle, old_lane)
+        vehicle.time_since_lane_change = 0.0
+        return True
+
+    def __str__(self):
+        return 'Link[{}, {} m, {} lanes]'.format(self.name, self.length, self.nb_lanes)
+
+def _braking_distance(back, front):
+    closing = max(0.0, back.velocity - front.velocity)
+    return closing*closing/(2*FORCED_BRAKING)
+
+def _step_link(job):
+    link, ghosts, dt = job
+    link.time_step(dt, ghosts)
+
+class Network:
+    """
+    Road network: links joined by nodes (plain connections, on-ramp merges,
+    off-ramp diverges, lane drops). Vehicles are spawned by source links and
+    follow a route, a list of link names. A time step first steps every link
+    on its own, then exchanges the vehicles that left a link. Vehicles see
+    the last vehicles of the next link as ghosts, placed before the step.
+
+    executor: optional object with a map method (e.g. a
+    concurrent.futures.ThreadPoolExecutor) to step the links in parallel. The
+    result doesn't depend on it.
+    """
+
+    def __init__(self, conf, executor=None):
+        self._conf = conf
+        self._executor = executor
+        self._sim_time = 0
+        self._feeds = {}            # (link, lane) -> (upstream link, lane)
+        self._ids = VehicleIds()    # shared by the links
+        self.links = {}
+        self.travel_times = {}      # driven route -> travel times
+        self.missed_turns = 0
+
+    def add_link(self, name, length, nb_lanes=None, lane_ends=None):
+        if name in self.links:
+            raise ValueError('duplicate link {}'.format(name))
+        seed = None if self._conf.seed is None else self._conf.seed*1000 + len(self.links)
+        link = Link(name, self._conf, length, nb_lanes or self._conf.nb_lanes, lane_ends, seed,
+                    self._ids)
+        self.links[name] = link
+        return link
+
+    def connect(self, a, b, lanes=None):
+        """
+        Vehicles at the end of link a continue on link b. lanes maps lanes
+        of a to lanes of b, by default lane i to lane i. Lanes of a that lead
+        to no link end there.
+        """
+        la, lb = self.links[a], self.links[b]
+        if lanes is None:
+            lanes = {i: i for i in range(min(la.nb_lanes, lb.nb_lanes))}
+        for i, j in lanes.items():
+            if not (0 <= i < la.nb_lanes and 0 <= j < lb.nb_lanes):
+                raise ValueError('no lane {} -> {} between {} and {}'.format(i, j, a, b))
+            if (b, j) in self._feeds:
+                raise ValueError('lane {} of {} is already fed by {}'.format(j, b, self._feeds[b, j]))
+        for i, j in lanes.items():
+            self._feeds[b, j] = (a, i)
+
+        la.outgoing.setdefault(b, {}).update(lanes)
+        la.update_lane_ends()
+
+    def add_merge(self, main, ramp, out, accel_len=ACCELERATION_LANE):
+        """
+        On-ramp: the lanes of main continue on the first lanes of out, the
+        lanes of ramp become the acceleration lanes of out (the right-most
+        ones), which end after accel_len meters.
+        """
+        lm, lr, lo = self.links[main], self.links[ramp], self.links[out]
+        if lo.nb_lanes != lm.nb_lanes + lr.nb_lanes:
+            raise ValueError('{} needs {} lanes'.format(out, lm.nb_lanes + lr.nb_lanes))
+        self.connect(main, out)
+        self.connect(ramp, out, {i: lm.nb_lanes + i for i in range(lr.nb_lanes)})
+
+        for lane in range(lm.nb_lanes, lo.nb_lanes):
+            lo._explicit_lane_ends[lane] = accel_len
+        lo.update_lane_ends()
+
+    def add_diverge(self, main, out, ramp, exit_lanes=1):
+        """
+        Off-ramp: the first lanes of main continue on out, its exit_lanes
+        right-most lanes also lead to ramp.
+        """
+        lm, lr = self.links[main], self.links[ramp]
+        if exit_lanes > min(lm.nb_lanes, lr.nb_lanes):
+            raise ValueError('too many exit lanes')
+        self.connect(main, out)
+        first = lm.nb_lanes - exit_lanes
+        self.connect(main, ramp, {first + i: i for i in range(exit_lanes)})
+
+    def add_lane_drop(self, a, b, dropped):
+        """ The lanes dropped of link a end, its other lanes continue on b. """
+        kept = [l for l in range(self.links[a].nb_lanes) if l not in dropped]
+        if len(kept) != self.links[b].nb_lanes:
+            raise ValueError('{} has {} lanes, {} remain'.format(b, self.links[b].nb_lanes, len(kept)))
+        self.connect(a, b, {l: i for i, l in enumerate(kept)})
+
+    def add_source(self, name, rate, routes=None):
+        """
+        Spawn rate vehicles per second at the start of link name. routes is a
+        list of (weight, [link names]) starting with name; without it (or at
+        the end of their route) vehicles take the first link they can reach.
+        """
+        routes = routes or [(1.0, [name])]
+        for w, route in routes:
+            if route[0] != name:
+                raise ValueError('route {} doesn\'t start at {}'.format(route, name))
+            for a, b in zip(route, route[1:]):
+                if b not in self.links[a].outgoing:
+                    raise ValueError('{} is not connected to {}'.format(a, b))
+        self.links[name].set_source(rate, routes)
+
+    def time_step(self, dt):
+        jobs = [(link, self._boundary_ghosts(link, dt), dt) for link in self.links.values()]
+        if self._executor:
+            list(self._executor.map(_step_link, jobs))
+        else:
+            for job in jobs:
+                _step_link(job)
+
+        self._sim_time += dt
+        for link in self.links.values():
+            self._exchange(link)
+
+    def _boundary_ghosts(self, link, dt):
+        """ Ghosts of the last vehicles of the next links, per lane of link. """
+        closest = {}
+        for name, lanes in link.outgoing.items():
+            nxt = self.links[name]._container
+            for i, j in lanes.items():
+                last = nxt.last(j)
+                if last and (i not in closest or last.position < closest[i].position):
+                    closest[i] = last
+        return [Ghost(i, link.length + v.position, v, dt) for i, v in closest.items()]
+
+    def _exchange(self, link):
+        arrivals = {}
+        for v in link.outbox:
+            v.position -= link.length
+            name = self._next_link(link, v)
+            if name is None:
+                route = tuple(v.route[:v.route_index+1])
+                self.travel_times.setdefault(route, []).append(self._sim_time - v.spawn_time)
+                continue
+
+            v.lane = link.outgoing[name][v.lane]
+            v.animlane = v.lane
+            v.route_index += 1
+            # Draw from the streams of the new link, so that links stepped in
+            # parallel never share a stream.
+            v._rng = self.links[name]._rng
+            arrivals.setdefault(name, []).append(v)
+        link.outbox = []
+
+        for name, vehicles in arrivals.items():
+            self.links[name]._container.spawn_many(vehicles)
+
+    def _next_link(self, link, vehicle):
+        """ Next link of vehicle, rerouted if it can't reach the one of its route. """
+        nxt = link.next_link(vehicle)
+        if nxt is not None and vehicle.lane in link.outgoing[nxt]:
+            return nxt
+
+        reachable = [name for name, lanes in link.outgoing.items() if vehicle.lane in lanes]
+        if not reachable:
+            return None
+        if nxt is not None:
+            self.missed_turns += 1
+        vehicle.route = tuple(vehicle.route[:vehicle.route_index+1]) + (reachable[0],)
+        return reachable[0]
+
+    def __iter__(self):
+        """ All vehicles, their positions are relative to the start of their link. """
+        for link in self.links.values():
+            yield from link
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from config import HeadlessConfig
+
+class NetworkTest(unittest.TestCase):
+
+    class Conf(HeadlessConfig):
+        seed = 4
+        speed_range = (20, 25)
+
+    def _network(self, executor=None):
+        net = Network(self.Conf(), executor)
+        net.add_link('main', 300, 2)
+        net.add_link('ramp', 150, 1)
+        net.add_link('merge', 400, 3)
+        net.add_link('mid', 600, 2)
+        net.add_link('out', 300, 2)
+        net.add_link('exit', 200, 1)
+        net.add_merge('main', 'ramp', 'merge', accel_len=250)
+        net.add_lane_drop('merge', 'mid', dropped=[2])
+        net.add_diverge('mid', 'out', 'exit')
+        net.add_source('main', 1.0, [(0.7, ['main', 'merge', 'mid', 'out']),
+                                     (0.3, ['main', 'merge', 'mid', 'exit'])])
+        net.add_source('ramp', 0.3, [(1.0, ['ramp', 'merge', 'mid', 'out'])])
+        return net
+
+    def test_nodes(self):
+        net = self._network()
+        self.assertEqual(net.links['merge']._container.lane_ends, {2: 250})
+        self.assertEqual(net.links['mid'].outgoing, {'out': {0: 0, 1: 1}, 'exit': {1: 0}})
+        self.assertFalse(net.links['merge']._container.lane_open(2, 10))
+        with self.assertRaises(ValueError):
+            net.connect('ramp', 'mid', {0: 0})
+        with self.assertRaises(ValueError):
+            net.add_source('out', 1.0, [(1.0, ['out', 'main'])])
+
+    def test_flow(self):
+        net = self._network()
+        for i in range(3000):
+            net.time_step(0.1)
+
+            for v in net.links['merge']:
+                self.assertTrue(v.lane < 2 or v.position <= 250)
+            for v in net.links['exit']:
+                self.assertEqual(v.route[-1], 'exit')
+
+        arrived = {route: len(t) for route, t in net.travel_times.items()}
+        self.assertGreater(arrived.get(('ramp', 'merge', 'mid', 'out'), 0), 20)
+        self.assertGreater(arrived.get(('main', 'merge', 'mid', 'exit'), 0), 20)
+        self.assertLess(net.missed_turns, 0.1*sum(arrived.values()))
+
+        # No vehicle is lost or duplicated at the nodes.
+        nb_spawned = sum(l.nb_spawned for l in net.links.values())
+        self.assertEqual(nb_spawned, sum(arrived.values()) + len(list(net)))
+        # Ids are unique on the whole network.
+        ids = [v.id for v in net]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_parallel(self):
+        a = self._network()
+        with ThreadPoolExecutor(4) as pool:
+            b = self._network(pool)
+            for i in range(500):
+                a.time_step(0.1)
+                b.time_step(0.1)
+        self.assertEqual([(v.lane, v.position) for v in a], [(v.lane, v.position) for v in b])
+
+if __name__ == '__main__':
+    unittest.main()
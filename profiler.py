@@ -0,0 +1,244 @@
+import json
+import time
+from collections import defaultdict
+
+from vehicle import Vehicle, HumanVehicle, Car, Truck, AutomaticCar
+
+NEIGHBOR_METHODS = ['front', 'back', 'left', 'right', 'left_front', 'left_back',
+                    'right_front', 'right_back', 'get_closest_vehicle']
+LANE_CHANGE_METHODS = ['prob_left', 'prob_right', '_enough_room']
+HANDLER_METHODS = ['before_time_step', 'after_time_step', 'before_vehicle_update',
+                   'after_vehicle_update', 'after_vehicle_spawn', 'before_vehicle_despawn',
+                   'after_vehicles_spawn', 'before_vehicles_despawn']
+VEHICLE_CLASSES = [HumanVehicle, Car, Truck, AutomaticCar]
+
+class Profiler:
+    """
+    Opt-in instrumentation of the simulation hot paths. attach() wraps the
+    methods of interest (neighbor lookups, calc_acceleration, lane change
+    evaluation, handler dispatch, spawning and rendering), detach() puts the
+    original methods back. Nothing is wrapped when the profiler is not
+    attached, so there is no cost when profiling is disabled.
+
+    Counters (lane changes, emergency speed changes, spawns, ...) are kept for
+    every step. Timings are only taken every `sample_every` steps to keep the
+    overhead low enough to leave the profiler on.
+    """
+
+    def __init__(self, sample_every=1):
+        self.sample_every = sample_every
+        self.steps = 0
+        self.sampled_steps = 0
+        self.counters = defaultdict(int)
+        for counter in ['vehicle_updates', 'spawns', 'despawns', 'lane_changes', 'emergencies',
+                        'platoon_members']:
+            self.counters[counter] = 0
+        self.calls = defaultdict(int)
+        self.total_time = defaultdict(float)
+        self.self_time = defaultdict(float)
+        self.folded = defaultdict(float)    # stack path -> self time
+
+        self._sampling = False
+        self._stack = [['root', 0.0, 0.0]]  # [section, start time, time in children]
+        self._patched = []                  # (obj, name, original or None)
+        self._sim = None
+
+    def attach(self, sim, anim=None):
+        self._sim = sim
+
+        self._patch(sim, 'time_step', self._wrap_time_step(sim.time_step))
+        self._patch(sim, 'time_step_vehicle', self._wrap('vehicle_update', sim.time_step_vehicle))
+        self._patch(sim, 'try_spawn_vehicle', self._wrap('spawn', sim.try_spawn_vehicle))
+        self._patch(sim, '_spawn_vehicle', self._count('spawns', sim._spawn_vehicle))
+        self._patch(sim, '_resolve_lane_changes',
+                self._count_returned('lane_changes', self._wrap('lane_change', sim._resolve_lane_changes)))
+        self._patch(sim, 'time_step_platoon_member',
+                self._count('platoon_members', self._wrap('platoon', sim.time_step_platoon_member)))
+        self._patch(sim, '_despawn_beyond', self._count_returned('despawns', self._wrap('despawn', sim._despawn_beyond)))
+
+        container = sim._container
+        for name in NEIGHBOR_METHODS:
+            self._patch(container, name, self._wrap('neighbors', getattr(container, name)))
+        self._patch(container, 'notify_lane_change',
+                self._count('lane_changes', self._wrap('lane_change', container.notify_lane_change)))
+
+        for cls in VEHICLE_CLASSES:
+            for name in LANE_CHANGE_METHODS + ['calc_acceleration']:
+                if name in vars(cls):
+                    section = 'calc_acceleration' if name == 'calc_acceleration' else 'lane_change'
+                    self._patch(cls, name, self._wrap(section, vars(cls)[name]), cls_attr=True)
+        self._patch(Vehicle, 'update', self._count_emergency(vars(Vehicle)['update']), cls_attr=True)
+
+        for h in getattr(sim, '_handlers', []):
+            self._attach_handler(h)
+        if hasattr(sim, 'add_handler'):
+            add_handler = sim.add_handler
+            def wrapped_add_handler(handler):
+                self._attach_handler(handler)
+                add_handler(handler)
+            self._patch(sim, 'add_handler', wrapped_add_handler)
+
+        if anim:
+            self._patch(anim, 'draw_frame', self._wrap('render', anim.draw_frame))
+
+        return self
+
+    def detach(self):
+        for obj, name, original in reversed(self._patched):
+            if original is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, original)
+        self._patched = []
+        self._sim = None
+
+    def _attach_handler(self, handler):
+        for name in HANDLER_METHODS:
+            self._patch(handler, name, self._wrap('handlers', getattr(handler, name)))
+
+    def _patch(self, obj, name, wrapper, cls_attr=False):
+        original = vars(obj).get(name) if cls_attr or name in vars(obj) else None
+        self._patched.append((obj, name, original))
+        setattr(obj, name, wrapper)
+
+    def _wrap(self, section, fn):
+        prof = self
+        def wrapper(*args, **kwargs):
+            # Nested calls of the same section (e.g. super() calls) are timed
+            # by the outermost call only.
+            if not prof._sampling or prof._stack[-1][0] == section:
+                return fn(*args, **kwargs)
+            prof._enter(section)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                prof._exit()
+        wrapper.__wrapped__ = fn
+        return wrapper
+
+    def _wrap_time_step(self, fn):
+        def wrapper(dt):
+            self.steps += 1
+            self._sampling = self.steps % self.sample_every == 0
+            if not self._sampling:
+                return fn(dt)
+            self.sampled_steps += 1
+            self._enter('time_step')
+            try:
+                return fn(dt)
+            finally:
+                self._exit()
+        return wrapper
+
+    def _count(self, counter, fn):
+        def wrapper(*args, **kwargs):
+            self.counters[counter] += 1
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def _count_returned(self, counter, fn):
+        """ Count the items of the list returned by fn. """
+        def wrapper(*args, **kwargs):
+            result = fn(*args, **kwargs)
+            self.counters[counter] += len(result)
+            return result
+        return wrapper
+
+    def _count_emergency(self, fn):
+        def wrapper(vehicle, conf, container, dt):
+            fn(vehicle, conf, container, dt)
+            self.counters['vehicle_updates'] += 1
+            if vehicle.emergency == conf.fps:
+                self.counters['emergencies'] += 1
+        return wrapper
+
+    def _enter(self, section):
+        self._stack.append([section, time.perf_counter(), 0.0])
+
+    def _exit(self):
+        section, start, children = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        path = ';'.join(frame[0] for frame in self._stack[1:] + [[section]])
+
+        self.calls[section] += 1
+        self.total_time[section] += elapsed
+        self.self_time[section] += elapsed - children
+        self.folded[path] += elapsed - children
+        self._stack[-1][2] += elapsed
+
+    def report(self):
+        """ Summary of the timings and counters as a JSON serializable dict. """
+        n = max(1, self.sampled_steps)
+        sections = {}
+        for section in self.calls:
+            sections[section] = {
+                'calls': self.calls[section],
+                'total_time': self.total_time[section],
+                'self_time': self.self_time[section],
+                'time_per_step': self.total_time[section] / n,
+            }
+        return {
+            'steps': self.steps,
+            'sampled_steps': self.sampled_steps,
+            'sample_every': self.sample_every,
+            'sections': sections,
+            'counters': dict(self.counters),
+        }
+
+    def to_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def to_folded(self, filename):
+        """
+        Write the profile in the folded stack format ("a;b;c <count>") read by
+        flamegraph.pl and speedscope. Counts are in microseconds.
+        """
+        with open(filename, 'w') as f:
+            for path, t in sorted(self.folded.items()):
+                f.write('{} {}\n'.format(path, int(round(t*1e6))))
+
+    def __str__(self):
+        lines = ['Profile over {} steps ({} sampled):'.format(self.steps, self.sampled_steps)]
+        n = max(1, self.sampled_steps)
+        for section in sorted(self.calls, key=lambda s: -self.total_time[s]):
+            lines.append(' - {:18s} {:9.3f} ms/step {:9d} calls'.format(
+                section, 1000*self.total_time[section]/n, self.calls[section]))
+        for counter in sorted(self.counters):
+            lines.append(' - {:18s} {:9d}'.format(counter, self.counters[counter]))
+        return '\n'.join(lines)
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+
+class ProfilerTest(unittest.TestCase):
+
+    def test_attach_detach(self):
+        from config import HeadlessConfig
+        from simulation import SimulationWithHandlers
+        from sim_event_handler import StatsEvHandler
+
+        sim = SimulationWithHandlers(HeadlessConfig(), [StatsEvHandler()])
+        profiler = Profiler(sample_every=2).attach(sim)
+        for i in range(200):
+            sim.time_step(0.1)
+        profiler.detach()
+
+        report = profiler.report()
+        self.assertEqual(report['steps'], 200)
+        self.assertEqual(report['sampled_steps'], 100)
+        for section in ['time_step', 'vehicle_update', 'neighbors', 'calc_acceleration', 'handlers', 'spawn']:
+            self.assertIn(section, report['sections'])
+        self.assertGreater(report['counters']['spawns'], 0)
+        self.assertIn('time_step;vehicle_update', ''.join(profiler.folded))
+
+        self.assertNotIn('time_step', vars(sim))
+        self.assertNotIn('front', vars(sim._container))
+        self.assertFalse(hasattr(vars(HumanVehicle)['calc_acceleration'], '__wrapped__'))
+        self.assertFalse(hasattr(vars(Car)['calc_acceleration'], '__wrapped__'))
+
+if __name__ == '__main__':
+    unittest.main()
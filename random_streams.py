@@ -0,0 +1,94 @@
+import numpy as np
+
+# One stream per purpose, so that paired runs (e.g. slow zone on/off) use the
+# same random numbers for the same purpose: common random numbers.
+STREAMS = ['spawn_time', 'lane', 'vehicle_class', 'speed', 'driver', 'vehicle_type', 'lane_change']
+
+class RandomStream:
+    """
+    A stream of random numbers. All draws are made by inversion of a single
+    uniform number, so the antithetic stream (u -> 1-u) draws the "mirrored"
+    value of every draw of the normal stream.
+    """
+
+    def __init__(self, random_state, antithetic=False):
+        self._rs = random_state
+        self._antithetic = antithetic
+
+    def rand(self):
+        u = self._rs.random_sample()
+        return 1.0 - u if self._antithetic else u
+
+    def uniform(self, low=0.0, high=1.0):
+        return low + (high-low)*self.rand()
+
+    def exponential(self, scale=1.0):
+        return -scale*np.log(max(1.0 - self.rand(), 1e-300))
+
+    def randint(self, n):
+        return min(int(self.rand()*n), n-1)
+
+    def choice(self, seq):
+        return seq[self.randint(len(seq))]
+
+class RandomStreams:
+    """
+    The random number streams of a simulation, one attribute per purpose
+    (see STREAMS). Streams are seeded from (seed, stream index). Without a
+    seed, the seed is drawn from the global np.random state, so seeding
+    np.random still makes a run reproducible.
+    """
+
+    def __init__(self, seed=None, antithetic=False):
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        self.seed = seed
+        self.antithetic = antithetic
+
+        for i, name in enumerate(STREAMS):
+            setattr(self, name, RandomStream(np.random.RandomState([seed, i]), antithetic))
+
+class GlobalRandomStreams:
+    """ All streams draw from the global np.random state. """
+
+    def __init__(self):
+        stream = RandomStream(np.random.mtrand._rand)
+        for name in STREAMS:
+            setattr(self, name, stream)
+
+GLOBAL_STREAMS = GlobalRandomStreams()
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+
+class RandomStreamsTest(unittest.TestCase):
+
+    def test_antithetic(self):
+        normal = RandomStreams(seed=3)
+        anti = RandomStreams(seed=3, antithetic=True)
+
+        for i in range(10):
+            self.assertAlmostEqual(normal.spawn_time.rand() + anti.spawn_time.rand(), 1.0)
+        self.assertAlmostEqual(normal.speed.uniform(20, 30) + anti.speed.uniform(20, 30), 50.0)
+
+    def test_independent_streams(self):
+        a = RandomStreams(seed=3)
+        b = RandomStreams(seed=3)
+
+        # Drawing from one stream doesn't change the others.
+        for i in range(5):
+            a.lane_change.rand()
+        self.assertEqual(a.driver.rand(), b.driver.rand())
+        self.assertNotEqual(a.lane.rand(), a.driver.rand())
+
+    def test_ranges(self):
+        s = RandomStreams(seed=1).lane
+        for i in range(100):
+            self.assertIn(s.randint(3), [0, 1, 2])
+            self.assertGreaterEqual(s.exponential(2.0), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,292 @@
+import numpy as np
+
+from vehicle import Car, Truck
+
+LANE_WIDTH   = 4.0
+ROAD_SPACING = 2.5
+
+VEHICLE_HEIGHT = 2.0   # meter, drawn width of a vehicle across the lane
+INDICATOR_SIZE = 0.5   # meter
+
+# Vehicle classes that get a status indicator.
+CLASS_OTHER, CLASS_CAR, CLASS_TRUCK = 0, 1, 2
+
+# The per vehicle data the renderers need.
+VEHICLE_DTYPE = np.dtype([
+    ('position',     'f4'),
+    ('animlane',     'f4'),
+    ('length',       'f4'),
+    ('type',         'u1'),     # type id: sprite index in the atlas
+    ('cls',          'u1'),     # CLASS_*
+    ('emergency',    'u1'),
+    ('acceleration', 'f4'),
+    ('velocity',     'f4'),
+    ('slack',        'f4'),     # desired_velocity - velocity
+])
+
+# Interleaved vertex: x, y, u, v, r, g, b
+VERTEX_SIZE = 7
+
+ASPHALT = (0.3, 0.3, 0.3)
+JAM_SPACING = 7.5      # meter of lane per vehicle in a standing queue
+
+class RoadGeometry:
+    """
+    Layout of the road in world coordinates (meters): the road of road_len is
+    wrapped into conf.rows rows of nb_lanes lanes each.
+    """
+
+    def __init__(self, conf):
+        self.rows = conf.rows
+        self.nb_lanes = conf.nb_lanes
+        self.row_length = conf.road_len / conf.rows
+        self.road_width = ROAD_SPACING + LANE_WIDTH * conf.nb_lanes
+        self.world_height = self.road_width * conf.rows + ROAD_SPACING
+
+    def y_offset(self, row, lane):
+        return row*self.road_width + ROAD_SPACING + lane*LANE_WIDTH
+
+    def vehicle_centers(self, position, animlane):
+        """ Center (x, y) of vehicles, works on scalars and arrays. """
+        row = position // self.row_length
+        return position % self.row_length, self.y_offset(row, animlane) + LANE_WIDTH/2
+
+class Viewport:
+    """
+    The visible part of the world (meters), with the aspect ratio of the
+    window. Fully zoomed out it fits the whole road.
+    """
+
+    MIN_WIDTH = 20.0    # meter
+
+    def __init__(self, geometry, width_px, height_px):
+        self.geometry = geometry
+        self.width_px = width_px
+        self.height_px = height_px
+        self.aspect = width_px / height_px
+        self.max_width = max(geometry.row_length, geometry.world_height*self.aspect)
+        self.reset()
+
+    @property
+    def height(self):
+        return self.width / self.aspect
+
+    @property
+    def meters_per_pixel(self):
+        return self.width / self.width_px
+
+    def reset(self):
+        self.width = self.max_width
+        self.x0 = (self.geometry.row_length - self.width) / 2
+        self.y0 = (self.geometry.world_height - self.height) / 2
+
+    def zoom(self, factor, cx=None, cy=None):
+        """ Zoom in by factor (out if < 1), keeping the world point (cx, cy) in place. """
+        if cx is None:
+            cx, cy = self.x0 + self.width/2, self.y0 + self.height/2
+        width = min(max(self.width/factor, self.MIN_WIDTH), self.max_width)
+        self.x0 = cx - (cx - self.x0)*width/self.width
+        self.y0 = cy - (cy - self.y0)*width/self.width
+        self.width = width
+        self._clamp()
+
+    def pan(self, dx, dy):
+        self.x0 += dx
+        self.y0 += dy
+        self._clamp()
+
+    def _clamp(self):
+        g = self.geometry
+        self.x0 = min(max(self.x0, min(0, g.row_length - self.width)), max(0, g.row_length - self.width))
+        self.y0 = min(max(self.y0, min(0, g.world_height - self.height)), max(0, g.world_height - self.height))
+
+    def to_world(self, px, py):
+        return (self.x0 + px*self.meters_per_pixel, self.y0 + py*self.meters_per_pixel)
+
+    def visible(self, x, y, margin=0.0):
+        """ Mask of the points within margin of the viewport. """
+        return (x >= self.x0 - margin) & (x <= self.x0 + self.width + margin) & \
+               (y >= self.y0 - margin) & (y <= self.y0 + self.height + margin)
+
+_class_codes = {}
+
+def _class_code(vehicle):
+    cls = vehicle.__class__
+    if cls not in _class_codes:
+        _class_codes[cls] = CLASS_CAR if issubclass(cls, Car) else \
+                            CLASS_TRUCK if issubclass(cls, Truck) else CLASS_OTHER
+    return _class_codes[cls]
+
+def vehicle_arrays(vehicles):
+    """ VEHICLE_DTYPE array of the vehicles. """
+    return np.array([(v.position, v.animlane, v.length, v.type_id, _class_code(v),
+                      v.emergency > 0, v.acceleration, v.velocity, v.desired_velocity - v.velocity)
+                     for v in vehicles], dtype=VEHICLE_DTYPE)
+
+def vehicle_colors(arr):
+    """ Color of the status indicator: emergency, braking, accelerating or cruising. """
+    acc = arr['acceleration']
+    braking = np.minimum(1.0, -acc/9)
+    accelerating = np.minimum(1.0, 0.3 + acc/3)
+
+    colors = np.zeros((len(arr), 3), dtype=np.float32)
+    cruising = arr['slack'] < 1
+    colors[cruising] = (0.05, 0.4, 0.4)
+    pos = acc > 0
+    colors[pos] = np.stack([np.full(pos.sum(), 0.1), accelerating[pos], np.full(pos.sum(), 0.1)], 1)
+    neg = acc < 0
+    colors[neg] = np.stack([braking[neg], braking[neg], np.full(neg.sum(), 0.1)], 1)
+    colors[arr['emergency'] > 0] = (0.7, 0.1, 0.1)
+    return colors
+
+def _quads(xc, yc, w, h, uv, colors):
+    """ Interleaved vertices of axis aligned quads, 4 vertices per quad. """
+    n = len(xc)
+    x0 = xc - w/2; x1 = xc + w/2
+    y0 = yc - h/2; y1 = yc + h/2
+
+    out = np.empty((n, 4, VERTEX_SIZE), dtype=np.float32)
+    out[:, :, 0] = np.stack([x0, x1, x1, x0], 1)
+    out[:, :, 1] = np.stack([y0, y0, y1, y1], 1)
+    u0, v0, u1, v1 = uv[:, 0], uv[:, 1], uv[:, 2], uv[:, 3]
+    out[:, :, 2] = np.stack([u0, u1, u1, u0], 1)
+    out[:, :, 3] = np.stack([v0, v0, v1, v1], 1)
+    out[:, :, 4:7] = colors[:, None, :]
+    return out.reshape(4*n, VERTEX_SIZE)
+
+def vehicle_quads(arr, geometry, uv):
+    """
+    Vertices of the textured vehicle bodies and of the status indicators of
+    cars and trucks. uv is a (nb sprites, 4) array of (u0, v0, u1, v1)
+    texture coordinates per sprite index.
+    """
+    xc, yc = geometry.vehicle_centers(arr['position'], arr['animlane'])
+    n = len(arr)
+
+    body = _quads(xc, yc, arr['length'], np.full(n, VEHICLE_HEIGHT), uv[arr['type']],
+                  np.zeros((n, 3), dtype=np.float32))
+
+    cls = arr['cls']
+    has = cls != CLASS_OTHER
+    xi = np.where(cls == CLASS_CAR, xc - 0.5, xc)[has]
+    m = len(xi)
+    indicators = _quads(xi, yc[has], np.full(m, INDICATOR_SIZE), np.full(m, INDICATOR_SIZE),
+                        np.zeros((m, 4), dtype=np.float32), vehicle_colors(arr[has]))
+
+    return body, indicators
+
+def lane_bins(arr, geometry, bin_len):
+    """
+    Vehicle count and mean velocity (nan for empty bins) per row, lane and
+    bin of bin_len meters, arrays of shape (rows, nb_lanes, nb bins).
+    """
+    g = geometry
+    nb_bins = int(np.ceil(g.row_length / bin_len))
+    position = arr['position'].astype(float)
+    row = np.clip(position // g.row_length, 0, g.rows-1).astype(int)
+    b = np.clip((position % g.row_length) // bin_len, 0, nb_bins-1).astype(int)
+    lane = np.clip(np.rint(arr['animlane']), 0, g.nb_lanes-1).astype(int)
+
+    idx = (row*g.nb_lanes + lane)*nb_bins + b
+    size = g.rows*g.nb_lanes*nb_bins
+    counts = np.bincount(idx, minlength=size)
+    speed = np.bincount(idx, weights=arr['velocity'], minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        speed = speed / counts
+
+    shape = (g.rows, g.nb_lanes, nb_bins)
+    return counts.reshape(shape), speed.reshape(shape)
+
+def speed_colors(speed, max_speed):
+    """ Red (standing) over yellow to green (max_speed). """
+    f = np.clip(speed / max_speed, 0, 1)
+    return np.stack([np.clip(2 - 2*f, 0, 1), np.clip(2*f, 0, 1), np.full(len(f), 0.1)], 1)
+
+def strip_quads(counts, speed, geometry, bin_len, max_speed):
+    """
+    Quads of the non-empty lane bins, colored by mean speed and blended with
+    the asphalt by density (full color at jam density).
+    """
+    row, lane, b = np.nonzero(counts)
+    n = counts[row, lane, b]
+    density = np.minimum(1.0, n*JAM_SPACING/bin_len)[:, None]
+    colors = (1 - density)*np.array(ASPHALT) + density*speed_colors(speed[row, lane, b], max_speed)
+
+    xc = (b + 0.5)*bin_len
+    yc = geometry.y_offset(row, lane) + LANE_WIDTH/2
+    m = len(xc)
+    return _quads(xc, yc, np.full(m, float(bin_len)), np.full(m, LANE_WIDTH*0.8),
+                  np.zeros((m, 4), dtype=np.float32), colors.astype(np.float32))
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+from assets import SPRITES, TYPE_IDS
+
+class RenderGeometryTest(unittest.TestCase):
+
+    class Conf:
+        road_len = 600
+        rows = 3
+        nb_lanes = 3
+
+    def test_vehicle_centers(self):
+        g = RoadGeometry(self.Conf)
+        x, y = g.vehicle_centers(np.array([50.0, 250.0]), np.array([0.0, 1.5]))
+        self.assertEqual(list(x), [50.0, 50.0])
+        self.assertEqual(y[0], ROAD_SPACING + LANE_WIDTH/2)
+        self.assertEqual(y[1], g.road_width + ROAD_SPACING + 1.5*LANE_WIDTH + LANE_WIDTH/2)
+
+    def test_vehicle_quads(self):
+        g = RoadGeometry(self.Conf)
+        car = Car(0, position=10.0)
+        truck = Truck(2, position=20.0)
+        truck.acceleration = -9.0
+        uv = np.zeros((len(SPRITES), 4), dtype=np.float32)
+        uv[TYPE_IDS['long_truck']] = (0.5, 0.0, 1.0, 1.0)
+
+        arr = vehicle_arrays([car, truck])
+        body, indicators = vehicle_quads(arr, g, uv)
+
+        self.assertEqual(body.shape, (8, VERTEX_SIZE))
+        self.assertEqual(indicators.shape, (8, VERTEX_SIZE))
+        # Truck body is 15m long and uses the long truck sprite.
+        self.assertAlmostEqual(body[5, 0] - body[4, 0], 15.0)
+        self.assertEqual(list(body[4, 2:4]), [0.5, 0.0])
+        # Braking truck indicator is yellow, centered on the truck.
+        self.assertEqual(list(indicators[4, 4:7]), [1.0, 1.0, np.float32(0.1)])
+        self.assertAlmostEqual((indicators[4, 0] + indicators[5, 0])/2, 20.0)
+
+    def test_viewport(self):
+        g = RoadGeometry(self.Conf)
+        vp = Viewport(g, 1000, 250)
+        self.assertEqual((vp.x0, vp.width), (0, g.row_length))
+
+        # The zoom center stays in place.
+        vp.zoom(4, 100.0, 10.0)
+        self.assertEqual((vp.x0, vp.width), (75.0, 50.0))
+        self.assertAlmostEqual(vp.to_world(500, 0)[0], 100.0)
+        vp.pan(-1000, 0)
+        self.assertEqual(vp.x0, 0)
+        self.assertEqual(list(vp.visible(np.array([10.0, 60.0]), np.array([vp.y0, vp.y0]))), [True, False])
+
+    def test_lane_bins(self):
+        g = RoadGeometry(self.Conf)
+        cars = [Car(1, position=p) for p in (10.0, 15.0, 250.0)]
+        for c, v in zip(cars, (10.0, 20.0, 30.0)):
+            c.velocity = v
+        counts, speed = lane_bins(vehicle_arrays(cars), g, 25)
+
+        self.assertEqual(counts.shape, (3, 3, 8))
+        self.assertEqual(counts[0, 1, 0], 2)
+        self.assertEqual(speed[0, 1, 0], 15.0)
+        self.assertEqual(counts[1, 1, 2], 1)
+        self.assertEqual(counts.sum(), 3)
+
+        quads = strip_quads(counts, speed, g, 25, 30.0)
+        self.assertEqual(quads.shape, (8, VERTEX_SIZE))
+
+if __name__ == '__main__':
+    unittest.main()
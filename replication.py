@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from equivalence import confidence_interval
+from headless import run_spec
+from scenario import read_scenario_file
+from sim_event_handler import ThroughPutHandler, TravelTimeHandler
+
+METRICS = ['travel_time', 'throughput']
+
+def run_replication(spec, seed, duration=300, warmup=60, antithetic=False, dt=0.1):
+    """
+    Run one replication of an experiment spec (see headless.run_spec) and
+    return the metrics and the control variate (number of spawn attempts)
+    with its expectation over the run's spawn_rate schedule.
+    """
+    traveltime = TravelTimeHandler()
+    throughput = ThroughPutHandler()
+    sim = run_spec(spec, duration, [traveltime, throughput], seed, antithetic, dt)
+
+    travel_times = [p[1] for p in traveltime.dict.values() if p[1] != 0 and p[0] >= warmup]
+    throughputs = throughput.nb_vehicles_list[int(warmup // throughput.interval):]
+    return {
+        'travel_time': np.mean(travel_times) if travel_times else np.nan,
+        'throughput': np.mean(throughputs) if throughputs else np.nan,
+        'spawn_attempts': sim._nb_spawn_attempts,
+        'expected_spawn_attempts': sim._expected_spawn_attempts,
+    }
+
+def _run_replication(args):
+    return run_replication(*args)
+
+def _jobs(spec, seeds, duration, warmup, antithetic):
+    if antithetic:
+        return [(spec, s, duration, warmup, a) for s in seeds for a in (False, True)]
+    return [(spec, s, duration, warmup, False) for s in seeds]
+
+def estimate(runs, metric, antithetic=False, control_variate=False):
+    """
+    Estimates of a metric, one per independent replication: the two runs of
+    an antithetic pair are averaged, and with control_variate the estimates
+    are corrected by c*(X - E[X]) with X the number of spawn attempts and c
+    the variance minimizing coefficient.
+    """
+    y = np.array([r[metric] for r in runs], dtype=float)
+    x = np.array([r['spawn_attempts'] for r in runs], dtype=float)
+    ex = np.array([r['expected_spawn_attempts'] for r in runs], dtype=float)
+
+    if antithetic:
+        y = (y[0::2] + y[1::2]) / 2
+        x = (x[0::2] + x[1::2]) / 2
+        ex = ex[0::2]
+
+    if control_variate and len(y) > 2 and np.var(x) > 0:
+        c = np.cov(y, x)[0, 1] / np.var(x, ddof=1)
+        y = y - c*(x - ex)
+
+    return y
+
+class ReplicationResult:
+
+    def __init__(self, metric, estimates):
+        self.metric = metric
+        self.estimates = estimates
+        self.mean, self.half_width = confidence_interval(estimates)
+
+    def __str__(self):
+        return "{}: {:.3f} ± {:.3f} ({} replications)".format(
+            self.metric, self.mean, self.half_width, len(self.estimates))
+
+def replicate(spec, metric, n, duration=300, warmup=60, antithetic=False,
+              control_variate=False, seed=0, processes=None):
+    """
+    Estimate a metric of an experiment spec from n runs. With antithetic the
+    n runs are n/2 antithetic pairs.
+    """
+    seeds = range(seed, seed + (n//2 if antithetic else n))
+    with Pool(processes) as pool:
+        runs = pool.map(_run_replication, _jobs(spec, seeds, duration, warmup, antithetic))
+    return ReplicationResult(metric, estimate(runs, metric, antithetic, control_variate))
+
+def compare_paired(spec_a, spec_b, metric, n, duration=300, warmup=60, crn=True,
+                   antithetic=False, control_variate=False, seed=0, processes=None):
+    """
+    Estimate metric(spec_b) - metric(spec_a). With crn both specs are run with
+    the same seeds (common random numbers), so the difference is estimated
+    from paired runs; otherwise spec_b gets its own seeds.
+    """
+    nb_seeds = n//2 if antithetic else n
+    seeds_a = range(seed, seed + nb_seeds)
+    seeds_b = seeds_a if crn else range(seed + nb_seeds, seed + 2*nb_seeds)
+
+    with Pool(processes) as pool:
+        runs_a = pool.map(_run_replication, _jobs(spec_a, seeds_a, duration, warmup, antithetic))
+        runs_b = pool.map(_run_replication, _jobs(spec_b, seeds_b, duration, warmup, antithetic))
+
+    ya = estimate(runs_a, metric, antithetic, control_variate)
+    yb = estimate(runs_b, metric, antithetic, control_variate)
+    return ReplicationResult(metric + ' difference', yb - ya)
+
+def main():
+    parser = argparse.ArgumentParser(description='Replicated runs with variance reduction.')
+    parser.add_argument('spec', help='experiment spec (scenario file with an optional "conf" section)')
+    parser.add_argument('spec_b', nargs='?', help='second spec, estimate the difference spec_b - spec')
+    parser.add_argument('--metric', default='travel_time', choices=METRICS)
+    parser.add_argument('-n', type=int, default=20, help='number of runs')
+    parser.add_argument('--duration', type=float, default=300)
+    parser.add_argument('--warmup', type=float, default=60)
+    parser.add_argument('--antithetic', action='store_true', help='use antithetic pairs')
+    parser.add_argument('--control-variate', action='store_true', help='correct with the spawn count')
+    parser.add_argument('--independent', action='store_true', help='no common random numbers for spec_b')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    spec = read_scenario_file(args.spec)
+    if args.spec_b:
+        result = compare_paired(spec, read_scenario_file(args.spec_b), args.metric, args.n,
+                                args.duration, args.warmup, not args.independent,
+                                args.antithetic, args.control_variate, args.seed)
+    else:
+        result = replicate(spec, args.metric, args.n, args.duration, args.warmup,
+                           args.antithetic, args.control_variate, args.seed)
+    print(result)
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+
+class EstimateTest(unittest.TestCase):
+
+    def _runs(self, y, x):
+        return [{'travel_time': yi, 'spawn_attempts': xi, 'expected_spawn_attempts': 100.0}
+                for yi, xi in zip(y, x)]
+
+    def test_antithetic_pairs(self):
+        runs = self._runs([1.0, 3.0, 2.0, 6.0], [90, 110, 95, 105])
+        self.assertEqual(list(estimate(runs, 'travel_time', antithetic=True)), [2.0, 4.0])
+
+    def test_control_variate(self):
+        rs = np.random.RandomState(0)
+        x = rs.poisson(100, 50).astype(float)
+        y = 30 + 0.5*(x - 100) + rs.normal(0, 0.5, 50)
+        runs = self._runs(y, x)
+
+        plain = estimate(runs, 'travel_time')
+        corrected = estimate(runs, 'travel_time', control_variate=True)
+        self.assertLess(np.var(corrected), np.var(plain) / 10)
+        self.assertAlmostEqual(np.mean(corrected), 30, delta=0.5)
+
+    def test_expected_spawn_attempts(self):
+        # The spawn rate goes from 3 to 6 cars/s half way: E[X] sums both pieces.
+        spec = {'conf': {'spawn_rate': 3.0, 'road_len': 200},
+                'events': [{'time': 10, 'action': 'spawn_rate', 'value': 6.0}]}
+        run = run_replication(spec, 0, duration=20, warmup=0)
+        piecewise = 100*(1 - np.exp(-0.3)) + 100*(1 - np.exp(-0.6))
+        self.assertAlmostEqual(run['expected_spawn_attempts'], piecewise, delta=0.5)
+        self.assertLess(run['expected_spawn_attempts'], 200*(1 - np.exp(-0.6)) - 10)
+        self.assertAlmostEqual(run['spawn_attempts'], piecewise, delta=4*np.sqrt(piecewise))
+
+if __name__ == "__main__":
+    main()
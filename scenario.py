@@ -0,0 +1,262 @@
+import heapq
+import json
+
+import sim_event_handler
+from sim_event_handler import SimEventHandler, SlowZoneEvHandler, IncidentEvHandler
+
+# Handler classes that can be declared by name in a scenario file.
+HANDLER_TYPES = {name: cls for name, cls in vars(sim_event_handler).items()
+                 if isinstance(cls, type) and issubclass(cls, SimEventHandler)}
+
+ACTIONS = ('enable', 'disable', 'spawn_rate', 'incident', 'speed_limit')
+
+class ScenarioEvHandler(SimEventHandler):
+    """
+    Simulation handler that plays back a scenario: a timeline of events that
+    are applied at given simulation times. It replaces the keyboard toggles of
+    the animation for headless and batch runs.
+
+    Supported events (all have a 'time' in seconds of simulated time):
+     - {"action": "enable"/"disable", "handler": name}
+     - {"action": "spawn_rate", "value": cars_per_sec}
+     - {"action": "incident", "start": m, "stop": m, "lanes": [..], "duration": s}
+     - {"action": "speed_limit", "start": m, "stop": m, "max_velocity": v}
+       (a max_velocity of null lifts the speed limit again)
+
+    Events are kept in a heap on time, so only the head of the queue is
+    looked at in each time step.
+    """
+
+    def __init__(self, events=(), handlers=None, duration=None):
+        self.duration = duration
+        self.log = []           # (sim_time, event) of all applied events
+        self._handlers = {}     # name -> handler
+        self._pending = []      # handlers not yet added to the simulation
+        self._queue = []
+        self._seq = 0
+        self._nb_incidents = 0
+        self._transient = set()     # names of the incidents and speed limits, their handlers are removed when disabled
+
+        for name, h in (handlers or {}).items():
+            self.register_handler(name, h, add=True)
+        for event in events:
+            self.schedule(event)
+
+    def register_handler(self, name, handler, add=False):
+        """
+        Make a handler available to 'enable'/'disable' events. If add is True
+        the handler is also added to the simulation running the scenario.
+        """
+        self._handlers[name] = handler
+        if add:
+            self._pending.append(handler)
+
+    def handler(self, name):
+        return self._handlers[name]
+
+    def schedule(self, event):
+        if event.get('action') not in ACTIONS:
+            raise ValueError("unknown scenario action: {}".format(event.get('action')))
+        heapq.heappush(self._queue, (float(event['time']), self._seq, event))
+        self._seq += 1
+
+    def before_time_step(self, dt, sim_time):
+        while self._pending:
+            self._sim.add_handler(self._pending.pop(0))
+
+        while self._queue and self._queue[0][0] <= sim_time:
+            _, _, event = heapq.heappop(self._queue)
+            self._apply(event, sim_time)
+            self.log.append((sim_time, event))
+
+    def _apply(self, event, sim_time):
+        action = event['action']
+
+        if action == 'enable' or action == 'disable':
+            self._enable(event['handler'], action == 'enable')
+        elif action == 'spawn_rate':
+            self._sim._conf.spawn_rate = event['value']
+        elif action == 'speed_limit':
+            self._speed_limit(event)
+        elif action == 'incident':
+            self._incident(event, sim_time)
+
+    def _enable(self, name, enabled):
+        h = self._handlers[name]
+        # A disabled incident or speed limit is over: its handler leaves the
+        # simulation, so that past events cost nothing per step.
+        if name in self._transient and enabled != h.enabled:
+            if enabled:
+                self._sim.add_handler(h)
+            else:
+                self._sim.remove_handler(h)
+        h.enabled = enabled
+
+    def _speed_limit(self, event):
+        name = event.get('name', 'speed_limit_{}_{}'.format(event['start'], event['stop']))
+        max_velocity = event.get('max_velocity')
+
+        if name in self._handlers:
+            h = self._handlers[name]
+        elif max_velocity is None:
+            return
+        else:
+            h = SlowZoneEvHandler(event['start'], event['stop'])
+            h.enabled = False       # added to the simulation by _enable
+            self._handlers[name] = h
+            self._transient.add(name)
+
+        if max_velocity is not None:
+            h._max_velocity = max_velocity
+        self._enable(name, max_velocity is not None)
+
+    def _incident(self, event, sim_time):
+        self._nb_incidents += 1
+        name = event.get('name', 'incident_{}'.format(self._nb_incidents))
+        lanes = event.get('lanes', range(self._sim._conf.nb_lanes))
+
+        h = IncidentEvHandler(event['start'], event['stop'], lanes)
+        if name in self._transient and self._handlers[name].enabled:
+            self._sim.remove_handler(self._handlers[name])
+        self._handlers[name] = h
+        self._transient.add(name)
+        self._sim.add_handler(h)
+
+        if event.get('duration') is not None:
+            self.schedule({'time': sim_time + event['duration'],
+                           'action': 'disable', 'handler': name})
+
+    def __str__(self):
+        return "{}: {} events left".format(self.__class__.__name__, len(self._queue))
+
+def scenario_from_dict(data):
+    """
+    Build a scenario from its dict representation:
+        {"duration": s,
+         "handlers": {name: {"type": cls_name, "args": {..}, "enabled": bool}},
+         "events": [..]}
+    """
+    handlers = {}
+    for name, spec in data.get('handlers', {}).items():
+        if spec['type'] not in HANDLER_TYPES:
+            raise ValueError("unknown handler type: {}".format(spec['type']))
+        h = HANDLER_TYPES[spec['type']](**spec.get('args', {}))
+        h.enabled = spec.get('enabled', True)
+        handlers[name] = h
+
+    return ScenarioEvHandler(data.get('events', []), handlers, data.get('duration'))
+
+def read_scenario_file(filename):
+    """ Read the dict representation of a scenario from a JSON or YAML (needs PyYAML) file. """
+    with open(filename) as f:
+        if filename.endswith('.yaml') or filename.endswith('.yml'):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def load_scenario(filename):
+    return scenario_from_dict(read_scenario_file(filename))
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+
+class ScenarioTest(unittest.TestCase):
+
+    def _sim(self, scenario):
+        from config import HeadlessConfig
+        from simulation import SimulationWithHandlers
+
+        return SimulationWithHandlers(HeadlessConfig(), [scenario])
+
+    def _run(self, sim, duration, dt=0.1):
+        for i in range(int(round(duration/dt))):
+            sim.time_step(dt)
+
+    def test_enable_disable(self):
+        zone = SlowZoneEvHandler(100, 200)
+        zone.enabled = False
+        scenario = ScenarioEvHandler([
+            {'time': 2.0, 'action': 'disable', 'handler': 'zone'},
+            {'time': 1.0, 'action': 'enable', 'handler': 'zone'},
+        ], {'zone': zone})
+        sim = self._sim(scenario)
+
+        self._run(sim, 1.5)
+        self.assertTrue(zone.enabled)
+        self.assertIn(zone, sim._handlers)
+
+        self._run(sim, 1.0)
+        self.assertFalse(zone.enabled)
+        self.assertEqual([e['action'] for t, e in scenario.log], ['enable', 'disable'])
+
+    def test_spawn_rate(self):
+        scenario = ScenarioEvHandler([{'time': 0.5, 'action': 'spawn_rate', 'value': 7}])
+        sim = self._sim(scenario)
+        self._run(sim, 1.0)
+        self.assertEqual(sim._conf.spawn_rate, 7)
+
+    def test_incident_duration(self):
+        scenario = ScenarioEvHandler([{'time': 0.2, 'action': 'incident', 'name': 'crash',
+            'start': 300, 'stop': 310, 'lanes': [0], 'duration': 1.0}])
+        sim = self._sim(scenario)
+
+        self._run(sim, 0.5)
+        self.assertTrue(scenario.handler('crash').enabled)
+        self._run(sim, 1.0)
+        self.assertFalse(scenario.handler('crash').enabled)
+        self.assertNotIn(scenario.handler('crash'), sim._handlers)
+
+    def test_incidents_removed(self):
+        scenario = ScenarioEvHandler([{'time': t, 'action': 'incident', 'start': 300, 'stop': 310,
+                                       'lanes': [0], 'duration': 0.5} for t in range(10)])
+        sim = self._sim(scenario)
+        self._run(sim, 9.3)
+        # Only the last incident is still going on, the others left the simulation.
+        incidents = [h for h in sim._handlers if isinstance(h, IncidentEvHandler)]
+        self.assertEqual(incidents, [scenario.handler('incident_10')])
+        self.assertEqual(len(scenario.handler('incident_1').simTimeList), 5)
+
+        # Enabled again by name, it comes back.
+        scenario.schedule({'time': 9.3, 'action': 'enable', 'handler': 'incident_1'})
+        self._run(sim, 0.2)
+        self.assertIn(scenario.handler('incident_1'), sim._handlers)
+
+    def test_speed_limit(self):
+        scenario = ScenarioEvHandler([
+            {'time': 0.0, 'action': 'speed_limit', 'name': 'sl', 'start': 0, 'stop': 600, 'max_velocity': 20},
+            {'time': 1.0, 'action': 'speed_limit', 'name': 'sl', 'start': 0, 'stop': 600, 'max_velocity': None},
+            {'time': 2.0, 'action': 'speed_limit', 'name': 'sl', 'start': 0, 'stop': 600, 'max_velocity': 15},
+        ])
+        sim = self._sim(scenario)
+        sl = lambda: [h for h in sim._handlers if isinstance(h, SlowZoneEvHandler)]
+
+        self._run(sim, 0.5)
+        self.assertEqual(scenario.handler('sl')._max_velocity, 20)
+        self.assertTrue(scenario.handler('sl').enabled)
+        self.assertEqual(sl(), [scenario.handler('sl')])
+        # Lifted, the speed limit leaves the simulation.
+        self._run(sim, 1.0)
+        self.assertFalse(scenario.handler('sl').enabled)
+        self.assertEqual(sl(), [])
+        # Set again, it comes back once.
+        self._run(sim, 1.0)
+        self.assertEqual(scenario.handler('sl')._max_velocity, 15)
+        self.assertEqual(sl(), [scenario.handler('sl')])
+
+    def test_from_dict(self):
+        scenario = scenario_from_dict({
+            'duration': 60,
+            'handlers': {'zone': {'type': 'SlowZoneEvHandler',
+                                  'args': {'start': 300, 'stop': 450, 'max_velocity': 7},
+                                  'enabled': False}},
+            'events': [{'time': 30, 'action': 'enable', 'handler': 'zone'}]})
+
+        self.assertEqual(scenario.duration, 60)
+        self.assertFalse(scenario.handler('zone').enabled)
+        self.assertRaises(ValueError, scenario.schedule, {'time': 0, 'action': 'explode'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from equivalence import confidence_interval
+from headless import make_sim
+from replication import METRICS, ReplicationResult, estimate, _run_replication
+from scenario import read_scenario_file
+from sim_event_handler import ThroughPutHandler, TravelTimeHandler
+
+class SequentialResult(ReplicationResult):
+
+    def __init__(self, metric, estimates, converged, label='replications'):
+        super().__init__(metric, estimates)
+        self.converged = converged
+        self.label = label
+
+    def __str__(self):
+        return "{}: {:.3f} ± {:.3f} ({} {}{})".format(
+            self.metric, self.mean, self.half_width, len(self.estimates), self.label,
+            '' if self.converged else ', target precision NOT reached')
+
+def relative_half_width(mean, half_width):
+    return half_width / abs(mean) if mean else np.inf
+
+def run_until_precision(spec, metric, target=0.05, min_runs=6, max_runs=500,
+                        duration=300, warmup=60, antithetic=False, control_variate=False,
+                        seed=0, processes=None, verbose=False):
+    """
+    Keep launching replications until the confidence interval of the metric
+    has a relative half width below target (or max_runs is reached), then
+    stop the workers. Runs are started in advance to keep all workers busy,
+    but only the finished runs with the lowest seeds are used, so the result
+    doesn't depend on the order in which runs finish.
+    """
+    def job(k):
+        if antithetic:
+            return (spec, seed + k//2, duration, warmup, k % 2 == 1)
+        return (spec, seed + k, duration, warmup, False)
+
+    pool = Pool(processes)
+    nb_workers = pool._processes
+    pending = {}
+    runs = []
+    next_run = 0
+    converged = False
+
+    try:
+        while len(runs) < max_runs:
+            while len(pending) < 2*nb_workers and next_run < max_runs:
+                pending[next_run] = pool.apply_async(_run_replication, (job(next_run),))
+                next_run += 1
+
+            runs.append(pending.pop(len(runs)).get())
+            if len(runs) < min_runs or (antithetic and len(runs) % 2):
+                continue
+
+            y = estimate(runs, metric, antithetic, control_variate)
+            mean, half_width = confidence_interval(y)
+            if verbose:
+                print('{:4d} runs: {:.3f} ± {:.3f}'.format(len(runs), mean, half_width))
+            if relative_half_width(mean, half_width) <= target:
+                converged = True
+                break
+    finally:
+        # Release the workers, also those still running unneeded replications.
+        pool.terminate()
+        pool.join()
+
+    return SequentialResult(metric, estimate(runs, metric, antithetic, control_variate), converged)
+
+def lag1_autocorrelation(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) < 3 or values.var() == 0:
+        return 0.0
+    d = values - values.mean()
+    return np.sum(d[1:]*d[:-1]) / np.sum(d*d)
+
+def merge_batches(values):
+    """ Halve the number of batches by averaging consecutive pairs. """
+    values = np.asarray(values, dtype=float)
+    n = len(values) // 2 * 2
+    return (values[0:n:2] + values[1:n:2]) / 2
+
+def batch_values(traveltime, metric, t0, t1, interval):
+    """ Value of the metric for the vehicles that left the road in [t0, t1). """
+    travel_times = [p[1] for p in traveltime.dict.values()
+                    if p[1] != 0 and t0 <= p[0] + p[1] < t1]
+    if metric == 'travel_time':
+        return np.mean(travel_times) if travel_times else np.nan
+    return len(travel_times) * interval / (t1 - t0)
+
+def batch_means_until_precision(spec, metric, target=0.05, batch_duration=60,
+                                warmup=60, min_batches=10, max_duration=36000,
+                                seed=0, dt=0.1, verbose=False):
+    """
+    Extend a single run batch by batch until the confidence interval of the
+    batch means has a relative half width below target. Whenever the batch
+    means are correlated (lag 1 autocorrelation above 0.2), consecutive
+    batches are merged so the intervals stay valid.
+    """
+    traveltime = TravelTimeHandler()
+    interval = ThroughPutHandler().interval
+    sim = make_sim(spec, [traveltime], seed)
+    steps_per_batch = int(round(batch_duration/dt))
+
+    for i in range(int(round(warmup/dt))):
+        sim.time_step(dt)
+
+    batches = []
+    size = 1            # number of original batches in a batch
+    converged = False
+    t = warmup
+    while t < max_duration:
+        for i in range(steps_per_batch):
+            sim.time_step(dt)
+        batches.append(batch_values(traveltime, metric, t, t + batch_duration, interval))
+        t += batch_duration
+
+        means = np.array(batches)
+        means = means[~np.isnan(means)]
+        for i in range(size.bit_length() - 1):
+            means = merge_batches(means)
+        if len(means) >= 2*min_batches and lag1_autocorrelation(means) > 0.2:
+            size *= 2
+            means = merge_batches(means)
+        if len(means) < min_batches:
+            continue
+
+        mean, half_width = confidence_interval(means)
+        if verbose:
+            print('{:7.0f} s, {:3d} batches of {:5.0f} s: {:.3f} ± {:.3f}'.format(
+                t, len(means), size*batch_duration, mean, half_width))
+        if relative_half_width(mean, half_width) <= target:
+            converged = True
+            break
+
+    return SequentialResult(metric, means, converged, 'batches of {:.0f} s'.format(size*batch_duration))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run until the confidence interval of a metric is narrow enough.')
+    parser.add_argument('spec', help='experiment spec (scenario file with an optional "conf" section)')
+    parser.add_argument('--metric', default='travel_time', choices=METRICS)
+    parser.add_argument('--target', type=float, default=0.02, help='relative half width of the CI')
+    parser.add_argument('--batch-means', action='store_true', help='extend one run instead of replicating')
+    parser.add_argument('--duration', type=float, default=300, help='simulated seconds per replication')
+    parser.add_argument('--warmup', type=float, default=60)
+    parser.add_argument('--max-runs', type=int, default=500)
+    parser.add_argument('--antithetic', action='store_true')
+    parser.add_argument('--control-variate', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    spec = read_scenario_file(args.spec)
+    if args.batch_means:
+        result = batch_means_until_precision(spec, args.metric, args.target, warmup=args.warmup,
+                                             seed=args.seed, verbose=True)
+    else:
+        result = run_until_precision(spec, args.metric, args.target, max_runs=args.max_runs,
+                                     duration=args.duration, warmup=args.warmup,
+                                     antithetic=args.antithetic,
+                                     control_variate=args.control_variate,
+                                     seed=args.seed, verbose=True)
+    print(result)
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+
+class BatchMeansTest(unittest.TestCase):
+
+    def test_merge_batches(self):
+        self.assertEqual(list(merge_batches([1, 3, 5, 7, 9])), [2, 6])
+
+    def test_lag1_autocorrelation(self):
+        rs = np.random.RandomState(0)
+        self.assertLess(abs(lag1_autocorrelation(rs.normal(size=1000))), 0.1)
+        self.assertGreater(lag1_autocorrelation(np.cumsum(rs.normal(size=1000))), 0.9)
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,9 @@ class SimEventHandler:
 
     It contains a bunch of methods that are called by the simulation at
     specific moments in the simulation. These methods should be overwritten by
-    sub-classes.
+    sub-classes. Spawns and despawns are notified in batches, by default the
+    batch methods call the per-vehicle ones. Vehicle objects are recycled
+    after their despawn, key per-vehicle data on vehicle.id.
     """
 
     enabled = True
@@ -32,6 +34,14 @@ class SimEventHandler:
     def before_vehicle_despawn(self, vehicle, sim_time):
         pass
 
+    def after_vehicles_spawn(self, vehicles, sim_time):
+        for v in vehicles:
+            self.after_vehicle_spawn(v, sim_time)
+
+    def before_vehicles_despawn(self, vehicles, sim_time):
+        for v in vehicles:
+            self.before_vehicle_despawn(v, sim_time)
+
     def __str__(self):
         return self.__class__.__name__
 
@@ -73,6 +83,25 @@ class SlowZoneEvHandler(SimEventHandler):
     def __str__(self):
         return "{}: max_velocity={}".format(self.__class__.__name__, self._max_velocity)
 
+class IncidentEvHandler(SlowZoneEvHandler):
+    """
+    Simulation handler that blocks some lanes at a certain section of the road,
+    e.g. a crash or a broken down truck. Vehicles in the blocked lanes have to
+    come to a full stop, the other lanes are not affected.
+    """
+
+    def __init__(self, start, stop, lanes):
+        super().__init__(start, stop, max_velocity=0)
+        self._lanes = set(lanes)
+        self._acc = -9
+
+    def after_vehicle_update(self, dt, vehicle):
+        if vehicle.lane in self._lanes:
+            super().after_vehicle_update(dt, vehicle)
+
+    def __str__(self):
+        return "{}: lanes={}".format(self.__class__.__name__, sorted(self._lanes))
+
 class StatsEvHandler(SimEventHandler):
     """
     Simulation handler that collects statistics.
@@ -84,6 +113,9 @@ class StatsEvHandler(SimEventHandler):
     def before_vehicle_despawn(self, vehicle, sim_time):
         self.unspawned_count += 1
 
+    def before_vehicles_despawn(self, vehicles, sim_time):
+        self.unspawned_count += len(vehicles)
+
     def __str__(self):
         return """
         Statistics summary:
@@ -180,11 +212,11 @@ class TravelTimeHandler(SimEventHandler):
         self.dict = {}
 
     def after_vehicle_spawn(self, vehicle, sim_time):
-        self.dict[vehicle] = (sim_time, 0)
+        self.dict[vehicle.id] = (sim_time, 0)
 
     def before_vehicle_despawn(self, vehicle, sim_time):
-        p = self.dict[vehicle]
-        self.dict[vehicle] = (p[0], sim_time - p[0])
+        p = self.dict[vehicle.id]
+        self.dict[vehicle.id] = (p[0], sim_time - p[0])
 
     def plot(self, subplot = False):
         times = []
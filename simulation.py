@@ -1,68 +1,174 @@
 import numpy as np
 
-from vehicle_container import VehicleContainer as Container
+from vehicle_container import VehicleContainer as Container, RingContainer
 from vehicle import Vehicle, HumanVehicle, Car, Truck, AutomaticCar
+from random_streams import RandomStreams
+from vehicle_pool import VehiclePool
 import pygame
 
 class Simulation:
 
     def __init__(self, conf):
         self._conf = conf
-        self._container = Container(conf.nb_lanes)
+        self._container = RingContainer(conf.nb_lanes, conf.road_len) if conf.ring \
+            else Container(conf.nb_lanes)
         self._sim_time = 0
         self._time_to_next_spawn = 0
+        self._nb_spawn_attempts = 0
+        self._expected_spawn_attempts = 0.0
+        self._rng = RandomStreams(conf.seed, conf.antithetic)
+        self._pool = VehiclePool(self._rng)
+        self._exited = []       # vehicles that left the road during the current step
+        # Lock-in chains need the zone model of AutomaticCar.
+        self._platoons = conf.platoons and 'AutomaticCar' not in (conf.car_following or {})
+        if conf.ring:
+            self._populate_ring()
 
     def time_step(self, dt):
+        # positions changed outside the vehicle updates (e.g. by handlers)
+        self._container.repair()
+
         # loop over all vehicles, update all vehicles
         # remove vehicles that are dead
+        platoons = self._platoons
         for v in self:
+            if platoons and self._advance_platoon_member(v, dt):
+                continue
             self.time_step_vehicle(v, dt)
-
-        self.try_spawn_vehicle()
+        if self._conf.lane_changes == 'synchronous':
+            self._resolve_lane_changes()
+        # The ring road keeps its vehicles.
+        if not self._conf.ring:
+            self._pool.release(self._despawn_beyond(self._conf.road_len))
+            # The exponential time to the next spawn is rounded up to a whole
+            # number of time steps, so a step holds an attempt with probability
+            # 1-exp(-spawn_rate*dt). Summed per step it follows rate changes.
+            self._expected_spawn_attempts += 1 - np.exp(-self._conf.spawn_rate*dt)
+            self.try_spawn_vehicle()
         self._sim_time += dt
 
     def time_step_vehicle(self, vehicle, dt):
         vehicle.update(self._conf, self._container, dt)
+        self._leave_road(vehicle)
 
+    def _leave_road(self, vehicle):
+        # Past the end of the road: out of the container right away, so that
+        # its followers don't see it. _despawn_beyond despawns it after the
+        # loop.
         if vehicle.position > self._conf.road_len:
-            self._despawn_vehicle(vehicle)
-
-    def _despawn_vehicle(self, vehicle):
-        self._container.despawn(vehicle)
+            self._container.despawn(vehicle)
+            self._exited.append(vehicle)
+
+    def _populate_ring(self):
+        """
+        Place all the vehicles of the ring road: conf.ring_density per km
+        and lane, evenly spaced, with the class mix of the spawned vehicles.
+        Their initial speed is drawn from speed_range, capped so that they
+        start at their safe distance from the bumper of the vehicle in front.
+        """
+        conf, rng = self._conf, self._rng
+        n = int(round(conf.ring_density * conf.road_len / 1000))
+        spacing = conf.road_len / max(n, 1)
+        vehicles = []
+        for lane in range(conf.nb_lanes):
+            lane_vehicles = []
+            for i in range(n):
+                p = rng.vehicle_class.rand()
+                cls = Car if p < 0.45 else AutomaticCar if p < 0.90 else Truck
+                vehicle = self._pool.acquire(cls, lane)
+                vehicle.position = i * spacing
+                lane_vehicles.append(vehicle)
+            # The leader of the last vehicle is the first one, across the seam.
+            for vehicle, leader in zip(lane_vehicles, lane_vehicles[1:] + lane_vehicles[:1]):
+                gap = max(0.0, spacing - (leader.length + vehicle.length)/2)
+                vehicle.velocity = min(gap / vehicle.safe_time, conf.speed_range[0] +
+                        rng.speed.rand()*(conf.speed_range[1] - conf.speed_range[0]))
+            vehicles += lane_vehicles
+        self._container.spawn_many(vehicles)
+
+    def _advance_platoon_member(self, vehicle, dt):
+        """
+        Platoons (Config.platoons): a vehicle locked in behind the vehicle in
+        front of it (already updated, vehicles go front to back) follows it
+        at the same velocity, so the chain behind a leader moves with the
+        leader's update. Members are advanced without their own neighbor
+        lookups and lane change decisions. Returns False for a vehicle that
+        is not in steady lock-in, which gets its normal update.
+        """
+        # Only steady vehicles can stay locked in, skip the lookup for the others.
+        if not getattr(vehicle, 'LOCK_IN', False) or vehicle.acceleration != 0:
+            return False
+        front = self._container.front(vehicle)
+        if front is None:
+            return False
+        position = vehicle.locked_position(front, dt)
+        if position is None:
+            return False
+        self.time_step_platoon_member(vehicle, front, position, dt)
+        return True
+
+    def time_step_platoon_member(self, vehicle, front, position, dt):
+        vehicle.advance_locked(self._conf, self._container, front, position, dt)
+        self._leave_road(vehicle)
+
+    def _resolve_lane_changes(self):
+        """ Apply the lane changes requested during the vehicle updates that don't conflict. """
+        vehicles = self._container.resolve_lane_changes()
+        for v in vehicles:
+            v.time_since_lane_change = 0.0
+        return vehicles
+
+    def _despawn_beyond(self, position):
+        """
+        Despawn the vehicles that left the road during the step and remove
+        any others past position (the end of the road) at once, returns them
+        to be recycled.
+        """
+        vehicles, self._exited = self._exited, []
+        vehicles.extend(self._container.despawn_beyond(position))
+        return vehicles
 
     def try_spawn_vehicle(self): #Tried to fix the spawning issue
+        rng = self._rng
 
         # If the time has come to spawn new vehicle.
         if self._sim_time >= self._time_to_next_spawn:
-            p = np.random.rand()
-            lane = np.random.randint(self._conf.nb_lanes)
+            self._nb_spawn_attempts += 1
+            p = rng.vehicle_class.rand()
+            lane = rng.lane.randint(self._conf.nb_lanes)
             if p < 0.45:
-                vehicle = Car(lane)
+                vehicle = self._pool.acquire(Car, lane)
             elif p >= 0.45 and p < 0.90:
-                vehicle = AutomaticCar(lane)
+                vehicle = self._pool.acquire(AutomaticCar, lane)
             else: # p >= 0.9
                 lane = self._conf.nb_lanes - 1
-                vehicle = Truck(lane)
+                vehicle = self._pool.acquire(Truck, lane)
 
-            vehicle.velocity = np.random.uniform(
-                        self._conf.speed_range[0],
-                        self._conf.speed_range[1])
+            # Both speed draws are always made, to keep the streams of paired
+            # runs in sync.
+            u1 = rng.speed.rand()
+            u2 = rng.speed.rand()
+            vehicle.velocity = self._conf.speed_range[0] + \
+                    u1*(self._conf.speed_range[1] - self._conf.speed_range[0])
 
             # If there already exists a vehicle in the lane.
             if self._container.last(lane):
                 last = self._container.last(lane)
-                # If the safe distance is not held, don't spawn.
-                if last.position < last.extremely_safe_distance * 2:
+                # If the safe distance is not held or the vehicles would
+                # overlap (positions are centers), don't spawn.
+                if last.position < last.extremely_safe_distance * 2 or \
+                        last.position < (last.length + vehicle.length)/2:
+                    self._pool.release([vehicle])
                     self._time_to_next_spawn = self._sim_time + \
-                        np.random.exponential(1/self._conf.spawn_rate)
+                        rng.spawn_time.exponential(1/self._conf.spawn_rate)
                     return
 
                 # Else if distance is below 5 safe_distances, spawn with
                 # velocity depending on car in front.
                 elif last.position < (last.extremely_safe_distance * last.velocity*10):
-                    vehicle.velocity = np.random.uniform(
-                        last.velocity*0.5,
-                        last.velocity*min(1, last.position/(2*last.extremely_safe_distance) + 1))
+                    low = last.velocity*0.5
+                    high = last.velocity*min(1, last.position/(2*last.extremely_safe_distance) + 1)
+                    vehicle.velocity = low + u2*(high - low)
 
 
             # Spawn the car.
@@ -75,10 +181,13 @@ class Simulation:
 
             # Find time to next car.
             self._time_to_next_spawn = self._sim_time + \
-                    np.random.exponential(1/self._conf.spawn_rate)
+                    rng.spawn_time.exponential(1/self._conf.spawn_rate)
 
     def _spawn_vehicle(self, vehicle):
-        self._container.spawn(vehicle)
+        self._spawn_vehicles([vehicle])
+
+    def _spawn_vehicles(self, vehicles):
+        self._container.spawn_many(vehicles)
 
     def find_vehicle(self, pos, lane, max_dist=10):
         v = Vehicle(lane)
@@ -89,6 +198,14 @@ class Simulation:
             return w
         return None
 
+    def stop_vehicles(self, pos):
+        """ Stop the vehicles close to pos in all lanes. """
+        for lane in range(self._conf.nb_lanes):
+            v = self.find_vehicle(pos, lane)
+            if v:
+                v.velocity = 0
+                v.acceleration = 0
+
     def __iter__(self):
         return iter(self._container)
 
@@ -99,16 +216,21 @@ class Simulation:
 
 class SimulationWithHandlers(Simulation):
 
-    def __init__(self, conf, handlers=[]):
+    def __init__(self, conf, handlers=None):
         super().__init__(conf)
-        self._handlers = handlers
+        self._handlers = list(handlers) if handlers else []
 
         for h in self._handlers:
             h._sim = self
 
     def add_handler(self, handler):
+        handler._sim = self
         self._handlers.append(handler)
 
+    def remove_handler(self, handler):
+        # A new list: the handler may be removed while the list is iterated.
+        self._handlers = [h for h in self._handlers if h is not handler]
+
     def time_step(self, dt):
         for h in self._handlers:
             h.before_time_step(dt, self._sim_time)
@@ -127,14 +249,25 @@ class SimulationWithHandlers(Simulation):
         for h in self._handlers:
             h.after_vehicle_update(dt, vehicle)
 
-    def _spawn_vehicle(self, vehicle):
-        super()._spawn_vehicle(vehicle)
+    def time_step_platoon_member(self, vehicle, front, position, dt):
+        for h in self._handlers:
+            h.before_vehicle_update(dt, vehicle)
+
+        super().time_step_platoon_member(vehicle, front, position, dt)
 
         for h in self._handlers:
-            h.after_vehicle_spawn(vehicle, self._sim_time)
+            h.after_vehicle_update(dt, vehicle)
+
+    def _spawn_vehicles(self, vehicles):
+        super()._spawn_vehicles(vehicles)
 
-    def _despawn_vehicle(self, vehicle):
         for h in self._handlers:
-            h.before_vehicle_despawn(vehicle, self._sim_time)
+            h.after_vehicles_spawn(vehicles, self._sim_time)
+
+    def _despawn_beyond(self, position):
+        vehicles = self._exited + self._container.beyond(position)
+        if vehicles:
+            for h in self._handlers:
+                h.before_vehicles_despawn(vehicles, self._sim_time)
 
-        super()._despawn_vehicle(vehicle)
+        return super()._despawn_beyond(position)
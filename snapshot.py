@@ -0,0 +1,242 @@
+import multiprocessing as mp
+import queue
+import time
+
+import numpy as np
+import pygame
+
+from render_geometry import VEHICLE_DTYPE, vehicle_arrays
+from scenario import ScenarioEvHandler, load_scenario
+from simulation import SimulationWithHandlers
+
+class SnapshotBuffer:
+    """
+    Double buffered vehicle snapshots (VEHICLE_DTYPE arrays) in shared
+    memory. The writer fills the back buffer without locking and swaps it to
+    the front under the lock; readers copy the front buffer under the lock,
+    so the writer never touches the buffer being copied.
+    """
+
+    # header fields
+    FRONT, COUNT, TIME, SEQUENCE = 0, 1, 3, 5
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._data = mp.RawArray('b', 2*capacity*VEHICLE_DTYPE.itemsize)
+        self._header = mp.RawArray('d', 6)   # front, count x2, sim time x2, sequence
+        self._lock = mp.Lock()
+        self._views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None
+        return state
+
+    def _buffers(self):
+        if self._views is None:
+            self._views = np.frombuffer(self._data, dtype=VEHICLE_DTYPE).reshape(2, self.capacity)
+        return self._views
+
+    def publish(self, arr, sim_time):
+        """ Publish a snapshot, vehicles beyond the capacity are dropped. """
+        h = self._header
+        n = min(len(arr), self.capacity)
+        back = 1 - int(h[self.FRONT])
+        self._buffers()[back][:n] = arr[:n]
+
+        with self._lock:
+            h[self.COUNT + back] = n
+            h[self.TIME + back] = sim_time
+            h[self.FRONT] = back
+            h[self.SEQUENCE] += 1
+
+    def read(self):
+        """ (sequence number, simulation time, copy of the latest snapshot) """
+        h = self._header
+        with self._lock:
+            front = int(h[self.FRONT])
+            n = int(h[self.COUNT + front])
+            return int(h[self.SEQUENCE]), h[self.TIME + front], self._buffers()[front][:n].copy()
+
+def _simulation_main(conf, handlers, named_handlers, scenario_file, buffer, commands, results):
+    if conf.sound:
+        pygame.mixer.init()
+
+    scenario = load_scenario(scenario_file) if scenario_file else ScenarioEvHandler()
+    for name, h in named_handlers.items():
+        scenario.register_handler(name, h)
+    sim = SimulationWithHandlers(conf, list(handlers) + [scenario])
+
+    dt = 1./conf.fps
+    publish_interval = 1./conf.fps
+    speedup = conf.speedup
+    wall_ref, sim_ref = time.perf_counter(), 0.0
+    last_publish = 0.0
+
+    while True:
+        try:
+            while True:
+                command = commands.get_nowait()
+                if command[0] == 'stop':
+                    for h in handlers:
+                        h._sim = None
+                    results.put(list(handlers))
+                    return
+                elif command[0] == 'event':
+                    scenario.schedule(dict(command[1], time=sim._sim_time))
+                elif command[0] == 'speedup':
+                    speedup = command[1]
+                    wall_ref, sim_ref = time.perf_counter(), sim._sim_time
+                elif command[0] == 'stop_vehicles':
+                    sim.stop_vehicles(command[1])
+        except queue.Empty:
+            pass
+
+        # Keep simulated time at speedup x wall clock time. When the
+        # simulation can't keep up, it runs as fast as it can without
+        # trying to catch up afterwards.
+        now = time.perf_counter()
+        target = sim_ref + speedup*(now - wall_ref)
+        behind = sim._sim_time + dt <= target
+        if behind:
+            sim.time_step(dt)
+            if target - sim._sim_time > 1.0:
+                wall_ref, sim_ref = now, sim._sim_time
+
+        if now - last_publish >= publish_interval:
+            buffer.publish(vehicle_arrays(sim), sim._sim_time)
+            last_publish = now
+        elif not behind:
+            time.sleep(min(dt/max(speedup, 1), publish_interval/4))
+
+class HandlerProxy:
+    """ Renderer side stand-in of a named handler of a SimulationProcess. """
+
+    def __init__(self, name, process, enabled):
+        self._name = name
+        self._process = process
+        self._enabled = enabled
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, enabled):
+        self._enabled = enabled
+        self._process.send_event({'action': 'enable' if enabled else 'disable', 'handler': self._name})
+
+    def __str__(self):
+        return self._name
+
+class SimulationProcess:
+    """
+    Runs a SimulationWithHandlers in its own process. It advances conf.speedup
+    simulated seconds per second in steps of 1/conf.fps, independent of the
+    frame rate of the renderer, and publishes snapshots to a SnapshotBuffer
+    that the renderer reads with vehicle_arrays().
+
+    The renderer controls the simulation with scenario events (handlers are
+    toggled through handler_proxy), changes of conf.speedup and
+    conf.spawn_rate are forwarded by sync_conf(). stop() returns the
+    handlers of the simulation with their recorded statistics.
+    """
+
+    def __init__(self, conf, handlers=(), named_handlers=None, scenario_file=None, capacity=4096):
+        self._conf = conf
+        self._speedup = conf.speedup
+        self._spawn_rate = conf.spawn_rate
+        self._named = dict(named_handlers or {})
+        self.sim_time = 0.0
+        self.buffer = SnapshotBuffer(capacity)
+        self._commands = mp.Queue()
+        self._results = mp.Queue()
+        self._process = mp.Process(target=_simulation_main, daemon=True,
+                                   args=(conf, list(handlers), self._named, scenario_file,
+                                         self.buffer, self._commands, self._results))
+
+    def start(self):
+        self._process.start()
+        return self
+
+    def stop(self, timeout=10):
+        self._commands.put(('stop',))
+        handlers = self._results.get(timeout=timeout)
+        self._process.join(timeout)
+        return handlers
+
+    def send_event(self, event):
+        self._commands.put(('event', event))
+
+    def handler_proxy(self, name):
+        return HandlerProxy(name, self, self._named[name].enabled)
+
+    def sync_conf(self):
+        """ Forward the changes of conf.speedup and conf.spawn_rate (keyboard). """
+        if self._conf.speedup != self._speedup:
+            self._speedup = self._conf.speedup
+            self._commands.put(('speedup', self._speedup))
+        if self._conf.spawn_rate != self._spawn_rate:
+            self._spawn_rate = self._conf.spawn_rate
+            self.send_event({'action': 'spawn_rate', 'value': self._spawn_rate})
+
+    def stop_vehicles(self, pos):
+        self._commands.put(('stop_vehicles', pos))
+
+    def vehicle_arrays(self):
+        seq, self.sim_time, arr = self.buffer.read()
+        return arr
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+from config import HeadlessConfig
+from sim_event_handler import SlowZoneEvHandler, ThroughPutHandler
+from vehicle import Car
+
+class SnapshotBufferTest(unittest.TestCase):
+
+    def test_double_buffer(self):
+        buffer = SnapshotBuffer(capacity=2)
+        self.assertEqual(len(buffer.read()[2]), 0)
+
+        buffer.publish(vehicle_arrays([Car(0, 10.0)]), 1.0)
+        buffer.publish(vehicle_arrays([Car(0, 20.0), Car(1, 30.0), Car(2, 40.0)]), 2.0)
+        seq, t, arr = buffer.read()
+        self.assertEqual((seq, t), (2, 2.0))
+        self.assertEqual(list(arr['position']), [20.0, 30.0])
+
+        # The copy is not changed by later snapshots.
+        buffer.publish(vehicle_arrays([]), 3.0)
+        self.assertEqual(list(arr['position']), [20.0, 30.0])
+        self.assertEqual(len(buffer.read()[2]), 0)
+
+class SimulationProcessTest(unittest.TestCase):
+
+    class Conf(HeadlessConfig):
+        speedup = 20
+        seed = 1
+
+    def test_run(self):
+        throughput = ThroughPutHandler()
+        zone = SlowZoneEvHandler(300, 450, max_velocity=7)
+        zone.enabled = False
+        process = SimulationProcess(self.Conf(), [throughput, zone], {'zone': zone}).start()
+        try:
+            process.handler_proxy('zone').enabled = True
+            deadline = time.time() + 10
+            while process.sim_time < 30 and time.time() < deadline:
+                arr = process.vehicle_arrays()
+                time.sleep(0.05)
+            self.assertGreater(len(arr), 0)
+        finally:
+            throughput, zone = process.stop()
+
+        self.assertGreaterEqual(process.sim_time, 30)
+        self.assertTrue(zone.enabled)
+        self.assertGreater(sum(throughput.nb_vehicles_list), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import json
+import struct
+
+import numpy as np
+
+from render_geometry import VEHICLE_DTYPE, vehicle_arrays
+from sim_event_handler import SimEventHandler
+
+# File layout: the VEHICLE_DTYPE records of all frames, followed by a JSON
+# index (configuration, time and number of vehicles of every frame) and the
+# length of the index as 8 bytes.
+FOOTER = struct.Struct('<Q')
+CONF_FIELDS = ['road_len', 'rows', 'nb_lanes', 'speed_range']
+
+class TrajectoryRecorder(SimEventHandler):
+    """
+    Simulation handler that records a snapshot of all vehicles every interval
+    seconds of simulated time to a trajectory file, for offline rendering
+    (see export.py). Frames are written as they are recorded, so the memory
+    use doesn't grow with the length of the run. close() writes the index.
+    """
+
+    def __init__(self, filename, interval=1/30):
+        self.filename = filename
+        self.interval = interval
+        self._file = open(filename, 'wb')
+        self._times = []
+        self._counts = []
+        self._conf = None
+        self._next_time = interval
+
+    def after_time_step(self, dt, sim_time):
+        if sim_time + 1e-9 < self._next_time:
+            return
+        if self._conf is None:
+            self._conf = {f: getattr(self._sim._conf, f) for f in CONF_FIELDS}
+
+        arr = vehicle_arrays(self._sim)
+        self._file.write(arr.tobytes())
+        self._times.append(sim_time)
+        self._counts.append(len(arr))
+        self._next_time = (np.floor(sim_time/self.interval + 1e-6) + 1) * self.interval
+
+    def close(self):
+        if self._file.closed:
+            return
+        index = json.dumps({'conf': self._conf, 'interval': self.interval,
+                            'times': self._times, 'counts': self._counts}).encode()
+        self._file.write(index)
+        self._file.write(FOOTER.pack(len(index)))
+        self._file.close()
+
+    def __str__(self):
+        return 'TrajectoryRecorder({}, {} frames)'.format(self.filename, len(self._times))
+
+class Trajectory:
+    """ A recorded trajectory file, frames are memory mapped. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            f.seek(-FOOTER.size, 2)
+            end = f.tell()
+            size, = FOOTER.unpack(f.read(FOOTER.size))
+            f.seek(end - size)
+            index = json.loads(f.read(size).decode())
+
+        self.conf = type('TrajectoryConf', (), index['conf'] or {})
+        self.interval = index['interval']
+        self.times = np.array(index['times'])
+        counts = np.array(index['counts'], dtype=np.int64)
+        self._offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        nb_records = int(self._offsets[-1])
+        self._records = np.memmap(filename, dtype=VEHICLE_DTYPE, mode='r', shape=(nb_records,)) \
+                        if nb_records else np.empty(0, dtype=VEHICLE_DTYPE)
+
+    def __len__(self):
+        return len(self.times)
+
+    def frame(self, i):
+        return self._records[self._offsets[i]:self._offsets[i+1]]
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import os
+import tempfile
+import unittest
+from config import HeadlessConfig
+from simulation import SimulationWithHandlers
+
+class TrajectoryTest(unittest.TestCase):
+
+    class Conf(HeadlessConfig):
+        seed = 2
+
+    def test_record(self):
+        fd, filename = tempfile.mkstemp(suffix='.traj')
+        os.close(fd)
+        try:
+            recorder = TrajectoryRecorder(filename, interval=0.5)
+            sim = SimulationWithHandlers(self.Conf(), [recorder])
+            for i in range(100):
+                sim.time_step(0.1)
+                if i == 79:
+                    last = vehicle_arrays(sim)
+            recorder.close()
+
+            traj = Trajectory(filename)
+            self.assertEqual(len(traj), 20)
+            self.assertAlmostEqual(traj.times[1], 1.0)
+            self.assertEqual(traj.conf.road_len, self.Conf.road_len)
+            self.assertTrue(np.array_equal(traj.frame(15), last))
+        finally:
+            os.remove(filename)
+
+if __name__ == '__main__':
+    unittest.main()
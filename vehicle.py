@@ -1,19 +1,24 @@
 import numpy as np
-import time
 
-import random
 import pygame
 
+from assets import TYPE_IDS
+from random_streams import GLOBAL_STREAMS
+
+LANE_CHANGE_COOLDOWN = 5.0 # seconds of simulated time between two lane changes
+
 class Vehicle:
     VEHICLE_TYPES = ["tesla", "car", "black_car", "yellow_car", "police_car", "red_truck", "ambulance"]
 
-    def __init__(self, lane, position=0.0):
+    def __init__(self, lane, position=0.0, rng=None):
         self.lane = lane
         self.position = position # meter
         self.velocity = 0.0      # meter/sec
         self.acceleration = 0.0  # meter/sec²
 
-        self.type = random.choice(self.VEHICLE_TYPES)
+        self._rng = rng if rng else GLOBAL_STREAMS
+        self.type = self._rng.vehicle_type.choice(self.VEHICLE_TYPES)
+        self.type_id = TYPE_IDS[self.type]   # sprite index in the atlas
         self.emergency = 0
 
     def __lt__(self, other):
@@ -33,7 +38,7 @@ class Vehicle:
         if front and abs(front.position-new_position) < .99*self.extremely_safe_distance:
             self.velocity = front.velocity
             self.acceleration = front.acceleration
-            self.position = front.position - self.extremely_safe_distance
+            container.move(self, front.position - self.extremely_safe_distance)
 
             self.emergency = conf.fps
 
@@ -44,7 +49,7 @@ class Vehicle:
                 scream = pygame.mixer.Sound('data/wilhem.wav')
                 scream.play()
         else:
-            self.position = new_position
+            container.move(self, new_position)
             self.velocity = new_velocity
             self.emergency = max(0, self.emergency-1)
 
@@ -60,32 +65,49 @@ class Vehicle:
 #    [X]lf - left front      [X]lb - left back
 
 class HumanVehicle(Vehicle):
-
-    def __init__(self, lane, position=0.0):
-        super().__init__(lane, position)
-
-    def _enough_room(self, container, location):
-        d = 0
-
-        if location[1] == 'front' and location[0] == 'left':
-            v = container.left_front(self)
-            d = v.position - self.position if v else None
-        elif location[1] == 'front' and location[0] == 'right':
-            v = container.right_front(self)
-            d = v.position - self.position if v else None
-        elif location[1] == 'back'  and location[0] == 'left':
-            v = container.left_back(self)
-            d = self.position - v.position if v else None
-        elif location[1] == 'back'  and location[0] == 'right':
-            v = container.right_back(self)
-            d = self.position - v.position if v else None
-
-        if d is None:
-            return True
-        elif d > max(v.length, self.HV_K*v.safe_distance):
-            return True
-        else:
-            return False
+    LOCK_IN = False     # AutomaticCar locks in behind a leader at its desired velocity
+
+    def __init__(self, lane, position=0.0, rng=None):
+        super().__init__(lane, position, rng)
+        self._kernel_params = None
+        self._car_following = None
+
+    def kernel_params(self):
+        """ The constant driver parameters, as passed to kernels.acceleration. """
+        if self._kernel_params is None:
+            self._kernel_params = (self.HV_K, self.HV_K1, self.HV_K2, getattr(self, 'HV_K3', 0.0),
+                                   self.HV_L, getattr(self, 'HV_L2', 0.0), self.HV_A0,
+                                   self.HV_AMAX, self.HV_BRAKING, self.LOCK_IN)
+        return self._kernel_params
+
+    def car_following(self, name):
+        """ (model, parameters) of the car-following model name for this driver (car_following.py). """
+        if self._car_following is None or self._car_following[0].name != name:
+            import car_following    # not at the top: its tests import this module
+            model = car_following.model(name)
+            self._car_following = (model, model.params(self))
+        return self._car_following
+
+    def _enough_room(self, v, d):
+        """ The gap d to neighbor v (None if there is none) is large enough. """
+        return d is None or d > max(v.length, self.HV_K*v.safe_distance)
+
+    def _lane_change_sides(self, container, df, p):
+        """
+        Candidate filter: whether a change to the (right, left) lane is
+        possible at all this step, given the draw p. Cheap tests on the
+        vehicle itself, so that vehicles in free flow or in their cooldown
+        skip the lateral neighbor lookups and the probabilities. prob_left is
+        0 without a close enough vehicle in front, and at most
+        (safe_distance/df)**(3/4) otherwise.
+        """
+        if not (self.time_since_lane_change > LANE_CHANGE_COOLDOWN and self.velocity > 3
+                and self.position > 3*self.safe_distance):
+            return False, False
+        return (container.lane_open(self.lane+1, self.position),
+                bool(df and df < self.HV_K1*self.safe_distance)
+                and p < (self.safe_distance/df)**(3/4)
+                and container.lane_open(self.lane-1, self.position))
 
 
     def update(self, conf, container, dt):
@@ -105,49 +127,73 @@ class HumanVehicle(Vehicle):
         vf = veh_f.velocity if veh_f else None
         df = veh_f.position  - self.position if veh_f else None
 
-        veh_b = container.back(self)
-        db = self.position - veh_b.position if veh_b else None
-
-        veh_lf = container.left_front(self)
-        vlf = veh_lf.velocity if veh_lf else None
-        dlf = veh_lf.position - self.position if veh_lf else None
-
-        veh_lb = container.left_back(self)
-        vlb = veh_lb.velocity if veh_lb else None
-        dlb = self.position - veh_lb.position if veh_lb else None
-
-        veh_rf = container.right_front(self)
-        vrf = veh_rf.velocity if veh_rf else None
-        drf = veh_rf.position - self.position if veh_rf else None
-
-        veh_rb = container.right_back(self)
-        drb = self.position - veh_rb.position if veh_rb else None
-        vrb = veh_rb.velocity if veh_rb else None
-
-        p = np.random.rand()
-        p_right = self.prob_right(container, conf, df, vf, db, vrf, drf, vrb, drb)
-        p_left = self.prob_left(container, conf, af, vf, df, dlf, vlf, dlb, vlb)
+        # Drawn by every vehicle, candidate or not, to keep the random streams.
+        p = self._rng.lane_change.rand()
+        if conf.kernels:
+            k = _kernels or _load_kernels()
 
         #NEW ONLY SWITCH IF THEY ARE ABOVE 3 SAFE_DISTANCES #####
-        if time.time() - self.last_lane_change > (5.0/conf.speedup) and self.velocity > 3:
-            if (p < p_right) \
-                and (self.lane+1 < conf.nb_lanes) \
-                and (self.position > (3 * self.safe_distance)) \
-                and (drf is None or drf > self.safe_distance) \
-                and (drb is None or drb > veh_rb.safe_distance):
-                self.lane += 1
-                container.notify_lane_change(self, self.lane-1)
-                self.last_lane_change = time.time()
-            elif (p < p_left) \
-                and (self.lane > 0) \
-                and (self.position > (3 * self.safe_distance)) \
-                and (dlf is None or dlf > self.safe_distance) \
-                and (dlb is None or dlb > veh_lb.safe_distance):
-                self.lane -= 1
-                container.notify_lane_change(self, self.lane+1)
-                self.last_lane_change = time.time()
+        self.time_since_lane_change += dt
+        right, left = self._lane_change_sides(container, df, p)
+        if right:
+            veh_rf = container.right_front(self)
+            vrf = veh_rf.velocity if veh_rf else None
+            drf = veh_rf.position - self.position if veh_rf else None
+
+            veh_rb = container.right_back(self)
+            drb = self.position - veh_rb.position if veh_rb else None
+            vrb = veh_rb.velocity if veh_rb else None
+
+            if conf.kernels:
+                p_right = k.prob_right(self.velocity, self.safe_distance, self.epsilon, self.HV_K,
+                                       _nan(vrf), _nan(drf), *_size(veh_rf), _nan(drb), *_size(veh_rb))
+            else:
+                veh_b = container.back(self)
+                db = self.position - veh_b.position if veh_b else None
+                p_right = self.prob_right(conf, df, vf, db, veh_rf, vrf, drf, veh_rb, vrb, drb)
+        if left:
+            veh_lf = container.left_front(self)
+            vlf = veh_lf.velocity if veh_lf else None
+            dlf = veh_lf.position - self.position if veh_lf else None
+
+            veh_lb = container.left_back(self)
+            vlb = veh_lb.velocity if veh_lb else None
+            dlb = self.position - veh_lb.position if veh_lb else None
+
+            if conf.kernels:
+                p_left = k.prob_left(self.velocity, self.safe_distance, self.desired_velocity,
+                                     self.epsilon, self.HV_K, self.HV_K1, _nan(vf), _nan(df),
+                                     _nan(vlf), _nan(dlf), *_size(veh_lf),
+                                     _nan(vlb), _nan(dlb), *_size(veh_lb))
+            else:
+                p_left = self.prob_left(conf, af, vf, df, veh_lf, dlf, vlf, veh_lb, dlb, vlb)
+
+        if right and (p < p_right) \
+            and (drf is None or drf > self.safe_distance) \
+            and (drb is None or drb > veh_rb.safe_distance):
+            self.change_lane(conf, container, self.lane+1)
+        elif left and (p < p_left) \
+            and (dlf is None or dlf > self.safe_distance) \
+            and (dlb is None or dlb > veh_lb.safe_distance):
+            self.change_lane(conf, container, self.lane-1)
         #########################################################
 
+        self._animate_lane_change()
+
+        model = conf.car_following.get(type(self).__name__) if conf.car_following else None
+        if model:
+            model, params = self.car_following(model)
+            acc = model.acceleration(self.velocity, _nan(vf), _nan(df),
+                                     veh_f.length if veh_f else np.nan, *params)
+        elif conf.kernels:
+            acc, self.velocity, self.safe_distance = k.acceleration(
+                self.velocity, self.acceleration, self.safe_distance, self.desired_velocity,
+                self.epsilon, *self.kernel_params(), _nan(af), _nan(vf), _nan(df))
+        else:
+            acc = self.calc_acceleration(conf, af, vf, df)
+        self.acceleration = min(self.HV_AMAX, acc)
+
+    def _animate_lane_change(self):
         ### ANIMATION FOR LANE CHANGING
         if abs(self.animlane - self.lane) > 0.1:
             if self.animlane < self.lane:
@@ -157,26 +203,36 @@ class HumanVehicle(Vehicle):
         else:
             self.animlane = self.lane
 
-        acc = self.calc_acceleration(conf, af, vf, df)
-        self.acceleration = min(self.HV_AMAX, acc)
+    def change_lane(self, conf, container, lane):
+        """
+        Change to lane now, or only request it if conf.lane_changes is
+        'synchronous': the simulation resolves the requests of all vehicles
+        after their updates.
+        """
+        if conf.lane_changes == 'synchronous':
+            container.request_lane_change(self, lane)
+        else:
+            old_lane, self.lane = self.lane, lane
+            container.notify_lane_change(self, old_lane)
+            self.time_since_lane_change = 0.0
 
-    def prob_left(self, container, conf, af, vf, df, dlf, vlf, dlb, vlb):
+    def prob_left(self, conf, af, vf, df, veh_lf, dlf, vlf, veh_lb, dlb, vlb):
         p = 0
         if (df and df < self.HV_K1*self.safe_distance \
             and (self.desired_velocity - self.velocity > self.epsilon or self.desired_velocity - vf > self.epsilon) \
-            and self._enough_room(container, ('left','front')) \
-            and self._enough_room(container, ('left','back')) \
+            and self._enough_room(veh_lf, dlf) \
+            and self._enough_room(veh_lb, dlb) \
             and (vlf is None or (self.velocity <= vlf or dlf >= self.HV_K1*self.safe_distance))
             and (vlb is None or (self.velocity >= vlb or dlb >= self.HV_K1*self.safe_distance))):
             p = (self.safe_distance/df)**(3/4)  # P(left|state)
         return p
 
-    def prob_right(self, container, conf, df, vf, db, vrf, drf, vrb, drb):
+    def prob_right(self, conf, df, vf, db, veh_rf, vrf, drf, veh_rb, vrb, drb):
         p = 0
 
         if (vrf is None or (self.velocity - vrf < self.epsilon or drf > self.HV_K*self.safe_distance)) \
-            and self._enough_room(container, ('right','front')) \
-            and self._enough_room(container, ('right','back')):
+            and self._enough_room(veh_rf, drf) \
+            and self._enough_room(veh_rb, drb):
 
             p = 0.9
 
@@ -223,36 +279,54 @@ class HumanVehicle(Vehicle):
 
 
 
+NAN = float('nan')
+_kernels = None
+
+def _load_kernels():
+    global _kernels
+    import kernels      # not at the top: the tests of kernels.py import this module
+    _kernels = kernels
+    return kernels
+
+def _nan(x):
+    """ Missing neighbors are NaN for the kernels. """
+    return NAN if x is None else x
+
+def _size(vehicle):
+    return (vehicle.length, vehicle.safe_distance) if vehicle else (NAN, NAN)
+
+
 class Car(HumanVehicle):
 
-    def __init__(self, lane, position=0.0):
+    def __init__(self, lane, position=0.0, rng=None):
+        rng = rng if rng else GLOBAL_STREAMS
         self.HV_K    = 1.4  # distance factor
         self.HV_K1   = 3.0  # scaling factors on safety distance ds to separate space to...
         self.HV_K2   = 1.8  # ... car in front into behavioral zones.
         self.HV_A0   = 1.0  # small constant acceleration to reach desired velocity
-        self.HV_L    = np.random.uniform(1, 20)  # no idea what this is
-        self.HV_AMAX = np.random.uniform(2.5, 4)  # maximum acceleration (0-100 in about 7 seconds)
+        self.HV_L    = rng.driver.uniform(1, 20)  # no idea what this is
+        self.HV_AMAX = rng.driver.uniform(2.5, 4)  # maximum acceleration (0-100 in about 7 seconds)
         self.HV_BRAKING = 9.0
         self.length = 4.0
-        self.extremely_safe_distance = np.random.uniform(2.5, 4)   # meter
+        self.extremely_safe_distance = rng.driver.uniform(2.5, 4)   # meter
         self.safe_distance = self.extremely_safe_distance
 
-        super().__init__(lane, position)
+        super().__init__(lane, position, rng)
 
-        self.desired_velocity = np.random.uniform(30.0, 35.0)
+        self.desired_velocity = rng.driver.uniform(30.0, 35.0)
         self.safe_time = 0.9 # seconds, 7m/(30m/s) = 0.23333... s
-        self.epsilon = np.random.uniform(2.0, 10.0) # sensitivity to speed up
+        self.epsilon = rng.driver.uniform(2.0, 10.0) # sensitivity to speed up
         self.animlane = self.lane
-        self.last_lane_change = time.time()
+        self.time_since_lane_change = 0.0
 
     def update(self, conf, container, dt):
         super().update(conf, container, dt)
 
-    def prob_left(self, container, conf, af, vf, df, dlf, vlf, dlb, vlb):
-        return super().prob_left(container, conf, af, vf, df, dlf, vlf, dlb, vlb)
+    def prob_left(self, conf, af, vf, df, veh_lf, dlf, vlf, veh_lb, dlb, vlb):
+        return super().prob_left(conf, af, vf, df, veh_lf, dlf, vlf, veh_lb, dlb, vlb)
 
-    def prob_right(self, container, conf, df, vf, db, vrf, drf, vrb, drb):
-        return super().prob_right(container, conf, df, vf, db, vrf, drf, vrb, drb)
+    def prob_right(self, conf, df, vf, db, veh_rf, vrf, drf, veh_rb, vrb, drb):
+        return super().prob_right(conf, df, vf, db, veh_rf, vrf, drf, veh_rb, vrb, drb)
 
     def calc_acceleration(self, conf, af, vf, df):
         return super().calc_acceleration(conf, af, vf, df)
@@ -260,43 +334,47 @@ class Car(HumanVehicle):
 
 class Truck(HumanVehicle):
 
-    def __init__(self, lane, position=0.0):
+    def __init__(self, lane, position=0.0, rng=None):
+        rng = rng if rng else GLOBAL_STREAMS
         self.HV_K    = 2.0  # distance factor
         self.HV_K1   = 2.6  # scaling factors on safety distance ds to separate space to...
         self.HV_K2   = 2.2  # ... car in front into behavioral zones.
         self.HV_A0   = 1.0  # small constant acceleration to reach desired velocity
         self.HV_L    = 1.0  # no idea what this is
-        self.HV_AMAX = np.random.uniform(1, 2)  # maximum acceleration (0-100 in about 7 seconds)
+        self.HV_AMAX = rng.driver.uniform(1, 2)  # maximum acceleration (0-100 in about 7 seconds)
         self.HV_BRAKING = 5.0
         self.length = 15.0
-        self.extremely_safe_distance = np.random.uniform(8, 9)
+        self.extremely_safe_distance = rng.driver.uniform(8, 9)
         self.safe_distance = self.extremely_safe_distance
 
-        super().__init__(lane, position)
+        super().__init__(lane, position, rng)
 
-        self.desired_velocity = np.random.uniform(18.0, 22.0)
+        self.desired_velocity = rng.driver.uniform(18.0, 22.0)
         self.safe_time = 2.2 # seconds, 7m/(30m/s) = 0.23333... s
-        self.epsilon = np.random.uniform(1.0, 3.0) # sensitivity to speed up
+        self.epsilon = rng.driver.uniform(1.0, 3.0) # sensitivity to speed up
         self.animlane = self.lane
-        self.last_lane_change = time.time()
+        self.time_since_lane_change = 0.0
         self.type = 'long_truck'
+        self.type_id = TYPE_IDS[self.type]
 
     def update(self, conf, container, dt):
         super().update(conf, container, dt)
 
-    def prob_left(self, container, conf, af, vf, df, dlf, vlf, dlb, vlb):
-        return super().prob_left(container, conf, af, vf, df, dlf, vlf, dlb, vlb)
+    def prob_left(self, conf, af, vf, df, veh_lf, dlf, vlf, veh_lb, dlb, vlb):
+        return super().prob_left(conf, af, vf, df, veh_lf, dlf, vlf, veh_lb, dlb, vlb)
 
-    def prob_right(self, container, conf, df, vf, db, vrf, drf, vrb, drb):
-        return super().prob_right(container, conf, df, vf, db, vrf, drf, vrb, drb)
+    def prob_right(self, conf, df, vf, db, veh_rf, vrf, drf, veh_rb, vrb, drb):
+        return super().prob_right(conf, df, vf, db, veh_rf, vrf, drf, veh_rb, vrb, drb)
 
     def calc_acceleration(self, conf, af, vf, df):
         return super().calc_acceleration(conf, af, vf, df)
 
 
 class AutomaticCar(HumanVehicle):
+    LOCK_IN = True
 
-    def __init__(self, lane, position=0.0):
+    def __init__(self, lane, position=0.0, rng=None):
+        rng = rng if rng else GLOBAL_STREAMS
         self.HV_K    = 1.4  # AUTOMATIC CAR!
         self.HV_K1   = 3.0  # scaling factors on safety distance ds to separate space to...
         self.HV_K2   = 1.8  # ... car in front into behavioral zones.
@@ -304,29 +382,68 @@ class AutomaticCar(HumanVehicle):
         self.HV_A0   = 1.0  # small constant acceleration to reach desired velocity
         self.HV_L    = 10  # no idea what this is
         self.HV_L2    = 50  # no idea what this is
-        self.HV_AMAX = np.random.uniform(2.5, 4)  # maximum acceleration (0-100 in about 7 seconds)
+        self.HV_AMAX = rng.driver.uniform(2.5, 4)  # maximum acceleration (0-100 in about 7 seconds)
         self.HV_BRAKING = 9.0
         self.length = 4.0
         self.extremely_safe_distance = 4.0     # meter
         self.safe_distance = self.extremely_safe_distance
         self.type = 'tesla'
 
-        super().__init__(lane, position)
+        super().__init__(lane, position, rng)
 
-        self.desired_velocity = np.random.uniform(30.0, 35.0)
+        self.desired_velocity = rng.driver.uniform(30.0, 35.0)
         self.safe_time = 0.9 # seconds, 7m/(30m/s) = 0.23333... s
-        self.epsilon = np.random.uniform(2.0, 10.0) # sensitivity to speed up
+        self.epsilon = rng.driver.uniform(2.0, 10.0) # sensitivity to speed up
         self.animlane = self.lane
-        self.last_lane_change = time.time()
+        self.time_since_lane_change = 0.0
 
     def update(self, conf, container, dt):
         super().update(conf, container, dt)
 
-    def prob_left(self, container, conf, af, vf, df, dlf, vlf, dlb, vlb):
-        return super().prob_left(container, conf, af, vf, df, dlf, vlf, dlb, vlb)
-
-    def prob_right(self, container, conf, df, vf, db, vrf, drf, vrb, drb):
-        return super().prob_right(container, conf, df, vf, db, vrf, drf, vrb, drb)
+    def prob_left(self, conf, af, vf, df, veh_lf, dlf, vlf, veh_lb, dlb, vlb):
+        return super().prob_left(conf, af, vf, df, veh_lf, dlf, vlf, veh_lb, dlb, vlb)
+
+    def prob_right(self, conf, df, vf, db, veh_rf, vrf, drf, veh_rb, vrb, drb):
+        return super().prob_right(conf, df, vf, db, veh_rf, vrf, drf, veh_rb, vrb, drb)
+
+    def locked_position(self, front, dt):
+        """
+        Platoon fast path (Config.platoons): the position of this vehicle
+        after the step if it is in steady lock-in behind front (already
+        updated) and stays in the copying branch of the lock-in zone, None
+        otherwise. Steady: no acceleration, the velocity is kept.
+        """
+        if self.acceleration != 0:
+            return None
+        position = self.position + dt*self.velocity
+        velocity = min(self.desired_velocity, self.velocity)
+        safe_distance = max(self.extremely_safe_distance, velocity * self.safe_time)
+        df = front.position - position
+        if self.HV_K3*safe_distance < df < self.HV_K2*safe_distance \
+                and abs(front.velocity - self.desired_velocity) < 2 and velocity - front.velocity < 1:
+            return position
+        return None
+
+    def advance_locked(self, conf, container, front, position, dt):
+        """
+        The update of a vehicle for which locked_position() gave position:
+        the same as update() (the lock-in zone keeps it clear of an emergency
+        speed change), except that locked-in vehicles don't consider lane
+        changes.
+        """
+        container.move(self, position)
+        self.emergency = max(0, self.emergency-1)
+        self.safe_distance = max(self.extremely_safe_distance,
+                                 min(self.desired_velocity, self.velocity) * self.safe_time)
+        # Drawn by every vehicle, to keep the random streams.
+        self._rng.lane_change.rand()
+        self.time_since_lane_change += dt
+        self._animate_lane_change()
+
+        self.velocity = front.velocity
+        self.acceleration = 0
+        if self.safe_distance > 2:
+            self.safe_distance -= 1
 
     def calc_acceleration(self, conf, af, vf, df):
 
@@ -375,3 +492,147 @@ class AutomaticCar(HumanVehicle):
         # print("self.velocity * self.safe_time: {}".format(self.velocity * self.safe_time))
 
         return a
+
+###########################################################
+#                       UNIT TESTS                        #
+###########################################################
+
+import unittest
+from config import HeadlessConfig
+from random_streams import RandomStreams
+from vehicle_container import VehicleContainer
+
+class LaneChangeFilterTest(unittest.TestCase):
+
+    def _road(self, gap):
+        """ A car at 100m behind a car at 100m + gap, an empty lane on each side. """
+        rng = RandomStreams(seed=3)
+        container = VehicleContainer(3)
+        car, front = Car(1, 100.0, rng=rng), Car(1, 100.0 + gap, rng=rng)
+        for v in (car, front):
+            v.velocity = 30.0
+            container.spawn(v)
+        car.time_since_lane_change = 2*LANE_CHANGE_COOLDOWN
+
+        lookups = []
+        for name in ('left_front', 'left_back', 'right_front', 'right_back'):
+            method = getattr(container, name)
+            setattr(container, name, lambda v, name=name, method=method: lookups.append(name) or method(v))
+        return car, container, lookups
+
+    def test_free_flow(self):
+        car, container, lookups = self._road(gap=500.0)
+        stream = car._rng.lane_change
+        draws = []
+        stream.rand = lambda rand=stream.rand: draws.append(1) or rand()
+        car.update(HeadlessConfig, container, 0.1)
+
+        # Only the right lane is considered, the draw is made anyway.
+        self.assertEqual(lookups, ['right_front', 'right_back'])
+        self.assertEqual(len(draws), 1)
+
+    def test_cooldown(self):
+        car, container, lookups = self._road(gap=20.0)
+        car.time_since_lane_change = 0.0
+        car.update(HeadlessConfig, container, 0.1)
+        self.assertEqual(lookups, [])
+        self.assertEqual(car.lane, 1)
+
+    def test_synchronous(self):
+        class Conf(HeadlessConfig):
+            lane_changes = 'synchronous'
+
+        car, container, lookups = self._road(gap=500.0)
+        car.update(Conf, container, 0.1)
+        # Only requested, the simulation resolves the requests.
+        self.assertEqual(car.lane, 1)
+        self.assertEqual(container.resolve_lane_changes(), [car])
+        self.assertEqual(car.lane, 2)
+        self.assertEqual(container.right_front(car), None)
+
+class PlatoonTest(unittest.TestCase):
+
+    def _chain(self, gaps):
+        """ A leader at its desired velocity followed by AutomaticCars at the given gaps, on one lane. """
+        rng = RandomStreams(seed=4)
+        container = VehicleContainer(1)
+        position = 500.0
+        chain = []
+        for gap in (0.0,) + tuple(gaps):
+            position -= gap
+            v = AutomaticCar(0, position, rng=rng)
+            v.desired_velocity = v.velocity = 32.0
+            v.safe_distance = 28.8
+            container.spawn(v)
+            chain.append(v)
+        return container, chain
+
+    def test_locked_chain(self):
+        gaps = (40.0, 45.0, 35.0)
+        container, chain = self._chain(gaps)
+        for v in chain:
+            v.update(HeadlessConfig, container, 0.1)
+
+        # The same steps on the fast path.
+        platoon, members = self._chain(gaps)
+        members[0].update(HeadlessConfig, platoon, 0.1)
+        for front, v in zip(members, members[1:]):
+            position = v.locked_position(front, 0.1)
+            self.assertIsNotNone(position)
+            v.advance_locked(HeadlessConfig, platoon, front, position, 0.1)
+
+        for v, member in zip(chain, members):
+            for k in vars(v):
+                if k != '_rng':
+                    self.assertEqual(getattr(v, k), getattr(member, k), k)
+
+    def test_fallback(self):
+        container, (leader, close, accelerating) = self._chain((25.0, 40.0))
+        accelerating.acceleration = 1.0
+        leader.update(HeadlessConfig, container, 0.1)
+        # Too close to stay in the lock-in zone, not steady.
+        self.assertIsNone(close.locked_position(leader, 0.1))
+        self.assertIsNone(accelerating.locked_position(close, 0.1))
+
+    def test_simulation(self):
+        from simulation import Simulation    # imports this module
+
+        class Conf(HeadlessConfig):
+            seed = 3
+            spawn_rate = 4.0
+            platoons = True
+
+        sim = Simulation(Conf())
+        members = []
+        sim.time_step_platoon_member = lambda v, *args, advance=sim.time_step_platoon_member: \
+            members.append(v) or advance(v, *args)
+        for i in range(2000):
+            sim.time_step(0.1)
+        self.assertGreater(len(members), 100)
+        self.assertTrue(all(isinstance(v, AutomaticCar) for v in members))
+
+class RoadEndTest(unittest.TestCase):
+
+    def test_leader_leaves(self):
+        from simulation import Simulation    # imports this module
+
+        class Conf(HeadlessConfig):
+            seed = 2
+            spawn_rate = 1e-6
+
+        sim = Simulation(Conf())
+        end = Conf.road_len
+        leader, follower = sim._pool.acquire(Car, 0), sim._pool.acquire(Car, 0)
+        leader.position, leader.velocity = end - 1.0, 30.0
+        follower.position, follower.velocity = end - 21.0, 25.0
+        sim._spawn_vehicles([leader, follower])
+        ids = leader.id, follower.id
+        sim.time_step(0.1)
+
+        # The leader left the road before its follower's update: the follower
+        # doesn't brake for it.
+        self.assertEqual([v.id for v in sim if v.id in ids], [follower.id])
+        self.assertGreater(follower.acceleration, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,22 +1,53 @@
-from vehicle import Vehicle
-from sortedcontainers import SortedList
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from itertools import islice
+from operator import attrgetter, gt, ne
+
+_position = attrgetter('position')
 
 class VehicleContainer:
+    """
+    The vehicles of every lane, ordered by position. Each lane is a list of
+    vehicles with a parallel list of their positions (the keys), so lookups
+    bisect floats instead of calling Vehicle.__lt__.
+
+    The container owns the positions: move() updates a vehicle and keeps its
+    lane sorted. repair() resyncs the keys with positions changed behind the
+    container's back and fixes the order with an insertion sort, which is
+    linear on nearly sorted lanes.
+    """
+
     def __init__(self, nb_lanes):
         self._nb_lanes = nb_lanes
-        self._lists = [SortedList() for i in range(nb_lanes)]
+        self._lists = [[] for i in range(nb_lanes)]
+        self._keys = [[] for i in range(nb_lanes)]
+        self._requests = []     # (vehicle, lane) lane changes to resolve
 
     def __iter__(self):
-        return VehicleContainerIter(self)
+        """ The vehicles from the front to the back, as ordered when the iteration starts. """
+        # The lanes are sorted, merge them from their fronts.
+        return iter(list(merge(*(reversed(l) for l in self._lists), key=_position, reverse=True)))
+
+    def _index(self, vehicle, lane=None):
+        lane = vehicle.lane if lane is None else lane
+        l, keys = self._lists[lane], self._keys[lane]
+        i = bisect_left(keys, vehicle.position)
+        while i < len(keys) and keys[i] == vehicle.position:
+            if l[i] is vehicle:
+                return i
+            i += 1
+        # The position was changed without move(), search by identity.
+        return l.index(vehicle)
 
     def front(self, vehicle):
-        i = self._lists[vehicle.lane].index(vehicle)
-        if i+1 >= len(self._lists[vehicle.lane]):
+        l = self._lists[vehicle.lane]
+        i = self._index(vehicle)
+        if i+1 >= len(l):
             return None
-        return self._lists[vehicle.lane][i+1]
+        return l[i+1]
 
     def back(self, vehicle):
-        i = self._lists[vehicle.lane].index(vehicle)
+        i = self._index(vehicle)
         if i == 0:
             return None
         return self._lists[vehicle.lane][i-1]
@@ -29,7 +60,7 @@ class VehicleContainer:
         pos = vehicle.position
         pos_left = left.position if left else None
 
-        if pos_left:
+        if pos_left is not None:
             if pos_left - pos > 0:
                 return left
             else:
@@ -42,7 +73,7 @@ class VehicleContainer:
         pos = vehicle.position
         pos_left = left.position if left else None
 
-        if pos_left:
+        if pos_left is not None:
             if pos_left - pos < 0:
                 return left
             else:
@@ -58,7 +89,7 @@ class VehicleContainer:
         pos = vehicle.position
         pos_right = right.position if right else None
 
-        if pos_right:
+        if pos_right is not None:
             if pos_right - pos > 0:
                 return right
             else:
@@ -71,7 +102,7 @@ class VehicleContainer:
         pos = vehicle.position
         pos_right = right.position if right else None
 
-        if pos_right:
+        if pos_right is not None:
             if pos_right - pos < 0:
                 return right
             else:
@@ -91,7 +122,7 @@ class VehicleContainer:
     def get_closest_vehicle(self, vehicle, lane):
         if lane in range(self._nb_lanes) and len(self._lists[lane]) > 0:
             l = self._lists[lane]
-            b = l.bisect(vehicle)
+            b = bisect_right(self._keys[lane], vehicle.position)
             v1 = l[max(0, b-1)]
             v2 = l[min(b, len(l)-1)]
             d1 = abs(v1.position-vehicle.position)
@@ -102,52 +133,251 @@ class VehicleContainer:
                 return v2
         return None
 
+    def neighbors_at(self, lane, position):
+        """ (back, front): the vehicles of lane just behind and ahead of position. """
+        l = self._lists[lane]
+        i = bisect_right(self._keys[lane], position)
+        return (l[i-1] if i > 0 else None, l[i] if i < len(l) else None)
+
+    def _insert(self, vehicle):
+        keys = self._keys[vehicle.lane]
+        i = bisect_right(keys, vehicle.position)
+        keys.insert(i, vehicle.position)
+        self._lists[vehicle.lane].insert(i, vehicle)
+
     def spawn(self, vehicle):
-        self._lists[vehicle.lane].insert(0, vehicle)
+        self._insert(vehicle)
         return vehicle
 
+    def spawn_many(self, vehicles):
+        """
+        Insert vehicles. A single vehicle of a lane is bisected in, the
+        vehicles of a lane with several are sorted and merged into the lane
+        in one pass.
+        """
+        batches = {}
+        for v in vehicles:
+            batches.setdefault(v.lane, []).append(v)
+        for lane, batch in batches.items():
+            if len(batch) == 1:
+                self._insert(batch[0])
+                continue
+            l = list(merge(self._lists[lane], sorted(batch, key=_position), key=_position))
+            self._lists[lane] = l
+            self._keys[lane] = [v.position for v in l]
+        return vehicles
+
+    def lane_open(self, lane, position):
+        """ Whether a vehicle at position may change to lane. """
+        return 0 <= lane < self._nb_lanes
+
     def despawn(self, vehicle):
-        if not vehicle in self._lists[vehicle.lane]:
+        try:
+            i = self._index(vehicle)
+        except ValueError:
             raise ValueError("vehicle not in container")
-        self._lists[vehicle.lane].discard(vehicle)
+        del self._lists[vehicle.lane][i]
+        del self._keys[vehicle.lane][i]
+
+    def beyond(self, position):
+        """ The vehicles past position, they are at the end of their lane. """
+        vehicles = []
+        for l, keys in zip(self._lists, self._keys):
+            vehicles.extend(l[bisect_right(keys, position):])
+        return vehicles
+
+    def despawn_beyond(self, position):
+        """ Remove the vehicles past position with one slice deletion per lane, returns them. """
+        vehicles = []
+        for l, keys in zip(self._lists, self._keys):
+            i = bisect_right(keys, position)
+            if i < len(l):
+                vehicles.extend(l[i:])
+                del l[i:]
+                del keys[i:]
+        return vehicles
 
     def notify_lane_change(self, vehicle, old_lane):
-        i = self._lists[old_lane].index(vehicle)
+        i = self._index(vehicle, old_lane)
         del self._lists[old_lane][i]
-
-        self._lists[vehicle.lane].add(vehicle)
-
-_DUMMY_VEHICLE = Vehicle(0);
-_DUMMY_VEHICLE.position = -999;
-
-class VehicleContainerIter:
-    def __init__(self, container):
-        self._container = container
-        self._iters = [reversed(l) for l in container._lists]
-        self._values = [_next_aux(it) for it in self._iters]
-
-    def __iter__(self):
+        del self._keys[old_lane][i]
+
+        self._insert(vehicle)
+
+    def request_lane_change(self, vehicle, lane):
+        """ Lane change of vehicle to lane, granted or not by resolve_lane_changes(). """
+        self._requests.append((vehicle, lane))
+
+    def resolve_lane_changes(self):
+        """
+        Grant the requested lane changes that don't conflict and apply them
+        together, returns the vehicles that changed lanes. Requests into the
+        same gap of a lane (between the same two vehicles of that lane)
+        conflict when they are closer than the safe distance of the one
+        behind or the length of the one in front: they are granted from the
+        front, so the result does not depend on the order of the requests.
+        """
+        requests, self._requests = self._requests, []
+        gaps = {}
+        for v, lane in requests:
+            gaps.setdefault((lane, bisect_right(self._keys[lane], v.position)), []).append(v)
+
+        granted = []
+        arrivals = {}           # lane -> granted vehicles
+        left = set()            # lanes that granted vehicles left
+        for (lane, i), vehicles in sorted(gaps.items()):
+            front = None
+            for v in sorted(vehicles, key=_position, reverse=True):
+                if front is None or front.position - v.position > max(front.length, v.safe_distance):
+                    left.add(v.lane)
+                    v.lane = lane
+                    arrivals.setdefault(lane, []).append(v)
+                    granted.append(v)
+                    front = v
+
+        # Re-partition the lanes the granted vehicles left or joined at once.
+        for lane in left | arrivals.keys():
+            vehicles = [v for v in self._lists[lane] if v.lane == lane] + arrivals.get(lane, [])
+            keys = [v.position for v in vehicles]
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            self._lists[lane] = [vehicles[i] for i in order]
+            self._keys[lane] = [keys[i] for i in order]
+        return granted
+
+    def move(self, vehicle, position):
+        """ Set the position of vehicle, it is moved past the vehicles it overtakes. """
+        l, keys = self._lists[vehicle.lane], self._keys[vehicle.lane]
+        i = self._index(vehicle)
+        vehicle.position = keys[i] = position
+
+        while i+1 < len(keys) and keys[i+1] < position:
+            l[i], l[i+1] = l[i+1], l[i]
+            keys[i], keys[i+1] = keys[i+1], position
+            i += 1
+        while i > 0 and keys[i-1] > position:
+            l[i], l[i-1] = l[i-1], l[i]
+            keys[i], keys[i-1] = keys[i-1], position
+            i -= 1
+
+    def repair(self):
+        """
+        Resync the keys with the positions of the vehicles and restore the
+        order of the lanes. Returns the number of lanes that were out of order.
+        """
+        repaired = 0
+        for lane, l in enumerate(self._lists):
+            # Only lanes with a position changed behind the container's back
+            # (compared in C, nothing is allocated for the others).
+            if not any(map(ne, map(_position, l), self._keys[lane])):
+                continue
+            keys = self._keys[lane] = [v.position for v in l]
+            # Detector: any pair out of order?
+            if any(map(gt, keys, islice(keys, 1, None))):
+                self._sort(lane)
+                repaired += 1
+        return repaired
+
+    def _sort(self, lane):
+        """ Insertion sort of a lane by key, linear if it is nearly sorted. """
+        l, keys = self._lists[lane], self._keys[lane]
+        for i in range(1, len(keys)):
+            k = keys[i]
+            if k >= keys[i-1]:
+                continue
+            v = l[i]
+            j = i - 1
+            while j >= 0 and keys[j] > k:
+                keys[j+1] = keys[j]
+                l[j+1] = l[j]
+                j -= 1
+            keys[j+1] = k
+            l[j+1] = v
+
+class WrappedVehicle:
+    """
+    A vehicle of a RingContainer seen across the seam of the ring: its
+    neighbor attributes, with the position one lap ahead or behind.
+    """
+
+    def __init__(self):
+        self.vehicle = None
+        self.lane = 0
+        self.position = 0.0
+        self.velocity = 0.0
+        self.acceleration = 0.0
+        self.length = 0.0
+        self.safe_distance = self.extremely_safe_distance = 0.0
+
+    def wrap(self, vehicle, offset):
+        self.vehicle = vehicle
+        self.lane = vehicle.lane
+        self.position = vehicle.position + offset
+        self.velocity = vehicle.velocity
+        self.acceleration = vehicle.acceleration
+        self.length = vehicle.length
+        self.safe_distance = vehicle.safe_distance
+        self.extremely_safe_distance = vehicle.extremely_safe_distance
         return self
 
-    def __next__(self):
-        mi, mv = max(enumerate(self._values), key=lambda t: t[1])
-        if mv is _DUMMY_VEHICLE:
-            raise StopIteration
+    def __lt__(self, other):
+        return self.position < other.position
+
+class RingContainer(VehicleContainer):
+    """
+    The lanes of a ring road of length road_len (Config.ring): positions
+    wrap around, the vehicle in front of the first vehicle of a lane is its
+    last one, one lap ahead. Across the seam, front() and back() return a
+    WrappedVehicle: one per lane and direction, allocated with the container
+    and refreshed when returned, so it is only valid until the next lookup
+    in that lane.
+    """
+
+    def __init__(self, nb_lanes, road_len):
+        super().__init__(nb_lanes)
+        self.road_len = road_len
+        self._ahead = [WrappedVehicle() for i in range(nb_lanes)]
+        self._behind = [WrappedVehicle() for i in range(nb_lanes)]
 
-        self._values[mi] = _next_aux(self._iters[mi])
-        return mv
+    def front(self, vehicle):
+        l = self._lists[vehicle.lane]
+        i = self._index(vehicle)
+        if i+1 < len(l):
+            return l[i+1]
+        return self._ahead[vehicle.lane].wrap(l[0], self.road_len)
 
-def _next_aux(it):
-    try:
-        return it.__next__()
-    except StopIteration:
-        return _DUMMY_VEHICLE
+    def back(self, vehicle):
+        l = self._lists[vehicle.lane]
+        i = self._index(vehicle)
+        if i > 0:
+            return l[i-1]
+        return self._behind[vehicle.lane].wrap(l[-1], -self.road_len)
+
+    def neighbors_at(self, lane, position):
+        l = self._lists[lane]
+        if not l:
+            return None, None
+        i = bisect_right(self._keys[lane], position)
+        return (l[i-1] if i > 0 else self._behind[lane].wrap(l[-1], -self.road_len),
+                l[i] if i < len(l) else self._ahead[lane].wrap(l[0], self.road_len))
+
+    def move(self, vehicle, position):
+        if 0 <= position < self.road_len:
+            super().move(vehicle, position)
+            return
+        # Across the seam: from one end of the lane to the other.
+        i = self._index(vehicle)
+        del self._lists[vehicle.lane][i]
+        del self._keys[vehicle.lane][i]
+        position %= self.road_len
+        vehicle.position = position if position < self.road_len else 0.0
+        self._insert(vehicle)
 
 ###########################################################
 #                       UNIT TESTS                        #
 ###########################################################
 
 import unittest
+from vehicle import Vehicle
 
 class VehicleContainerTest(unittest.TestCase):
 
@@ -208,6 +438,17 @@ class VehicleContainerTest(unittest.TestCase):
         self.assertEqual(container.left(v4), v2)
         self.assertEqual(container.right(v4), v6)
 
+    def test_neighbor_at_zero(self):
+        # A neighbor at position 0 is still a neighbor.
+        container = VehicleContainer(2)
+        v1 = container.spawn(Vehicle(0, position=0.0))
+        v2 = container.spawn(Vehicle(1, position=5.0))
+        v3 = container.spawn(Vehicle(1, position=0.0))
+
+        self.assertIs(container.right_front(v1), v2)
+        self.assertIs(container.left_front(v3), None)
+        self.assertIs(container.left_back(v2), v1)
+
     def test_iter(self):
         container = VehicleContainer(3)
         v1 = container.spawn(Vehicle(0, position=4))
@@ -260,5 +501,109 @@ class VehicleContainerTest(unittest.TestCase):
         self.assertEqual(container.back(v2), v1)
         self.assertIsNone(container.first(0))
 
+    def test_bulk(self):
+        container = VehicleContainer(2)
+        vehicles = [Vehicle(lane, position=p) for lane, p in
+                    [(0, 1.0), (0, 10.0), (0, 12.0), (1, 3.0), (1, 10.0)]]
+        container.spawn_many(vehicles)
+
+        self.assertEqual(container.first(0), vehicles[2])
+        self.assertEqual(container.last(1), vehicles[3])
+        self.assertEqual(set(container.beyond(9.0)), set(vehicles[1:3] + vehicles[4:]))
+
+        removed = container.despawn_beyond(10.0)
+        self.assertEqual(removed, [vehicles[2]])
+        self.assertEqual(container.first(0), vehicles[1])
+        self.assertEqual(container.first(1), vehicles[4])
+        with self.assertRaises(ValueError):
+            container.despawn(vehicles[2])
+
+    def test_move(self):
+        container = VehicleContainer(1)
+        v1, v2, v3 = container.spawn_many([Vehicle(0, position=p) for p in (1.0, 2.0, 3.0)])
+
+        container.move(v1, 2.5)
+        self.assertEqual(container.front(v1), v3)
+        self.assertEqual(container.back(v1), v2)
+        self.assertEqual(container._keys[0], [2.0, 2.5, 3.0])
+
+    def test_spawn_many(self):
+        container = VehicleContainer(2)
+        old = container.spawn_many([Vehicle(0, position=p) for p in (2.0, 6.0, 4.0)])
+        new = container.spawn_many([Vehicle(0, position=p) for p in (5.0, 0.0, 4.0)] +
+                                   [Vehicle(1, position=3.0)])
+
+        self.assertEqual(container._keys[0], [0.0, 2.0, 4.0, 4.0, 5.0, 6.0])
+        # Vehicles already in the lane come before new ones at the same position.
+        self.assertEqual(container._lists[0],
+                         [new[1], old[0], old[2], new[2], new[0], old[1]])
+        self.assertEqual(container._lists[1], [new[3]])
+
+    def test_repair(self):
+        container = VehicleContainer(2)
+        vehicles = container.spawn_many([Vehicle(i % 2, position=float(i)) for i in range(10)])
+        self.assertEqual(container.repair(), 0)
+
+        # Overtakes behind the container's back.
+        vehicles[2].position = 7.5
+        vehicles[9].position = 0.5
+        self.assertEqual(container.repair(), 2)
+        self.assertEqual([v.position for v in container._lists[0]], [0.0, 4.0, 6.0, 7.5, 8.0])
+        self.assertEqual(container._keys[1], [0.5, 1.0, 3.0, 5.0, 7.0])
+        self.assertEqual(container.front(vehicles[2]), vehicles[8])
+
+    def test_resolve_lane_changes(self):
+        def resolve(order):
+            container = VehicleContainer(3)
+            vehicles = container.spawn_many([Vehicle(lane, position=p) for lane, p in
+                                             [(1, 0.0), (1, 50.0), (0, 20.0), (2, 27.0), (0, 30.0), (2, 60.0)]])
+            for v in vehicles:
+                v.length, v.safe_distance = 4.0, 5.0
+            for i in order:
+                container.request_lane_change(vehicles[i], 1)
+            granted = container.resolve_lane_changes()
+            return vehicles, granted, container
+
+        # 2, 3 and 4 want the same gap of lane 1: 4 is granted first, 3 is
+        # too close behind it, 2 is far enough behind 4.
+        vehicles, granted, container = resolve([2, 3, 4, 5])
+        self.assertEqual(granted, [vehicles[4], vehicles[2], vehicles[5]])
+        self.assertEqual(container._lists[1], [vehicles[i] for i in (0, 2, 4, 1, 5)])
+        self.assertEqual(container._keys[1], [0.0, 20.0, 30.0, 50.0, 60.0])
+        self.assertEqual(container._lists[0], [])
+        self.assertEqual(container._lists[2], [vehicles[3]])
+        self.assertEqual(vehicles[3].lane, 2)
+
+        # Same result whatever the order of the requests.
+        vehicles, granted, container = resolve([5, 4, 3, 2])
+        self.assertEqual(granted, [vehicles[4], vehicles[2], vehicles[5]])
+        self.assertEqual(container.resolve_lane_changes(), [])
+
+    def test_ring(self):
+        container = RingContainer(2, 100.0)
+        v1, v2, v3 = container.spawn_many([Vehicle(0, position=p) for p in (10.0, 90.0, 50.0)])
+        for v in (v1, v2, v3):
+            v.length, v.safe_distance, v.extremely_safe_distance = 4.0, 5.0, 3.0
+
+        front = container.front(v2)
+        self.assertIs(front.vehicle, v1)
+        self.assertEqual(front.position, 110.0)
+        self.assertEqual(container.back(v1).position, -10.0)
+        self.assertEqual(container.neighbors_at(1, 20.0), (None, None))
+        back, front = container.neighbors_at(0, 95.0)
+        self.assertIs(back, v2)
+        self.assertEqual(front.position, 110.0)
+
+        container.move(v2, 102.5)
+        self.assertEqual(v2.position, 2.5)
+        self.assertEqual(container._lists[0], [v2, v1, v3])
+        self.assertEqual(container._keys[0], [2.5, 10.0, 50.0])
+        self.assertEqual(container.back(v2).vehicle, v3)
+
+        # A single vehicle follows itself.
+        v4 = container.spawn(Vehicle(1, position=30.0))
+        v4.length = v4.safe_distance = v4.extremely_safe_distance = 1.0
+        self.assertEqual(container.front(v4).position - v4.position, 100.0)
+
 if __name__ == '__main__':
     unittest.main()